@@ -0,0 +1,102 @@
+"""
+Builds an interval account range index with N ranges and measures lookups per second,
+with the LRU cache cold (every PAN in a different range) and hot (a working set of BINs).
+--mapped does the same with the ranges compiled into a memory mapped file.
+
+    python -m benchmark.account_range_lookup --ranges 1000000 [--mapped]
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import pydantic
+
+from checkout.card_processing import account_ranges, adapters
+
+
+def generate_ranges(count: int, seed: int = 7) -> list:
+    """
+    Non overlapping 10 digits account ranges, with one BIN wide range out of every hundred nesting some of them.
+    Issuers are drawn from a small set, like in real scheme tables.
+    """
+    rng = random.Random(seed)
+    pan_infos = [adapters.PANInfo(country=rng.choice(["FR", "UK", "VE", "US", "DE"]),
+                                  franchise=rng.choice(["VISA", "MASTER_CARD"]),
+                                  category=rng.choice(["CLASSIC", "GOLD", "BLACK"]),
+                                  issuer=f"ISSUER-{issuer}") for issuer in range(2000)]
+    ranges = []
+    low = 4_000_000_000
+    for position in range(count):
+        low += rng.randint(1, 50)
+        high = low + rng.randint(0, 40)
+        if position % 100 == 0:
+            bin_prefix = str(low)[:6]
+            ranges.append(adapters.AccountRange(low=bin_prefix, high=bin_prefix, pan_info=rng.choice(pan_infos)))
+        ranges.append(adapters.AccountRange(low=str(low), high=str(high), pan_info=rng.choice(pan_infos)))
+        low = high
+    return ranges[:count]
+
+
+def measure(provider: adapters.AccountRangeProvider, pans: list) -> float:
+    started = time.perf_counter()
+    for pan in pans:
+        provider.get_pan_info(pan=pan)
+    return len(pans) / (time.perf_counter() - started)
+
+
+def build_mapped_provider(ranges: list, directory: str, cache_size: int = 65536) -> adapters.AccountRangeProvider:
+    source = os.path.join(directory, "ranges.csv")
+    with open(source, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(account_ranges.CSV_COLUMNS)
+        for account_range in ranges:
+            info = account_range.pan_info
+            writer.writerow([account_range.low, account_range.high,
+                             info.country, info.franchise, info.category, info.issuer])
+    destination = os.path.join(directory, "ranges.bin")
+    account_ranges.compile_csv(source, destination)
+    return adapters.MappedAccountRangeProvider(path=destination, cache_size=cache_size)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ranges", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=200_000)
+    parser.add_argument("--mapped", action="store_true")
+    args = parser.parse_args()
+
+    ranges = generate_ranges(args.ranges)
+    directory = tempfile.mkdtemp(prefix="account-ranges-")
+    started = time.perf_counter()
+    if args.mapped:
+        provider = build_mapped_provider(ranges, directory=directory)
+        uncached = build_mapped_provider(ranges, directory=directory, cache_size=0)
+    else:
+        provider = adapters.IntervalAccountRangeProvider(ranges=ranges)
+        uncached = adapters.IntervalAccountRangeProvider(ranges=ranges, cache_size=0)
+    build_seconds = time.perf_counter() - started
+
+    rng = random.Random(11)
+    cold_pans = [pydantic.SecretStr(rng.choice(ranges).low.ljust(10, "0") + f"{rng.randint(0, 999999):06d}")
+                 for _ in range(args.lookups)]
+    working_set = cold_pans[:1000]
+    hot_pans = [rng.choice(working_set) for _ in range(args.lookups)]
+
+    print(json.dumps({
+        "ranges": args.ranges,
+        "provider": type(provider).__name__,
+        "build_seconds": round(build_seconds, 2),
+        "uncached_lookups_per_second": round(measure(uncached, cold_pans)),
+        "cold_cache_lookups_per_second": round(measure(provider, cold_pans)),
+        "hot_cache_lookups_per_second": round(measure(provider, hot_pans)),
+    }))
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Local stand-in for the HTTP API of an acquirer, to load test routing, retries and connection pooling end to end on
+one machine:
+
+    python -m benchmark.acquirer_simulator --port 9001 --latency lognormal:0.08,0.4 --error-rate 0.01 \\
+        --timeout-rate 0.002 --response-codes 00=0.95,51=0.03,19=0.02
+    CHECKOUT_CKO_ACQUIRER_URL=http://127.0.0.1:9001 uvicorn checkout.gateway.entrypoint:app
+
+Every ``POST /v1/captures`` waits a latency drawn from ``--latency`` and is answered with a response code drawn from
+``--response-codes``. A share of them, ``--error-rate``, is answered with a 503 instead, and ``--timeout-rate`` is
+held for ``--timeout-seconds`` before answering, longer than the gateway waits. The test cards of the gateway keep
+their usual answers. Connections are kept alive, idle ones are closed after ``--keep-alive-seconds``.
+"""
+import argparse
+import collections
+import http.server
+import json
+import random
+import threading
+import time
+from typing import Callable, Counter, List, NamedTuple, Optional, Tuple
+
+RESPONSE_MESSAGES = {
+    "00": "Approved or completed successfully",
+    "05": "Do not honour",
+    "14": "Invalid card number",
+    "19": "Re-enter transaction",
+    "43": "Stolen card, pick up",
+    "51": "Insufficient funds",
+    "54": "Expired card",
+    "91": "Issuer or switch inoperative",
+    "96": "System malfunction",
+}
+# The answers the in-memory acquirers give to the gateway's test cards.
+TEST_CARDS = {"5555555555555555": "43", "4444444444444444": "19"}
+
+
+class Behaviour(NamedTuple):
+    latency: Callable[[random.Random], float]
+    response_codes: List[Tuple[str, float]]
+    error_rate: float = 0.0
+    timeout_rate: float = 0.0
+    timeout_seconds: float = 30.0
+    network: str = "CKO"
+    interchange_rate: str = "0.10"
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    ``constant:0.05``, ``uniform:0.01,0.1``, ``normal:0.05,0.01``, ``lognormal:<median>,<sigma>`` or
+    ``exponential:<mean>``, in seconds.
+    """
+    distribution, _, arguments = spec.partition(":")
+    values = [float(value) for value in arguments.split(",") if value]
+    if distribution == "constant":
+        return lambda rng: values[0]
+    if distribution == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if distribution == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if distribution == "lognormal":
+        median, sigma = values
+        return lambda rng: median * rng.lognormvariate(0.0, sigma)
+    if distribution == "exponential":
+        return lambda rng: rng.expovariate(1.0 / values[0])
+    raise ValueError(f"Unknown latency distribution {spec!r}")
+
+
+def parse_response_codes(spec: str) -> List[Tuple[str, float]]:
+    """``00=0.9,51=0.1``: response codes and their weights."""
+    codes = []
+    for entry in filter(None, spec.split(",")):
+        code, _, weight = entry.partition("=")
+        codes.append((code.strip(), float(weight or 1)))
+    return codes
+
+
+class AcquirerSimulator(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], behaviour: Behaviour, seed: Optional[int] = None,
+                 keep_alive_seconds: Optional[float] = None) -> None:
+        super().__init__(address, _CaptureHandler)
+        self.behaviour = behaviour
+        # Idle connections are closed after that long, like the load balancer in front of an acquirer would.
+        self.keep_alive_seconds = keep_alive_seconds
+        self.outcomes: Counter[str] = collections.Counter()
+        self.connections = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def draw(self, pan: str) -> Tuple[str, float, str]:
+        """Outcome of a capture: ``error``, ``timeout`` or its response code, and its latency."""
+        behaviour = self.behaviour
+        with self._lock:
+            latency = behaviour.latency(self._random)
+            roll = self._random.random()
+            if roll < behaviour.error_rate:
+                outcome = "error"
+            elif roll < behaviour.error_rate + behaviour.timeout_rate:
+                outcome, latency = "timeout", behaviour.timeout_seconds
+            else:
+                codes, weights = zip(*behaviour.response_codes)
+                outcome = TEST_CARDS.get(pan) or self._random.choices(codes, weights)[0]
+            approval_code = "".join(self._random.choices("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", k=10))
+            self.outcomes[outcome] += 1
+        return outcome, latency, approval_code
+
+    def start(self) -> "AcquirerSimulator":
+        threading.Thread(target=self.serve_forever, name="acquirer-simulator", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _CaptureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: AcquirerSimulator
+
+    def setup(self) -> None:
+        self.timeout = self.server.keep_alive_seconds
+        super().setup()
+        with self.server._lock:
+            self.server.connections += 1
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/v1/captures":
+            self._answer(404, {"error": "not found"})
+            return
+        capture = json.loads(body or b"{}")
+        outcome, latency, approval_code = self.server.draw(pan=capture.get("pan", ""))
+        time.sleep(latency)
+        if outcome == "error":
+            self._answer(503, {"error": "acquirer unavailable"})
+            return
+        outcome = "00" if outcome == "timeout" else outcome
+        behaviour = self.server.behaviour
+        self._answer(200, {
+            "network": behaviour.network,
+            "response_code": outcome,
+            "response_message": RESPONSE_MESSAGES.get(outcome, "Declined"),
+            "approval_code": approval_code if outcome == "00" else "",
+            "interchange_rate": behaviour.interchange_rate,
+        })
+
+    def _answer(self, status: int, content: dict) -> None:
+        payload = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--latency", default="lognormal:0.08,0.4", help="see parse_latency")
+    parser.add_argument("--response-codes", default="00=0.95,51=0.03,19=0.02")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-seconds", type=float, default=30.0)
+    parser.add_argument("--network", default="CKO")
+    parser.add_argument("--interchange-rate", default="0.10")
+    parser.add_argument("--keep-alive-seconds", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    behaviour = Behaviour(
+        latency=parse_latency(args.latency),
+        response_codes=parse_response_codes(args.response_codes),
+        error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate,
+        timeout_seconds=args.timeout_seconds,
+        network=args.network,
+        interchange_rate=args.interchange_rate,
+    )
+    simulator = AcquirerSimulator((args.host, args.port), behaviour=behaviour, seed=args.seed,
+                                  keep_alive_seconds=args.keep_alive_seconds)
+    print(f"acquirer simulator listening on {simulator.url}", flush=True)
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.server_close()
+        print(json.dumps({"connections": simulator.connections, "outcomes": dict(simulator.outcomes)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import pydantic
+
+
+class Response(pydantic.BaseModel):
+    status_code: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+
+
+async def request(app: Callable, method: str, path: str, body: bytes = b"",
+                  headers: Sequence[Tuple[bytes, bytes]] = ((b"content-type", b"application/json"),)) -> Response:
+    """
+    Sends a single HTTP request straight to an ASGI application, without sockets,
+    so benchmarks measure the application and not the HTTP stack.
+    """
+    path, _, query_string = path.partition("?")
+    scope: Dict[str, Any] = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query_string.encode(),
+        "root_path": "",
+        "headers": [(b"host", b"testserver"), *headers],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    request_sent = False
+    response_complete = asyncio.Event()
+    status_code: Optional[int] = None
+    response_headers: List[Tuple[bytes, bytes]] = []
+    chunks: List[bytes] = []
+
+    async def receive() -> Dict[str, Any]:
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await response_complete.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Dict[str, Any]) -> None:
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+            response_headers.extend(message.get("headers", []))
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                response_complete.set()
+
+    await app(scope, receive, send)
+    response_complete.set()
+    return Response(status_code=status_code or 500, headers=response_headers, body=b"".join(chunks))
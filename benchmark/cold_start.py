@@ -0,0 +1,152 @@
+"""
+Measures the cold start of the serverless function: how long a fresh interpreter takes to import
+``checkout.gateway.entrypoint`` and answer its first ``POST /v1/payments``, and which modules the import spends
+that time in.
+
+    python -m benchmark.cold_start --runs 5
+    python -m benchmark.cold_start --warmup --budget-seconds 2.5
+
+Every run is a new process, the first payment goes through ASGI with a fake connection pool so the database is not
+part of the measurement. With --budget-seconds it exits with an error when the median time to the first payment is
+above the budget.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, NamedTuple
+
+ENTRYPOINT = "checkout.gateway.entrypoint"
+
+
+class ImportTime(NamedTuple):
+    module: str
+    self_seconds: float
+    cumulative_seconds: float
+
+
+class ColdStart(NamedTuple):
+    """Seconds since the process was spawned, ``total_seconds`` is the time to the first payment answered."""
+    import_seconds: float
+    warmup_seconds: float
+    first_payment_seconds: float
+    total_seconds: float
+    status_code: int
+
+
+def _root() -> str:
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _environment() -> Dict[str, str]:
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [_root(), environment.get("PYTHONPATH")]))
+    return environment
+
+
+# IMPORT PROFILE #########################################
+def profile_imports(module: str = ENTRYPOINT) -> List[ImportTime]:
+    """Imports ``module`` in a fresh interpreter with ``-X importtime``, in the order the imports finished."""
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True, env=_environment(), cwd=_root(), check=True)
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append(ImportTime(module=name.strip(), self_seconds=int(self_us) / 1e6,
+                                  cumulative_seconds=int(cumulative_us) / 1e6))
+    return imports
+
+
+def by_package(imports: List[ImportTime]) -> Dict[str, float]:
+    packages: Dict[str, float] = collections.defaultdict(float)
+    for entry in imports:
+        packages[entry.module.split(".")[0]] += entry.self_seconds
+    return dict(sorted(packages.items(), key=lambda item: item[1], reverse=True))
+
+
+# TIME TO FIRST PAYMENT #########################################
+def measure(warmup: bool = False) -> ColdStart:
+    spawned = time.time()
+    command = [sys.executable, "-m", "benchmark.cold_start", "--child", "--spawned", repr(spawned)]
+    if warmup:
+        command.append("--warmup")
+    process = subprocess.run(command, capture_output=True, text=True, env=_environment(), cwd=_root())
+    if process.returncode != 0:
+        raise RuntimeError(f"cold start run failed:\n{process.stderr}")
+    return ColdStart(**json.loads(process.stdout.splitlines()[-1]))
+
+
+def _child(spawned: float, warmup: bool) -> None:
+    from checkout.gateway import entrypoint
+    imported = time.time()
+
+    from benchmark import asgi, payment_hops
+    from checkout.gateway import adapters
+    from checkout.infrastructure import database
+    from test.checkout.gateway import faker as gateway_faker
+    from test.checkout.infrastructure import faker
+
+    pool = database.ConnectionPool(settings=database.PoolSettings(min_size=0), connect=faker.FakeConnectionFactory())
+    database.get_pool = lambda: pool
+    merchants = adapters.CachedMerchantRepository(repository=gateway_faker.FakeMerchantRepository.with_active(
+        payment_hops.PAYMENT_REQUEST["merchant_id"]))
+    merchants.load()
+    adapters.get_merchant_repository = lambda: merchants
+    # The measurement and the fakes it needs are not part of the cold start.
+    ready = time.time()
+    if warmup:
+        entrypoint.warmup()
+    warmed_up = time.time()
+    response = asyncio.run(asgi.request(entrypoint.app, "POST", "/v1/payments",
+                                        body=json.dumps(payment_hops.PAYMENT_REQUEST).encode()))
+    answered = time.time()
+    excluded = ready - imported
+    print(json.dumps(ColdStart(
+        import_seconds=imported - spawned,
+        warmup_seconds=warmed_up - ready,
+        first_payment_seconds=answered - warmed_up,
+        total_seconds=answered - spawned - excluded,
+        status_code=response.status_code,
+    )._asdict()))
+
+
+# REPORT #########################################
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--warmup", action="store_true", help="call entrypoint.warmup() before the first payment")
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    parser.add_argument("--budget-seconds", type=float, default=None)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--spawned", type=float, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(spawned=args.spawned, warmup=args.warmup)
+        return
+
+    imports = profile_imports()
+    runs = [measure(warmup=args.warmup) for _ in range(args.runs)]
+    median = statistics.median(run.total_seconds for run in runs)
+    print(json.dumps({
+        "import_seconds": round(sum(entry.self_seconds for entry in imports), 4),
+        "packages": {package: round(seconds, 4) for package, seconds in list(by_package(imports).items())[:10]},
+        "slowest_modules": [
+            {"module": entry.module, "self_seconds": round(entry.self_seconds, 4)}
+            for entry in sorted(imports, key=lambda entry: entry.self_seconds, reverse=True)[:args.top]],
+        "runs": [{name: round(value, 4) for name, value in run._asdict().items()} for run in runs],
+        "median_time_to_first_payment_seconds": round(median, 4),
+    }, indent=2))
+    if args.budget_seconds is not None and median > args.budget_seconds:
+        sys.exit(f"median time to first payment {median:.3f}s is above the budget of {args.budget_seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+from typing import Iterator, List, Tuple
+
+# Every value keeps its 8 most significant bits: under 1% error, like an HDR histogram with 2 significant digits.
+_SUB_BUCKET_BITS = 8
+_HALF_SUB_BUCKET = 1 << (_SUB_BUCKET_BITS - 1)
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of microsecond latencies in preallocated buckets, in the spirit of HdrHistogram:
+    recording is constant time and percentiles are exact to the bucket width.
+    """
+
+    def __init__(self, highest_microseconds: int = 60_000_000) -> None:
+        self._highest = highest_microseconds
+        self._counts: List[int] = [0] * (self._index(highest_microseconds) + 1)
+        self.total = 0
+        self.max = 0
+        self.min = highest_microseconds
+
+    def record(self, microseconds: int) -> None:
+        value = min(max(0, microseconds), self._highest)
+        self._counts[self._index(value)] += 1
+        self.total += 1
+        self.max = max(self.max, value)
+        self.min = min(self.min, value)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        for index, count in enumerate(other._counts):
+            self._counts[index] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.min = min(self.min, other.min)
+
+    def percentile(self, percentile: float) -> int:
+        """
+        Highest value of the bucket holding the given percentile, 0 when nothing was recorded.
+        """
+        if not self.total:
+            return 0
+        rank = max(1, round(percentile / 100 * self.total))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return min(self._highest_of(index), self.max)
+        return self.max
+
+    def distribution(self) -> Iterator[Tuple[int, float, int]]:
+        """
+        Yields ``(value, percentile, total count)`` for every non empty bucket, the percentile distribution
+        printed by HdrHistogram and plotted by its tools.
+        """
+        seen = 0
+        for index, count in enumerate(self._counts):
+            if count:
+                seen += count
+                yield min(self._highest_of(index), self.max), seen / self.total, seen
+
+    def hdr_output(self) -> str:
+        lines = [f"{'Value':>12} {'Percentile':>14} {'TotalCount':>10} {'1/(1-Percentile)':>18}", ""]
+        for value, percentile, count in self.distribution():
+            inverse = f"{1 / (1 - percentile):.2f}" if percentile < 1 else "inf"
+            lines.append(f"{value / 1000:12.3f} {percentile:14.12f} {count:10d} {inverse:>18}")
+        lines.append(f"#[Max = {self.max / 1000:.3f}, Total count = {self.total}]")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _index(value: int) -> int:
+        shift = max(0, value.bit_length() - _SUB_BUCKET_BITS)
+        return (shift * _HALF_SUB_BUCKET) + (value >> shift)
+
+    @staticmethod
+    def _highest_of(index: int) -> int:
+        shift = max(0, index // _HALF_SUB_BUCKET - 1)
+        sub_bucket = index - shift * _HALF_SUB_BUCKET
+        return ((sub_bucket + 1) << shift) - 1
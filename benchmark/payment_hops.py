@@ -0,0 +1,93 @@
+"""
+Measures the CPU time and the memory churn of a single payment going from the gateway through card processing and
+back, with in-memory repositories and acquirer so only the conversions between layers and the domain work count.
+
+    python -m benchmark.payment_hops --payments 20000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from checkout.card_processing import adapters as card_processing_adapters
+from checkout.gateway import adapters, services
+from checkout.standard_types import helpers
+from test.checkout.card_processing import faker as card_processing_faker
+from test.checkout.gateway import faker
+
+PAYMENT_REQUEST = {
+    "merchant_id": "1",
+    "currency": "EUR",
+    "total_amount": "100.0",
+    "tip": "0.0",
+    "vat": "0.0",
+    "card": {
+        "cardholder_name": "Juls Cesar",
+        "expiration_month": 12,
+        "expiration_year": 2030,
+        "pan": "3333111122223333",
+        "cvv": "000"
+    }
+}
+
+
+class InMemoryCardNotPresentPaymentRepository(faker.FakeCardNotPresentPaymentRepository):
+    def __init__(self) -> None:
+        super().__init__(ids=[])
+
+    def generate_id(self) -> str:
+        return helpers.IDGenerator.hex_uuid()
+
+
+class InMemoryCardNotPresentTransactionRepository(card_processing_faker.FakeCardNotPresentTransactionRepository):
+    def __init__(self) -> None:
+        super().__init__(ids=[])
+
+    def generate_id(self) -> str:
+        return helpers.IDGenerator.hex_uuid()
+
+
+def measure(payments: int) -> dict:
+    request = services.PaymentRequest.model_validate(PAYMENT_REQUEST)
+    repository = InMemoryCardNotPresentPaymentRepository()
+    processor = adapters.FlashyCardNotPresentProvider(
+        router=card_processing_faker.StubApprovedTransactionRouter(),
+        account_range_provider=card_processing_adapters.FlashyAccountRangeProvider(),
+        repo=InMemoryCardNotPresentTransactionRepository())
+
+    for _ in range(min(payments, 1000)):
+        services.process_payment(request=request, repository=repository, processor=processor)
+
+    started = time.process_time()
+    for _ in range(payments):
+        services.process_payment(request=request, repository=repository, processor=processor)
+    cpu_seconds = time.process_time() - started
+
+    # Traced separately, tracing slows every allocation down.
+    peaks = 0
+    tracemalloc.start()
+    try:
+        for _ in range(min(payments, 2000)):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            services.process_payment(request=request, repository=repository, processor=processor)
+            peaks += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "payments": payments,
+        "cpu_us_per_payment": round(cpu_seconds / payments * 1_000_000, 1),
+        "peak_bytes_per_payment": round(peaks / min(payments, 2000)),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payments", type=int, default=20000)
+    args = parser.parse_args()
+    print(json.dumps(measure(payments=args.payments)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Compares the blocking and the non-blocking payment paths through a FastAPI application.
+
+Both routes use the in-memory fakes with simulated I/O latency: the repositories and the acquirer
+block the calling thread like psycopg2 and a synchronous HTTP client would.
+
+    python -m benchmark.payment_path --clients 500 --duration 10
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import decimal
+import json
+import time
+from typing import List
+
+import fastapi
+
+from benchmark import asgi
+from checkout.card_processing import adapters as card_processing_adapters
+from checkout.gateway import adapters, model, services
+from checkout.standard_types import card, helpers
+from test.checkout.card_processing import faker as card_processing_faker
+from test.checkout.gateway import faker
+
+
+class SlowCardNotPresentPaymentRepository(faker.FakeCardNotPresentPaymentRepository):
+    def __init__(self, latency: float) -> None:
+        super().__init__(ids=[])
+        self.latency = latency
+
+    def generate_id(self) -> str:
+        return helpers.IDGenerator.hex_uuid()
+
+    def create_payment(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
+        time.sleep(self.latency)
+        return super().create_payment(payment=payment)
+
+    def update_payment(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
+        time.sleep(self.latency)
+        return super().update_payment(payment=payment)
+
+
+class SlowCardNotPresentTransactionRepository(card_processing_faker.FakeCardNotPresentTransactionRepository):
+    def __init__(self, latency: float) -> None:
+        super().__init__(ids=[])
+        self.latency = latency
+
+    def generate_id(self) -> str:
+        return helpers.IDGenerator.hex_uuid()
+
+    def register_transaction(self, transaction):
+        time.sleep(self.latency)
+        return super().register_transaction(transaction=transaction)
+
+    def update_transaction(self, transaction):
+        time.sleep(self.latency)
+        return super().update_transaction(transaction=transaction)
+
+
+class SlowAcquiringProcessorProvider(card_processing_adapters.AcquiringProcessorProvider):
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    def capture(self, message: card_processing_adapters.CaptureMessage) -> card_processing_adapters.FinancialMessageResult:
+        time.sleep(self.latency)
+        return card_processing_adapters.ApprovedCapture(
+            network=card.AcquiringNetwork.CKO,
+            response_code="00",
+            response_message="Approved or completed successfully",
+            interchange_rate=decimal.Decimal("0.10"),
+            approval_code="ABCDEFG1234",
+        )
+
+
+class SlowTransactionRouter(card_processing_adapters.TransactionRouter):
+    def __init__(self, latency: float) -> None:
+        self.provider = SlowAcquiringProcessorProvider(latency=latency)
+
+    def get_acquiring_processing_providers(self, package):
+        yield self.provider
+
+
+PAYMENT_REQUEST = {
+    "merchant_id": "1",
+    "currency": "EUR",
+    "total_amount": "100.0",
+    "tip": "0.0",
+    "vat": "0.0",
+    "card": {
+        "cardholder_name": "Juls Cesar",
+        "expiration_month": 12,
+        "expiration_year": 2030,
+        "pan": "3333111122223333",
+        "cvv": "000"
+    }
+}
+
+
+def build_app(db_latency: float, acquirer_latency: float) -> fastapi.FastAPI:
+    app = fastapi.FastAPI()
+    repository = SlowCardNotPresentPaymentRepository(latency=db_latency)
+    processor = adapters.FlashyCardNotPresentProvider(
+        router=SlowTransactionRouter(latency=acquirer_latency),
+        account_range_provider=card_processing_adapters.FlashyAccountRangeProvider(),
+        repo=SlowCardNotPresentTransactionRepository(latency=db_latency))
+
+    @app.post("/sync/v1/payments")
+    async def make_payment_sync(request: services.PaymentRequest) -> services.PaymentResponse:
+        return services.process_payment(request=request, repository=repository, processor=processor)
+
+    @app.post("/async/v1/payments")
+    async def make_payment_async(request: services.PaymentRequest) -> services.PaymentResponse:
+        return await services.process_payment_async(request=request, repository=repository, processor=processor)
+
+    return app
+
+
+async def run(app: fastapi.FastAPI, path: str, clients: int, duration: float) -> dict:
+    body = json.dumps(PAYMENT_REQUEST).encode()
+    latencies: List[float] = []
+    errors = 0
+    stop_at = time.perf_counter() + duration
+
+    async def client() -> None:
+        nonlocal errors
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            response = await asgi.request(app, "POST", path, body=body)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "path": path,
+        "clients": clients,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--db-latency-ms", type=float, default=2.0)
+    parser.add_argument("--acquirer-latency-ms", type=float, default=50.0)
+    parser.add_argument("--threads", type=int, default=64, help="size of the executor used by the async path")
+    args = parser.parse_args()
+
+    app = build_app(db_latency=args.db_latency_ms / 1000, acquirer_latency=args.acquirer_latency_ms / 1000)
+
+    async def compare() -> None:
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(max_workers=args.threads))
+        for path in ("/sync/v1/payments", "/async/v1/payments"):
+            print(json.dumps(await run(app, path=path, clients=args.clients, duration=args.duration)))
+
+    asyncio.run(compare())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Seeds N payments and transactions into the database configured by the POSTGRES_* variables, applies the migrations
+and asserts that the plans of the repository queries use index scans, and that the payment totals match a full scan
+of the payments. Point it to a scratch database.
+
+    python -m benchmark.query_plans --rows 1000000 --merchants 1000
+"""
+import argparse
+import datetime
+import json
+from typing import Iterator, List, Tuple
+
+from checkout.gateway import adapters
+from checkout.infrastructure import database
+from checkout.infrastructure.migrations import runner
+
+# Mirrors the statements of the Postgres repositories with representative parameters.
+_QUERIES: List[Tuple[str, str, Tuple]] = [
+    ("get_payments first page",
+     """
+        SELECT merchant_id, payment_id, currency, total_amount, tip, vat,
+        receipt_response_code, receipt_response_message, receipt_approval_code,
+        status, card_masked_pan, payment_date
+        FROM payments WHERE merchant_id = %s ORDER BY payment_date, payment_id LIMIT 101
+     """, ("bench-7",)),
+    ("get_payments next page",
+     """
+        SELECT merchant_id, payment_id, currency, total_amount, tip, vat,
+        receipt_response_code, receipt_response_message, receipt_approval_code,
+        status, card_masked_pan, payment_date
+        FROM payments WHERE merchant_id = %s AND (payment_date, payment_id) > (%s, %s)
+        ORDER BY payment_date, payment_id LIMIT 101
+     """, ("bench-7", 500_000, "bench-500")),
+    ("find_payment",
+     """
+        SELECT merchant_id, payment_id, currency, total_amount, tip, vat,
+        receipt_response_code, receipt_response_message, receipt_approval_code,
+        status, card_masked_pan, payment_date
+        FROM payments WHERE merchant_id = %s AND payment_id = %s
+     """, ("bench-7", "bench-6")),
+    ("update_payment",
+     """
+        UPDATE payments SET receipt_response_code = %s, receipt_response_message = %s,
+        receipt_approval_code = %s, status = %s
+        WHERE merchant_id = %s AND payment_id = %s
+     """, ("00", "Approved", "ABC", "APPROVED", "bench-7", "bench-6")),
+    ("update_transaction",
+     """
+        UPDATE transactions SET response_code = %s, response_message = %s,
+        approval_code = %s, status = %s, attempt = %s
+        WHERE client_id = %s AND transaction_id = %s
+     """, ("00", "Approved", "ABC", "APPROVED", 0, "FLASHY_GW", "bench-6")),
+    ("get_daily_totals",
+     """
+        SELECT day, currency, status, payments, total_amount, tip, vat
+        FROM payment_daily_totals
+        WHERE merchant_id = %s AND day BETWEEN %s AND %s AND payments <> 0
+        ORDER BY day, currency, status
+     """, ("bench-7", datetime.date.min, datetime.date.max)),
+    ("get_payment_days",
+     """
+        SELECT MIN(payment_date), MAX(payment_date) FROM payments WHERE merchant_id = %s
+     """, ("bench-7",)),
+    ("transactions by client reference",
+     """
+        SELECT transaction_id, status FROM transactions WHERE client_id = %s AND client_reference_id = %s
+     """, ("FLASHY_GW", "bench-6")),
+]
+
+
+def seed(cursor, rows: int, merchants: int) -> None:
+    cursor.execute(
+        """
+            INSERT INTO merchants (merchant_id, economical_activity, name, status, remarks)
+            SELECT 'bench-' || m, 'RETAIL', 'Bench ' || m, 'ACTIVE', 'benchmark'
+            FROM generate_series(1, %(merchants)s) m
+            ON CONFLICT (merchant_id) DO NOTHING
+        """, {"merchants": merchants})
+    cursor.execute(
+        """
+            INSERT INTO payments (payment_id, merchant_id, total_amount, tip, vat, currency, card_masked_pan,
+            status, payment_date, receipt_response_code, receipt_response_message, receipt_approval_code)
+            SELECT 'bench-' || n, 'bench-' || (n %% %(merchants)s + 1), 100.00, 0, 0, 'EUR', '444444******4444',
+            'APPROVED', n * 1000, '00', 'Approved or completed successfully', 'ABCDEFG1234'
+            FROM generate_series(1, %(rows)s) n
+            ON CONFLICT (payment_id) DO NOTHING
+        """, {"rows": rows, "merchants": merchants})
+    cursor.execute(
+        """
+            INSERT INTO transactions (transaction_id, client_id, client_reference_id, merchant_id, transaction_type,
+            currency, total_amount, tip, vat, status, transaction_date, card_data_masked_pan, response_code,
+            response_message, approval_code, attempt)
+            SELECT 'bench-' || n, 'FLASHY_GW', 'bench-' || n, 'bench-' || (n %% %(merchants)s + 1), 'CAPTURE',
+            'EUR', 100.00, 0, 0, 'APPROVED', n * 1000, '444444******4444', '00',
+            'Approved or completed successfully', 'ABCDEFG123', 0
+            FROM generate_series(1, %(rows)s) n
+            ON CONFLICT (transaction_id) DO NOTHING
+        """, {"rows": rows, "merchants": merchants})
+    cursor.execute("ANALYZE payments")
+    cursor.execute("ANALYZE transactions")
+    cursor.execute("ANALYZE payment_daily_totals")
+
+
+def payment_totals_match(cursor, merchant_id: str) -> bool:
+    """
+    Voids some payments of the merchant and compares the totals the trigger kept with a full scan of its payments.
+    The caller rolls the voids back.
+    """
+    cursor.execute(
+        """
+            UPDATE payments SET status = 'VOIDED'
+            WHERE payment_id IN (SELECT payment_id FROM payments WHERE merchant_id = %s LIMIT 10)
+        """, (merchant_id,))
+    cursor.execute(
+        """
+            SELECT day, currency, status, payments, total_amount, tip, vat
+            FROM payment_daily_totals WHERE merchant_id = %s AND payments <> 0 ORDER BY day, currency, status
+        """, (merchant_id,))
+    kept = cursor.fetchall()
+    cursor.execute(
+        """
+            SELECT DATE '1970-01-01' + (payment_date / 86400000000000)::INTEGER, currency, status,
+            COUNT(*), SUM(total_amount), SUM(tip), SUM(vat)
+            FROM payments WHERE merchant_id = %s AND status <> 'PENDING'
+            GROUP BY 1, 2, 3 ORDER BY 1, 2, 3
+        """, (merchant_id,))
+    return kept == cursor.fetchall()
+
+
+def _plan_nodes(plan: dict) -> Iterator[dict]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def explain(cursor, sql: str, params: Tuple) -> dict:
+    cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, params)
+    return cursor.fetchone()[0][0]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--merchants", type=int, default=1_000)
+    args = parser.parse_args()
+
+    pool = database.get_pool()
+    runner.migrate(pool=pool)
+    failures = []
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        seed(cursor, rows=args.rows, merchants=args.merchants)
+        conn.commit()
+        for name, sql, params in _QUERIES:
+            result = explain(cursor, sql, params)
+            # EXPLAIN ANALYZE executes the updates, roll them back to keep the seed stable.
+            conn.rollback()
+            nodes = list(_plan_nodes(result["Plan"]))
+            scans = [(node["Node Type"], node.get("Index Name")) for node in nodes if "Scan" in node["Node Type"]]
+            if any(node_type == "Seq Scan" for node_type, _ in scans):
+                failures.append(name)
+            print(json.dumps({"query": name, "execution_ms": result["Execution Time"], "scans": scans}))
+        cursor.close()
+
+    # Payments seeded before the totals existed are counted by rebuilding them.
+    totals = adapters.PostgresPaymentTotalsRepository(pool=pool)
+    first, last = totals.get_payment_days(merchant_id="bench-7")
+    totals.rebuild_daily_totals(merchant_id="bench-7", since=first, until=last)
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        if not payment_totals_match(cursor, merchant_id="bench-7"):
+            failures.append("payment totals")
+        conn.rollback()
+        cursor.close()
+
+    if failures:
+        raise SystemExit(f"Failed: {', '.join(failures)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Replays the payment traffic recorded by ``checkout.gateway.recording.TrafficRecorder`` against the gateway, either
+in-process through ASGI or against a running server:
+
+    CHECKOUT_TRAFFIC_RECORD_FILE=traffic.jsonl uvicorn checkout.gateway.entrypoint:app
+    python -m benchmark.replay traffic.jsonl --rate 200 --duration 30
+    python -m benchmark.replay traffic.jsonl --concurrency 16 --requests 5000 --url http://127.0.0.1:8000
+
+With --rate the load is open loop: request ``i`` is due at ``i / rate`` seconds whatever happened to the previous
+ones, and its latency counts from when it was due, so a stalled server shows up in the tail instead of just slowing
+the generator down (coordinated omission). With --concurrency the load is closed loop, each worker sending its next
+request when the previous one is answered, which measures the throughput the server sustains.
+"""
+import argparse
+import asyncio
+import collections
+import importlib
+import itertools
+import json
+import time
+import urllib.parse
+import uuid
+from typing import Any, Callable, Counter, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from benchmark import asgi
+from benchmark.histogram import LatencyHistogram
+
+
+class RecordedRequest(NamedTuple):
+    offset_seconds: float
+    method: str
+    path: str
+    idempotency_key: Optional[str]
+    body: bytes
+
+
+class Result(NamedTuple):
+    status_code: int
+    body: bytes
+
+
+def load(path: str) -> List[RecordedRequest]:
+    requests = []
+    with open(path) as recording:
+        for line in recording:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            requests.append(RecordedRequest(
+                offset_seconds=float(record.get("offset_seconds", 0.0)),
+                method=record.get("method", "POST"),
+                path=record["path"],
+                idempotency_key=record.get("idempotency_key"),
+                body=json.dumps(record["body"], separators=(",", ":")).encode()))
+    return requests
+
+
+def payment_statuses(result: Result) -> List[str]:
+    """
+    Statuses of the payments in a single or a batch payment response, empty when it is an error.
+    """
+    if result.status_code >= 300:
+        return []
+    try:
+        content = json.loads(result.body)
+    except ValueError:
+        return []
+    payments = content.get("payments", [content]) if isinstance(content, dict) else []
+    return [str(payment.get("status")) for payment in payments if isinstance(payment, dict)]
+
+
+# SENDERS ####
+
+
+class AsgiSender:
+    def __init__(self, app: Callable) -> None:
+        self._app = app
+
+    async def send(self, request: RecordedRequest, headers: List[Tuple[bytes, bytes]]) -> Result:
+        response = await asgi.request(self._app, method=request.method, path=request.path, body=request.body,
+                                      headers=headers)
+        return Result(status_code=response.status_code, body=response.body)
+
+    async def close(self) -> None:
+        pass
+
+
+class HttpSender:
+    """
+    Minimal HTTP/1.1 client over keep-alive connections, enough for the gateway's responses, sized or chunked, and
+    free of the overhead of a general purpose client skewing the measurement.
+    """
+
+    def __init__(self, url: str) -> None:
+        parsed = urllib.parse.urlsplit(url)
+        self._host = parsed.hostname or "127.0.0.1"
+        self._port = parsed.port or 80
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def send(self, request: RecordedRequest, headers: List[Tuple[bytes, bytes]]) -> Result:
+        reader, writer = self._idle.pop() if self._idle else await asyncio.open_connection(self._host, self._port)
+        head = [f"{request.method} {request.path} HTTP/1.1", f"Host: {self._host}:{self._port}",
+                f"Content-Length: {len(request.body)}"]
+        head.extend(f"{name.decode()}: {value.decode()}" for name, value in headers)
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + request.body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            writer.close()
+            raise ConnectionError("connection closed by the server")
+        status_code = int(status_line.split(maxsplit=2)[1])
+        headers_received: Dict[str, str] = {}
+        while (line := await reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers_received[name.strip().lower()] = value.strip().lower()
+        if headers_received.get("transfer-encoding") == "chunked":
+            body = await self._read_chunked(reader)
+        else:
+            body = await reader.readexactly(int(headers_received.get("content-length", "0")))
+        keep_alive = headers_received.get("connection") != "close"
+        if keep_alive:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return Result(status_code=status_code, body=body)
+
+    @staticmethod
+    async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+        chunks = []
+        while size := int((await reader.readline()).split(b";")[0], 16):
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        while await reader.readline() not in (b"\r\n", b""):
+            pass
+        return b"".join(chunks)
+
+    async def close(self) -> None:
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+
+def load_app(target: str) -> Callable:
+    module, _, attribute = target.partition(":")
+    return getattr(importlib.import_module(module), attribute or "app")
+
+
+# REPLAY ####
+
+
+class Report:
+    def __init__(self) -> None:
+        self.histogram = LatencyHistogram()
+        self.status_codes: Counter[int] = collections.Counter()
+        self.payment_statuses: Counter[str] = collections.Counter()
+        self.errors = 0
+        self.sent = 0
+        self.seconds = 0.0
+
+    def add(self, result: Optional[Result], latency_seconds: float) -> None:
+        self.sent += 1
+        self.histogram.record(int(latency_seconds * 1_000_000))
+        if result is None:
+            self.errors += 1
+            return
+        self.status_codes[result.status_code] += 1
+        self.payment_statuses.update(payment_statuses(result))
+
+    def summary(self) -> Dict[str, Any]:
+        payments = sum(self.payment_statuses.values())
+        return {
+            "requests": self.sent,
+            "seconds": round(self.seconds, 3),
+            "requests_per_second": round(self.sent / self.seconds, 1) if self.seconds else 0.0,
+            "errors": self.errors,
+            "status_codes": {str(code): count for code, count in sorted(self.status_codes.items())},
+            "payments": dict(self.payment_statuses),
+            "approved_ratio": round(self.payment_statuses["APPROVED"] / payments, 4) if payments else 0.0,
+            "rejected_ratio": round(self.payment_statuses["REJECTED"] / payments, 4) if payments else 0.0,
+            "pending_ratio": round(self.payment_statuses["PENDING"] / payments, 4) if payments else 0.0,
+            "latency_ms": {f"p{percentile:g}": round(self.histogram.percentile(percentile) / 1000, 3)
+                           for percentile in (50, 90, 99, 99.9, 99.99, 100)},
+        }
+
+
+def _schedule(requests: List[RecordedRequest], total: Optional[int], duration: Optional[float],
+              rate: Optional[float], speed: float) -> Iterator[Tuple[float, RecordedRequest]]:
+    """
+    Yields every request to send with when it is due, relative to the start, cycling through the recording.
+    Without a rate the recorded arrival offsets, scaled by ``speed``, are kept.
+    """
+    first = requests[0].offset_seconds
+    span = (requests[-1].offset_seconds - first) / speed
+    # Laps follow each other at the recording's mean interarrival time.
+    lap_seconds = span + (span / (len(requests) - 1) if len(requests) > 1 else 1 / speed)
+    for index, request in enumerate(itertools.islice(itertools.cycle(requests), total)):
+        if rate:
+            due = index / rate
+        else:
+            lap = index // len(requests)
+            due = lap * lap_seconds + (request.offset_seconds - first) / speed
+        if duration is not None and due >= duration:
+            return
+        yield due, request
+
+
+def _headers(request: RecordedRequest, lap_key: str) -> List[Tuple[bytes, bytes]]:
+    headers = [(b"content-type", b"application/json")]
+    if request.idempotency_key is not None:
+        # Keys are made unique per replay so a second run does not just read the first one's answers back.
+        headers.append((b"idempotency-key", f"{request.idempotency_key}-{lap_key}".encode()))
+    return headers
+
+
+async def _timed(sender: Any, request: RecordedRequest, headers: List[Tuple[bytes, bytes]],
+                 started: float, report: Report) -> None:
+    try:
+        result: Optional[Result] = await sender.send(request, headers)
+    except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+        result = None
+    report.add(result, latency_seconds=time.perf_counter() - started)
+
+
+async def open_loop(sender: Any, schedule: Iterator[Tuple[float, RecordedRequest]], report: Report) -> None:
+    replay_key = uuid.uuid4().hex[:8]
+    pending = set()
+    started = time.perf_counter()
+    for index, (due, request) in enumerate(schedule):
+        delay = started + due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Latency counts from when the request was due, not from when the generator got round to sending it.
+        task = asyncio.create_task(_timed(sender, request, _headers(request, f"{replay_key}-{index}"),
+                                          started=started + due, report=report))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.wait(pending)
+    report.seconds = time.perf_counter() - started
+
+
+async def closed_loop(sender: Any, schedule: Iterator[Tuple[float, RecordedRequest]], report: Report,
+                      concurrency: int) -> None:
+    replay_key = uuid.uuid4().hex[:8]
+    numbered = enumerate(schedule)
+
+    async def worker() -> None:
+        # A shared iterator hands every request to exactly one worker.
+        for index, (_, request) in numbered:
+            await _timed(sender, request, _headers(request, f"{replay_key}-{index}"),
+                         started=time.perf_counter(), report=report)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    report.seconds = time.perf_counter() - started
+
+
+async def replay(requests: List[RecordedRequest], sender: Any, rate: Optional[float] = None,
+                 concurrency: Optional[int] = None, total: Optional[int] = None,
+                 duration: Optional[float] = None, speed: float = 1.0) -> Report:
+    report = Report()
+    if not requests:
+        return report
+    if total is None and duration is None:
+        total = len(requests)
+    try:
+        if concurrency:
+            schedule = _schedule(requests, total=total, duration=None, rate=None, speed=speed)
+            if duration is not None:
+                deadline = time.perf_counter() + duration
+                schedule = itertools.takewhile(lambda _: time.perf_counter() < deadline, schedule)
+            await closed_loop(sender, schedule, report, concurrency=concurrency)
+        else:
+            await open_loop(sender, _schedule(requests, total=total, duration=duration, rate=rate, speed=speed),
+                            report)
+    finally:
+        await sender.close()
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", help="JSON lines file written by the traffic recorder")
+    load_shape = parser.add_mutually_exclusive_group()
+    load_shape.add_argument("--rate", type=float, help="open loop, requests per second")
+    load_shape.add_argument("--concurrency", type=int, help="closed loop, requests in flight")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="without --rate or --concurrency, replays the recorded arrivals this many times faster")
+    parser.add_argument("--requests", type=int, help="requests to send, cycling through the recording")
+    parser.add_argument("--duration", type=float, help="seconds to send requests for")
+    parser.add_argument("--url", help="server to send the requests to, in-process through ASGI when missing")
+    parser.add_argument("--app", default="checkout.gateway.entrypoint:app", help="ASGI application to replay to")
+    parser.add_argument("--hdr-output", help="file to save the percentile distribution to, in HdrHistogram format")
+    args = parser.parse_args()
+
+    sender = HttpSender(args.url) if args.url else AsgiSender(load_app(args.app))
+    report = asyncio.run(replay(load(args.recording), sender, rate=args.rate, concurrency=args.concurrency,
+                                total=args.requests, duration=args.duration, speed=args.speed))
+    print(json.dumps(report.summary()))
+    if args.hdr_output:
+        with open(args.hdr_output, "w") as output:
+            output.write(report.histogram.hdr_output())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Microbenchmarks of the gateway and card processing hot paths, run with the in-memory fakes.
+
+Every benchmark is warmed up, then timed call by call over several rounds, and run once more under tracemalloc for
+its memory. Results are printed as JSON lines and, with --output, saved with the commit they were measured on so
+two runs can be compared:
+
+    python -m benchmark.suite --output before.json
+    python -m benchmark.suite --output after.json --compare before.json
+"""
+import argparse
+import datetime
+import decimal
+import gc
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import pydantic
+
+from benchmark import account_range_lookup, payment_hops
+from checkout.card_processing import adapters as card_processing_adapters
+from checkout.card_processing import services as card_processing_services
+from checkout.gateway import adapters, services
+from checkout.standard_types import card
+from test.checkout.card_processing import faker as card_processing_faker
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # Prepares everything the benchmark needs outside of the measurement and returns the call to measure.
+    setup: Callable[[], Callable[[], object]]
+
+
+def _process_payment() -> Callable[[], object]:
+    request = services.PaymentRequest.model_validate(payment_hops.PAYMENT_REQUEST)
+    repository = payment_hops.InMemoryCardNotPresentPaymentRepository()
+    processor = adapters.FlashyCardNotPresentProvider(
+        router=card_processing_faker.StubApprovedTransactionRouter(),
+        account_range_provider=card_processing_adapters.FlashyAccountRangeProvider(),
+        repo=payment_hops.InMemoryCardNotPresentTransactionRepository())
+    return lambda: services.process_payment(request=request, repository=repository, processor=processor)
+
+
+def _process_sale(router: card_processing_adapters.TransactionRouter) -> Callable[[], Callable[[], object]]:
+    def setup() -> Callable[[], object]:
+        request = card_processing_faker.TransactionFake.fake()
+        account_range_provider = card_processing_adapters.FlashyAccountRangeProvider()
+        repo = payment_hops.InMemoryCardNotPresentTransactionRepository()
+        return lambda: card_processing_services.process_sale(
+            request=request, router=router, account_range_provider=account_range_provider, repo=repo)
+    return setup
+
+
+def _mask_pan() -> Callable[[], object]:
+    return lambda: card.PAN.mask("3333111122223333")
+
+
+def _account_range_lookup() -> Callable[[], object]:
+    rng = random.Random(11)
+    ranges = account_range_lookup.generate_ranges(count=100_000)
+    provider = card_processing_adapters.IntervalAccountRangeProvider(ranges=ranges, cache_size=0)
+    pans = [pydantic.SecretStr(rng.choice(ranges).low.ljust(10, "0") + f"{rng.randint(0, 999999):06d}")
+            for _ in range(1024)]
+    position = 0
+
+    def lookup() -> object:
+        nonlocal position
+        position = (position + 1) % len(pans)
+        return provider.get_pan_info(pan=pans[position])
+    return lookup
+
+
+def _map_request_to_payment() -> Callable[[], object]:
+    request = services.PaymentRequest.model_validate(payment_hops.PAYMENT_REQUEST)
+    return lambda: services._map_request_to_model(payment_id="1", request=request)
+
+
+def _map_payment_to_response() -> Callable[[], object]:
+    request = services.PaymentRequest.model_validate(payment_hops.PAYMENT_REQUEST)
+    payment = services._map_request_to_model(payment_id="1", request=request)
+    payment.approve(response_code="00", response_message="Approved or completed successfully",
+                    approval_code="ABCDEFG1234")
+    return lambda: services._map_payment_to_response(payment).model_dump_json()
+
+
+def _map_payment_to_view() -> Callable[[], object]:
+    request = services.PaymentRequest.model_validate(payment_hops.PAYMENT_REQUEST)
+    payment = services._map_request_to_model(payment_id="1", request=request)
+    return lambda: services.encode_json(adapters.payment_to_view(payment, services.PAYMENT_FIELDS).fields)
+
+
+BENCHMARKS: List[Benchmark] = [
+    Benchmark("gateway.process_payment", _process_payment),
+    Benchmark("card_processing.process_sale.approve",
+              _process_sale(card_processing_faker.StubApprovedTransactionRouter())),
+    Benchmark("card_processing.process_sale.retry",
+              _process_sale(card_processing_faker.StubRetryableApprovedTransactionRouter())),
+    Benchmark("card_processing.process_sale.all_reject",
+              _process_sale(card_processing_faker.StubAllRetryableRejectedTransactionRouter())),
+    Benchmark("card.pan_mask", _mask_pan),
+    Benchmark("card_processing.account_range_lookup", _account_range_lookup),
+    Benchmark("gateway.map_request_to_payment", _map_request_to_payment),
+    Benchmark("gateway.payment_response_json", _map_payment_to_response),
+    Benchmark("gateway.payment_view_json", _map_payment_to_view),
+]
+
+
+def run(benchmark: Benchmark, rounds: int, calls: int, warmup: int) -> Dict[str, object]:
+    call = benchmark.setup()
+    for _ in range(warmup):
+        call()
+
+    latencies: List[int] = []
+    round_ops: List[float] = []
+    gc.collect()
+    for _ in range(rounds):
+        round_started = time.perf_counter_ns()
+        for _ in range(calls):
+            started = time.perf_counter_ns()
+            call()
+            latencies.append(time.perf_counter_ns() - started)
+        round_ops.append(calls / ((time.perf_counter_ns() - round_started) / 1e9))
+
+    # Traced apart from the timings, tracing slows every allocation down.
+    traced_calls = min(calls, 1000)
+    peak_bytes = 0
+    gc.collect()
+    tracemalloc.start()
+    try:
+        blocks_before = sys.getallocatedblocks()
+        for _ in range(traced_calls):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            call()
+            peak_bytes += tracemalloc.get_traced_memory()[1] - current
+        retained_blocks = sys.getallocatedblocks() - blocks_before
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    round_ops.sort()
+    return {
+        "name": benchmark.name,
+        "calls": len(latencies),
+        # Median of the rounds, steadier than the mean when the machine is busy.
+        "ops_per_second": round(round_ops[len(round_ops) // 2], 1),
+        "p50_us": round(latencies[len(latencies) // 2] / 1000, 2),
+        "p99_us": round(latencies[int(len(latencies) * 0.99)] / 1000, 2),
+        "peak_bytes_per_call": round(peak_bytes / traced_calls),
+        "retained_blocks_per_call": round(retained_blocks / traced_calls, 2),
+    }
+
+
+def compare(results: List[Dict[str, object]], baseline: Dict[str, object], threshold: float) -> List[str]:
+    """
+    Prints the change of every benchmark against ``baseline``, returns the ones slower by more than ``threshold``.
+    """
+    previous = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result["name"])
+        if before is None:
+            continue
+        change = result["ops_per_second"] / before["ops_per_second"] - 1
+        print(json.dumps({
+            "name": result["name"],
+            "baseline_commit": baseline.get("commit"),
+            "ops_per_second_change": f"{change:+.1%}",
+            "p99_us": [before["p99_us"], result["p99_us"]],
+            "peak_bytes_per_call": [before["peak_bytes_per_call"], result["peak_bytes_per_call"]],
+        }))
+        if change < -threshold:
+            regressions.append(result["name"])
+    return regressions
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--calls", type=int, default=2000, help="calls per round")
+    parser.add_argument("--warmup", type=int, default=500)
+    parser.add_argument("--filter", default="", help="only run the benchmarks whose name contains it")
+    parser.add_argument("--output", help="file to save the results to, as JSON")
+    parser.add_argument("--compare", help="results saved by a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown in ops/sec above which a benchmark counts as a regression")
+    args = parser.parse_args()
+
+    random.seed(7)
+    decimal.getcontext().prec = 28
+    results = []
+    for benchmark in BENCHMARKS:
+        if args.filter in benchmark.name:
+            result = run(benchmark, rounds=args.rounds, calls=args.calls, warmup=args.warmup)
+            print(json.dumps(result))
+            results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({
+                "commit": _commit(),
+                "measured_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "settings": {"rounds": args.rounds, "calls": args.calls, "warmup": args.warmup},
+                "results": results,
+            }, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, baseline=json.load(baseline_file), threshold=args.threshold)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import array
+import bisect
+import csv
+import heapq
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from typing import Dict, Generic, Iterable, List, Optional, Tuple, TypeVar
+
+PAN_MAX_DIGITS: int = 19
+
+T = TypeVar("T")
+
+
+def low_bound(prefix: str) -> int:
+    """Smallest 19 digits number starting with ``prefix``."""
+    return int(prefix.ljust(PAN_MAX_DIGITS, "0"))
+
+
+def high_bound(prefix: str) -> int:
+    """Biggest 19 digits number starting with ``prefix``."""
+    return int(prefix.ljust(PAN_MAX_DIGITS, "9"))
+
+
+def flatten(ranges: Iterable[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    """
+    Turns possibly nested or overlapping ``(low, high, value)`` ranges into sorted, disjoint segments where every
+    segment keeps the value of the narrowest range covering it (the first one defined on ties).
+    Adjacent segments with the same value are merged.
+    """
+    ranges = sorted((low, high, order, value) for order, (low, high, value) in enumerate(ranges))
+    points = sorted({low for low, _, _, _ in ranges} | {high + 1 for _, high, _, _ in ranges})
+
+    segments: List[Tuple[int, int, int]] = []
+    active: List[Tuple[int, int, int, int]] = []
+    position = 0
+    for start, end in zip(points, points[1:]):
+        while position < len(ranges) and ranges[position][0] == start:
+            low, high, order, value = ranges[position]
+            heapq.heappush(active, (high - low, order, high, value))
+            position += 1
+        while active and active[0][2] < start:
+            heapq.heappop(active)
+        if not active:
+            continue
+        value = active[0][3]
+        if segments and segments[-1][1] == start - 1 and segments[-1][2] == value:
+            segments[-1] = (segments[-1][0], end - 1, value)
+        else:
+            segments.append((start, end - 1, value))
+    return segments
+
+
+class AccountRangeIndex(Generic[T]):
+    """
+    Array backed interval index over account ranges of varying length, resolved with a binary search.
+    Ranges are given as digit prefixes, ``("4444", "4445")`` covers every PAN from 4444000... to 4445999...
+    """
+
+    def __init__(self, ranges: Iterable[Tuple[str, str, T]]) -> None:
+        values: List[T] = []
+        bounds = []
+        self.precision = 0
+        for low, high, value in ranges:
+            if not (low.isdigit() and high.isdigit()) or low_bound(low) > high_bound(high):
+                raise ValueError(f"Invalid account range {low}-{high}")
+            self.precision = max(self.precision, len(low), len(high))
+            bounds.append((low_bound(low), high_bound(high), len(values)))
+            values.append(value)
+
+        segments = flatten(bounds)
+        self._lows = array.array("Q", (low for low, _, _ in segments))
+        self._highs = array.array("Q", (high for _, high, _ in segments))
+        self._values = [values[value] for _, _, value in segments]
+
+    def __len__(self) -> int:
+        return len(self._lows)
+
+    def find(self, pan: str) -> Optional[T]:
+        """
+        :param pan: the PAN, or at least its first ``precision`` digits.
+        """
+        key = low_bound(pan[:PAN_MAX_DIGITS])
+        position = bisect.bisect_right(self._lows, key) - 1
+        if position >= 0 and key <= self._highs[position]:
+            return self._values[position]
+        return None
+
+
+# COMPILED ACCOUNT RANGE FILE #########################################
+# Little endian layout, every section starts aligned to its item size:
+#   header         magic, format version, precision, segment count, string count
+#   lows           segment count x u64
+#   highs          segment count x u64
+#   attributes     segment count x 4 x u32, string ids of country, franchise, category and issuer
+#   strings        string count x (u16 length + utf-8 bytes)
+_MAGIC: bytes = b"FLYRANGE"
+_FORMAT_VERSION: int = 1
+_HEADER = struct.Struct("<8sIIQQ")
+_STRING_LENGTH = struct.Struct("<H")
+_ATTRIBUTES: Tuple[str, ...] = ("country", "franchise", "category", "issuer")
+CSV_COLUMNS: Tuple[str, ...] = ("low", "high") + _ATTRIBUTES
+
+AccountRangeAttributes = Tuple[str, str, str, str]
+
+
+class InvalidAccountRangeFileError(Exception):
+    message: str = "The account range file is not valid"
+
+
+def compile_csv(source: str, destination: str) -> int:
+    """
+    Compiles a CSV with the ``low,high,country,franchise,category,issuer`` columns into the binary account range
+    file read by ``MappedAccountRangeTable``. The destination is replaced atomically.
+    :return: number of segments written.
+    """
+    strings: Dict[str, int] = {}
+    attributes: List[Tuple[int, int, int, int]] = []
+    bounds = []
+    precision = 0
+    with open(source, newline="") as csv_file:
+        for row in csv.DictReader(csv_file):
+            low, high = row["low"].strip(), row["high"].strip()
+            if not (low.isdigit() and high.isdigit()) or low_bound(low) > high_bound(high):
+                raise ValueError(f"Invalid account range {low}-{high}")
+            precision = max(precision, len(low), len(high))
+            bounds.append((low_bound(low), high_bound(high), len(attributes)))
+            attributes.append(tuple(strings.setdefault(row[column].strip(), len(strings))
+                                    for column in _ATTRIBUTES))
+
+    segments = flatten(bounds)
+    directory = os.path.dirname(os.path.abspath(destination))
+    descriptor, temporary = tempfile.mkstemp(dir=directory, prefix=".account-ranges-")
+    try:
+        with os.fdopen(descriptor, "wb") as binary:
+            binary.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, precision, len(segments), len(strings)))
+            binary.write(array.array("Q", (low for low, _, _ in segments)).tobytes())
+            binary.write(array.array("Q", (high for _, high, _ in segments)).tobytes())
+            binary.write(array.array("I", (string_id for _, _, value in segments
+                                           for string_id in attributes[value])).tobytes())
+            for string in strings:
+                encoded = string.encode()
+                binary.write(_STRING_LENGTH.pack(len(encoded)))
+                binary.write(encoded)
+            binary.flush()
+            os.fsync(binary.fileno())
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, destination)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return len(segments)
+
+
+class MappedAccountRangeTable:
+    """
+    Read-only view over a compiled account range file. The file is memory mapped, so every worker process
+    mapping the same file shares its pages instead of holding its own copy of the table.
+    """
+
+    def __init__(self, path: str) -> None:
+        if sys.byteorder != "little":
+            raise InvalidAccountRangeFileError("Account range files can only be mapped on little endian hosts")
+        with open(path, "rb") as binary:
+            self._mapping = mmap.mmap(binary.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mapping) < _HEADER.size:
+            raise InvalidAccountRangeFileError(InvalidAccountRangeFileError.message)
+        magic, version, self.precision, count, string_count = _HEADER.unpack_from(self._mapping, 0)
+        if magic != _MAGIC or version != _FORMAT_VERSION:
+            raise InvalidAccountRangeFileError(InvalidAccountRangeFileError.message)
+
+        lows_offset = _HEADER.size
+        highs_offset = lows_offset + 8 * count
+        attributes_offset = highs_offset + 8 * count
+        strings_offset = attributes_offset + 4 * len(_ATTRIBUTES) * count
+
+        # A file truncated or still being written must not be mapped: its records would be read past the end.
+        size = len(self._mapping)
+        string_bounds = []
+        offset = strings_offset
+        for _ in range(string_count):
+            if offset + _STRING_LENGTH.size > size:
+                break
+            (length,) = _STRING_LENGTH.unpack_from(self._mapping, offset)
+            offset += _STRING_LENGTH.size
+            string_bounds.append((offset, offset + length))
+            offset += length
+        if len(string_bounds) != string_count or offset != size:
+            self._mapping.close()
+            raise InvalidAccountRangeFileError(
+                f"The account range file is {size} bytes long, its header announces {count} ranges "
+                f"and {string_count} strings")
+
+        view = memoryview(self._mapping)
+        self._lows = view[lows_offset:highs_offset].cast("Q")
+        self._highs = view[highs_offset:attributes_offset].cast("Q")
+        self._attributes = view[attributes_offset:strings_offset].cast("I")
+        self._strings: Tuple[str, ...] = tuple(bytes(view[start:end]).decode() for start, end in string_bounds)
+
+    def __len__(self) -> int:
+        return len(self._lows)
+
+    def find(self, pan: str) -> Optional[AccountRangeAttributes]:
+        key = low_bound(pan[:PAN_MAX_DIGITS])
+        position = bisect.bisect_right(self._lows, key) - 1
+        if position < 0 or key > self._highs[position]:
+            return None
+        first = position * len(_ATTRIBUTES)
+        strings = self._strings
+        attributes = self._attributes
+        return (strings[attributes[first]], strings[attributes[first + 1]],
+                strings[attributes[first + 2]], strings[attributes[first + 3]])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        raise SystemExit("usage: python -m checkout.card_processing.account_ranges <ranges.csv> <ranges.bin>")
+    print(f"{compile_csv(sys.argv[1], sys.argv[2])} segments written to {sys.argv[2]}")
@@ -1,17 +1,29 @@
 import abc
+import asyncio
+import collections
+import dataclasses
 import decimal
+import enum
+import functools
+import http.client
+import json
 import os
 import random
 import string
+import threading
+import time
 from collections.abc import Iterator
-from typing import Optional, Dict
+from typing import Callable, Deque, Optional, Dict, Iterable, List, Tuple
 
-import psycopg2
 import pydantic
 
-from checkout.card_processing import model
+from checkout.card_processing import account_ranges, model
+from checkout.infrastructure import database, deadline, http_client, log, metrics
 from checkout.standard_types import card, money, helpers
 
+_LOGGER = log.get_logger(__name__)
+psycopg2 = database.lazy_import("psycopg2")
+
 
 # ACCOUNT RANGES #########################################
 class PANInfo(pydantic.BaseModel):
@@ -51,6 +63,118 @@ class FlashyAccountRangeProvider(AccountRangeProvider):
         return self._ACCOUNT_RANGE_SERVICE.get(pan.get_secret_value()[:10], UnknownPANInfo())
 
 
+class AccountRange(pydantic.BaseModel):
+    low: str
+    high: str
+    pan_info: PANInfo
+
+
+class IntervalAccountRangeProvider(AccountRangeProvider):
+    """
+    Resolves the most specific account range of a PAN in O(log n) over a sorted interval index.
+    Lookups go through an LRU cache keyed by the first digits of the PAN, as many as the longest range bound has,
+    so every PAN sharing that prefix resolves to the same range.
+    """
+    # Beyond this many digits the cache key would start to identify cards, so the cache is turned off.
+    _MAX_CACHED_DIGITS: int = 12
+    _UNKNOWN_PAN_INFO: PANInfo = UnknownPANInfo()
+
+    def __init__(self, ranges: Iterable[AccountRange], cache_size: int = 65536) -> None:
+        self._index = account_ranges.AccountRangeIndex(
+            (account_range.low, account_range.high, account_range.pan_info) for account_range in ranges)
+        if self._index.precision > self._MAX_CACHED_DIGITS:
+            cache_size = 0
+        self._find = functools.lru_cache(maxsize=cache_size)(self._find_uncached)
+
+    def get_pan_info(self, pan: pydantic.SecretStr) -> PANInfo:
+        return self._find(pan.get_secret_value()[:self._index.precision])
+
+    def _find_uncached(self, account_number_prefix: str) -> PANInfo:
+        return self._index.find(account_number_prefix) or self._UNKNOWN_PAN_INFO
+
+
+class _MappedAccountRanges:
+    __slots__ = ("table", "file_identity", "find")
+
+    def __init__(self, table: account_ranges.MappedAccountRangeTable, file_identity: Tuple[int, int, int],
+                 find: Callable[[str], PANInfo]) -> None:
+        self.table = table
+        self.file_identity = file_identity
+        self.find = find
+
+
+class MappedAccountRangeProvider(AccountRangeProvider):
+    """
+    Resolves account ranges from a file compiled with ``python -m checkout.card_processing.account_ranges``.
+    The file is memory mapped read-only and shared by every worker process. Dropping a new version of the file
+    in place (the compiler replaces it atomically) is picked up within ``reload_interval_seconds``, lookups
+    in flight keep using the previous version. A file whose size does not match its header is refused and the
+    previous version stays in use.
+    """
+    _MAX_CACHED_DIGITS: int = 12
+    _UNKNOWN_PAN_INFO: PANInfo = UnknownPANInfo()
+
+    def __init__(self, path: str, reload_interval_seconds: float = 5.0, cache_size: int = 65536) -> None:
+        self._path = path
+        self._reload_interval_seconds = reload_interval_seconds
+        self._cache_size = cache_size
+        self._reload_lock = threading.Lock()
+        self._next_reload_check = time.monotonic() + reload_interval_seconds
+        self._ranges = self._load()
+
+    def get_pan_info(self, pan: pydantic.SecretStr) -> PANInfo:
+        if time.monotonic() >= self._next_reload_check:
+            self.reload_if_changed()
+        ranges = self._ranges
+        return ranges.find(pan.get_secret_value()[:ranges.table.precision])
+
+    def reload_if_changed(self) -> bool:
+        with self._reload_lock:
+            self._next_reload_check = time.monotonic() + self._reload_interval_seconds
+            if self._file_identity() == self._ranges.file_identity:
+                return False
+            try:
+                self._ranges = self._load()
+            except account_ranges.InvalidAccountRangeFileError as error:
+                _LOGGER.error("account_ranges_reload_refused", path=self._path, error=error)
+                return False
+            return True
+
+    def _load(self) -> _MappedAccountRanges:
+        file_identity = self._file_identity()
+        table = account_ranges.MappedAccountRangeTable(self._path)
+        cache_size = self._cache_size if table.precision <= self._MAX_CACHED_DIGITS else 0
+
+        @functools.lru_cache(maxsize=cache_size)
+        def find(account_number_prefix: str) -> PANInfo:
+            attributes = table.find(account_number_prefix)
+            if attributes is None:
+                return self._UNKNOWN_PAN_INFO
+            country, franchise, category, issuer = attributes
+            return PANInfo(country=country, franchise=franchise, category=category, issuer=issuer)
+
+        return _MappedAccountRanges(table=table, file_identity=file_identity, find=find)
+
+    def _file_identity(self) -> Tuple[int, int, int]:
+        stat = os.stat(self._path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+_ACCOUNT_RANGE_PROVIDER: Optional[AccountRangeProvider] = None
+
+
+def get_account_range_provider() -> AccountRangeProvider:
+    """
+    Returns the account range provider of the worker process: the compiled file pointed by
+    ``CHECKOUT_ACCOUNT_RANGES_FILE`` when set, the built-in ranges otherwise.
+    """
+    global _ACCOUNT_RANGE_PROVIDER
+    if _ACCOUNT_RANGE_PROVIDER is None:
+        path = os.environ.get("CHECKOUT_ACCOUNT_RANGES_FILE")
+        _ACCOUNT_RANGE_PROVIDER = MappedAccountRangeProvider(path=path) if path else FlashyAccountRangeProvider()
+    return _ACCOUNT_RANGE_PROVIDER
+
+
 # ACQUIRING PROCESSORS #########################################
 
 class FinancialMessageResult(pydantic.BaseModel):
@@ -68,7 +192,8 @@ class RejectedCapture(FinancialMessageResult):
     is_retryable: bool
 
 
-class CaptureMessage(pydantic.BaseModel):
+@dataclasses.dataclass(frozen=True, slots=True, kw_only=True)
+class CaptureMessage:
     merchant_id: str
     currency: money.Currency
     total_amount: decimal.Decimal
@@ -86,6 +211,30 @@ class AcquiringProcessorProvider(abc.ABC):
     def capture(self, message: CaptureMessage) -> FinancialMessageResult:
         ...
 
+    @property
+    def name(self) -> str:
+        return type(self).__name__
+
+    def is_available(self) -> bool:
+        """
+        Routers skip the providers that are not available.
+        """
+        return True
+
+    def expected_latency_seconds(self) -> float:
+        """
+        How long a capture typically takes. A transaction is not sent to a provider when the request deadline
+        leaves less time than this, captures should give up once ``deadline.remaining()`` runs out.
+        """
+        return 0.0
+
+    async def capture_async(self, message: CaptureMessage) -> FinancialMessageResult:
+        """
+        Non-blocking variant of ``capture``. By default the blocking call runs in a worker thread,
+        providers with a native asynchronous client should override it.
+        """
+        return await asyncio.to_thread(self.capture, message)
+
 
 class CKOAcquiringProcessorProvider(AcquiringProcessorProvider):
     _ACQUIRING_SERVICE: Dict[str, FinancialMessageResult] = {
@@ -107,6 +256,9 @@ class CKOAcquiringProcessorProvider(AcquiringProcessorProvider):
             approval_code="ABCDEFG1234",
         ))
 
+    async def capture_async(self, message: CaptureMessage) -> FinancialMessageResult:
+        return self.capture(message=message)
+
 
 class OTHERAcquiringProcessorProvider(AcquiringProcessorProvider):
     _ACQUIRING_SERVICE: Dict[str, FinancialMessageResult] = {
@@ -128,6 +280,9 @@ class OTHERAcquiringProcessorProvider(AcquiringProcessorProvider):
             approval_code="".join(random.SystemRandom().choices(string.ascii_uppercase + string.digits, k=10)),
         ))
 
+    async def capture_async(self, message: CaptureMessage) -> FinancialMessageResult:
+        return self.capture(message=message)
+
 
 class NoProcessorAvailable(AcquiringProcessorProvider):
 
@@ -151,10 +306,300 @@ class NoProcessorAvailable(AcquiringProcessorProvider):
             is_retryable=False
         )
 
+    async def capture_async(self, message: CaptureMessage) -> FinancialMessageResult:
+        return self.capture(message=message)
+
+
+# HTTP ACQUIRING PROCESSORS #########################################
+class AcquirerUnavailableError(Exception):
+    """The acquirer did not take the capture: it could not be reached or it answered with a 429 or a 5xx."""
+    message: str = "The acquirer could not take the capture"
+
+
+class CaptureOutcomeUnknownError(deadline.DeadlineExceededError):
+    """
+    The capture was sent but not answered in time, the acquirer may still capture it: like a capture cut short by the
+    request deadline, the transaction stays PROCESSING until it is resolved.
+    """
+    message: str = "The acquirer did not answer the capture in time"
+
+
+class HTTPAcquiringProcessorProvider(AcquiringProcessorProvider):
+    """
+    Captures through the HTTP API of an acquirer, ``POST {url}/v1/captures``, on the keep-alive connections of the
+    worker's HTTP pool. A capture waits at most ``timeout_seconds`` for its answer, less when the request deadline
+    is closer.
+    """
+    RETRYABLE_RESPONSE_CODES = frozenset({"19", "91", "96"})
+    # Answers a capture the acquirer refused with a 4xx: the request itself is wrong, sending it elsewhere won't help.
+    REFUSED_RESPONSE_CODE = "30"
+
+    def __init__(self, name: str, url: str, network: card.AcquiringNetwork,
+                 timeout_seconds: float = 5.0,
+                 expected_latency_seconds: float = 0.1,
+                 pool: Optional[http_client.HTTPConnectionPool] = None) -> None:
+        self._name = name
+        self._url = url.rstrip("/") + "/v1/captures"
+        self._network = network
+        self._timeout_seconds = timeout_seconds
+        self._expected_latency_seconds = expected_latency_seconds
+        self._pool = pool
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def expected_latency_seconds(self) -> float:
+        return self._expected_latency_seconds
+
+    def capture(self, message: CaptureMessage) -> FinancialMessageResult:
+        pool = self._pool or http_client.get_pool()
+        try:
+            response = pool.request("POST", self._url, body=self._encode(message),
+                                    headers={"Content-Type": "application/json"}, timeout=self._timeout_seconds)
+        except (http_client.HTTPPoolTimeoutError, http_client.HTTPConnectError) as error:
+            raise AcquirerUnavailableError(f"{AcquirerUnavailableError.message}: {error}") from error
+        except (OSError, http.client.HTTPException) as error:
+            raise CaptureOutcomeUnknownError(CaptureOutcomeUnknownError.message) from error
+        if response.status == 429 or response.status >= 500:
+            raise AcquirerUnavailableError(f"{AcquirerUnavailableError.message}: HTTP {response.status}")
+        if response.status != 200:
+            _LOGGER.warning("capture_refused", acquirer=self._name, status=response.status, body=response.body[:200])
+            return RejectedCapture(network=self._network, response_code=self.REFUSED_RESPONSE_CODE,
+                                   response_message=f"Refused by the acquirer with HTTP {response.status}",
+                                   interchange_rate=decimal.Decimal("0.0"), is_retryable=False)
+        return self._decode(json.loads(response.body))
+
+    @staticmethod
+    def _encode(message: CaptureMessage) -> bytes:
+        return json.dumps({
+            "merchant_id": message.merchant_id,
+            "currency": message.currency.value,
+            "total_amount": str(message.total_amount),
+            "tip": str(message.tip),
+            "vat": str(message.vat),
+            "cardholder_name": message.cardholder_name,
+            "expiration_month": message.expiration_month,
+            "expiration_year": message.expiration_year,
+            "pan": message.pan.get_secret_value(),
+            "cvv": message.cvv.get_secret_value(),
+        }).encode()
+
+    def _decode(self, answer: dict) -> FinancialMessageResult:
+        network = card.AcquiringNetwork(answer.get("network", self._network.value))
+        interchange_rate = decimal.Decimal(str(answer.get("interchange_rate", "0.0")))
+        response_code = answer["response_code"]
+        if response_code == "00":
+            return ApprovedCapture(network=network, response_code=response_code,
+                                   response_message=answer.get("response_message", ""),
+                                   interchange_rate=interchange_rate, approval_code=answer.get("approval_code", ""))
+        return RejectedCapture(network=network, response_code=response_code,
+                               response_message=answer.get("response_message", ""), interchange_rate=interchange_rate,
+                               is_retryable=response_code in self.RETRYABLE_RESPONSE_CODES)
+
+
+def _acquirer_from_env(name: str, network: card.AcquiringNetwork,
+                       in_memory: AcquiringProcessorProvider) -> AcquiringProcessorProvider:
+    """
+    The HTTP acquirer at ``CHECKOUT_<NAME>_ACQUIRER_URL`` when it is set, waiting up to
+    ``CHECKOUT_<NAME>_ACQUIRER_TIMEOUT_SECONDS`` for a capture, the in-memory one otherwise.
+    """
+    url = os.environ.get(f"CHECKOUT_{name}_ACQUIRER_URL")
+    if not url:
+        return in_memory
+    return HTTPAcquiringProcessorProvider(
+        name=name, url=url, network=network,
+        timeout_seconds=float(os.environ.get(f"CHECKOUT_{name}_ACQUIRER_TIMEOUT_SECONDS", "5")))
+
+
+# CIRCUIT BREAKER #########################################
+class CircuitState(enum.Enum):
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+
+class CircuitBreakerSettings(pydantic.BaseModel):
+    window_size: int = 50
+    minimum_calls: int = 10
+    failure_rate_threshold: float = 0.5
+    slow_call_seconds: float = 2.0
+    slow_call_rate_threshold: float = 0.8
+    open_seconds: float = 30.0
+    half_open_probes: int = 3
+
+
+class CircuitBreakerStats(pydantic.BaseModel):
+    name: str
+    state: CircuitState
+    failure_rate: float
+    slow_call_rate: float
+    rejected_calls: int
+    transitions: Dict[str, int]
+
+
+class CircuitBreakerAcquiringProcessorProvider(AcquiringProcessorProvider):
+    """
+    Stops calling an acquirer whose last ``window_size`` calls failed or were slow too often.
+
+    The breaker opens once ``failure_rate_threshold`` or ``slow_call_rate_threshold`` is reached over at least
+    ``minimum_calls`` calls; while open it is not available and a capture is answered at once with a retryable
+    rejection, so the transaction moves to the next acquirer. An acquirer that could not take a capture counts as a
+    failure and is answered the same way. After ``open_seconds`` it lets ``half_open_probes``
+    calls through, which close it again when they stay under the thresholds and reopen it otherwise.
+    """
+
+    def __init__(self, provider: AcquiringProcessorProvider,
+                 settings: Optional[CircuitBreakerSettings] = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self._provider = provider
+        self._settings = settings or CircuitBreakerSettings()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CircuitState.CLOSED
+        self._opened_at = 0.0
+        self._outcomes: Deque[Tuple[bool, bool]] = collections.deque()
+        self._failures = 0
+        self._slow_calls = 0
+        self._probes_started = 0
+        self._rejected_calls = 0
+        self._transitions: Dict[str, int] = {}
+
+    @property
+    def name(self) -> str:
+        return self._provider.name
+
+    def expected_latency_seconds(self) -> float:
+        return self._provider.expected_latency_seconds()
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            self._expire_open_state()
+            return self._state
+
+    def is_available(self) -> bool:
+        with self._lock:
+            self._expire_open_state()
+            return self._state == CircuitState.CLOSED or (
+                    self._state == CircuitState.HALF_OPEN and self._probes_started < self._settings.half_open_probes)
+
+    def capture(self, message: CaptureMessage) -> FinancialMessageResult:
+        if not self._permit():
+            return self._unavailable_rejection()
+        started = self._clock()
+        try:
+            result = self._provider.capture(message=message)
+        except AcquirerUnavailableError:
+            self._record(failed=True, seconds=self._clock() - started)
+            return self._unavailable_rejection()
+        except BaseException as error:
+            self._record_failure(error, started=started)
+            raise
+        self._record(failed=False, seconds=self._clock() - started)
+        return result
+
+    async def capture_async(self, message: CaptureMessage) -> FinancialMessageResult:
+        if not self._permit():
+            return self._unavailable_rejection()
+        started = self._clock()
+        try:
+            result = await self._provider.capture_async(message=message)
+        except AcquirerUnavailableError:
+            self._record(failed=True, seconds=self._clock() - started)
+            return self._unavailable_rejection()
+        except BaseException as error:
+            self._record_failure(error, started=started)
+            raise
+        self._record(failed=False, seconds=self._clock() - started)
+        return result
+
+    def stats(self) -> CircuitBreakerStats:
+        with self._lock:
+            self._expire_open_state()
+            calls = len(self._outcomes) or 1
+            return CircuitBreakerStats(
+                name=self.name,
+                state=self._state,
+                failure_rate=self._failures / calls,
+                slow_call_rate=self._slow_calls / calls,
+                rejected_calls=self._rejected_calls,
+                transitions=dict(self._transitions),
+            )
+
+    def _permit(self) -> bool:
+        with self._lock:
+            self._expire_open_state()
+            if self._state == CircuitState.CLOSED:
+                return True
+            if self._state == CircuitState.HALF_OPEN and self._probes_started < self._settings.half_open_probes:
+                self._probes_started += 1
+                return True
+            self._rejected_calls += 1
+            return False
+
+    def _record(self, failed: bool, seconds: float) -> None:
+        slow = seconds >= self._settings.slow_call_seconds
+        with self._lock:
+            self._outcomes.append((failed, slow))
+            self._failures += failed
+            self._slow_calls += slow
+            window_size = (self._settings.half_open_probes if self._state == CircuitState.HALF_OPEN
+                           else self._settings.window_size)
+            while len(self._outcomes) > window_size:
+                old_failed, old_slow = self._outcomes.popleft()
+                self._failures -= old_failed
+                self._slow_calls -= old_slow
+
+            if self._state == CircuitState.HALF_OPEN:
+                if len(self._outcomes) >= self._settings.half_open_probes:
+                    self._transition(CircuitState.OPEN if self._over_thresholds() else CircuitState.CLOSED)
+            elif self._state == CircuitState.CLOSED:
+                if len(self._outcomes) >= self._settings.minimum_calls and self._over_thresholds():
+                    self._transition(CircuitState.OPEN)
+
+    def _record_failure(self, error: BaseException, started: float) -> None:
+        # Every permitted call is recorded, whatever it raised, or a half-open probe would never be given back.
+        # A capture cancelled by the payment deadline did not answer in time: a slow failure.
+        seconds = self._clock() - started
+        if isinstance(error, asyncio.CancelledError):
+            seconds = max(seconds, self._settings.slow_call_seconds)
+        self._record(failed=True, seconds=seconds)
+
+    def _over_thresholds(self) -> bool:
+        calls = len(self._outcomes)
+        return (self._failures / calls >= self._settings.failure_rate_threshold
+                or self._slow_calls / calls >= self._settings.slow_call_rate_threshold)
+
+    def _expire_open_state(self) -> None:
+        if self._state == CircuitState.OPEN and self._clock() - self._opened_at >= self._settings.open_seconds:
+            self._transition(CircuitState.HALF_OPEN)
+
+    def _transition(self, state: CircuitState) -> None:
+        transition = f"{self._state.value}->{state.value}"
+        self._transitions[transition] = self._transitions.get(transition, 0) + 1
+        self._state = state
+        self._outcomes.clear()
+        self._failures = 0
+        self._slow_calls = 0
+        self._probes_started = 0
+        if state == CircuitState.OPEN:
+            self._opened_at = self._clock()
+
+    def _unavailable_rejection(self) -> FinancialMessageResult:
+        return RejectedCapture(
+            network=card.AcquiringNetwork.NONE,
+            response_code="F98",
+            response_message=f"{self.name} is unavailable",
+            interchange_rate=decimal.Decimal("0.0"),
+            is_retryable=True
+        )
+
 
 # ROUTER #########################################
 class TransactionPackage(pydantic.BaseModel):
     franchise: card.Franchise
+    country: str = UnknownPANInfo().country
 
 
 class TransactionRouter(abc.ABC):
@@ -179,6 +624,181 @@ class FlashyTransactionRouter(TransactionRouter):
             yield OTHERAcquiringProcessorProvider()
 
 
+class AcquirerStats:
+    """
+    Exponentially weighted moving averages of the captures of an acquirer for a franchise and country.
+    Updates are not synchronized: under contention an update may overwrite a concurrent one, which only costs
+    a sample and keeps the capture path free of locks.
+    """
+    __slots__ = ("latency_seconds", "approval_rate", "retryable_rate", "samples")
+
+    def __init__(self, latency_seconds: float, approval_rate: float, retryable_rate: float) -> None:
+        self.latency_seconds = latency_seconds
+        self.approval_rate = approval_rate
+        self.retryable_rate = retryable_rate
+        self.samples = 0
+
+    def record(self, alpha: float, latency_seconds: float, approved: bool, retryable: bool) -> None:
+        self.latency_seconds += alpha * (latency_seconds - self.latency_seconds)
+        self.approval_rate += alpha * (approved - self.approval_rate)
+        self.retryable_rate += alpha * (retryable - self.retryable_rate)
+        self.samples += 1
+
+    def expected_cost(self) -> float:
+        """
+        Expected seconds to get a final answer from the acquirer, a retryable rejection means starting over with
+        the next one, weighted down by the approval rate.
+        """
+        return self.latency_seconds / (max(1.0 - self.retryable_rate, 0.05) * max(self.approval_rate, 0.05))
+
+
+class _MeasuredAcquiringProcessorProvider(AcquiringProcessorProvider):
+    def __init__(self, provider: AcquiringProcessorProvider, stats: AcquirerStats, alpha: float) -> None:
+        self._provider = provider
+        self._stats = stats
+        self._alpha = alpha
+
+    @property
+    def name(self) -> str:
+        return self._provider.name
+
+    def is_available(self) -> bool:
+        return self._provider.is_available()
+
+    def expected_latency_seconds(self) -> float:
+        return self._stats.latency_seconds
+
+    def capture(self, message: CaptureMessage) -> FinancialMessageResult:
+        started = time.perf_counter()
+        try:
+            result = self._provider.capture(message=message)
+        except BaseException:
+            # Cancelled by the payment deadline included, the time it took still counts.
+            self._record(started=started, result=None)
+            raise
+        self._record(started=started, result=result)
+        return result
+
+    async def capture_async(self, message: CaptureMessage) -> FinancialMessageResult:
+        started = time.perf_counter()
+        try:
+            result = await self._provider.capture_async(message=message)
+        except BaseException:
+            # Cancelled by the payment deadline included, the time it took still counts.
+            self._record(started=started, result=None)
+            raise
+        self._record(started=started, result=result)
+        return result
+
+    def _record(self, started: float, result: Optional[FinancialMessageResult]) -> None:
+        # A failed call counts as a retryable rejection: the transaction has to go somewhere else.
+        self._stats.record(alpha=self._alpha, latency_seconds=time.perf_counter() - started,
+                           approved=isinstance(result, ApprovedCapture),
+                           retryable=result is None or (isinstance(result, RejectedCapture) and result.is_retryable))
+
+
+class AdaptiveTransactionRouter(TransactionRouter):
+    """
+    Routes a transaction to the acquirers eligible for its franchise, cheapest expected cost first.
+    Every capture of a yielded provider updates the stats of that acquirer for the franchise and country of the
+    transaction; acquirers without samples start from optimistic priors so they get tried. A small share of the
+    transactions starts with a random eligible acquirer to keep the stats of the others fresh.
+    """
+    def __init__(self,
+                 routes: Optional[Dict[card.Franchise, Tuple[AcquiringProcessorProvider, ...]]] = None,
+                 default_route: Optional[Tuple[AcquiringProcessorProvider, ...]] = None,
+                 alpha: float = 0.1,
+                 exploration_rate: float = 0.02,
+                 prior_latency_seconds: float = 0.1) -> None:
+        if routes is None or default_route is None:
+            cko = CircuitBreakerAcquiringProcessorProvider(provider=_acquirer_from_env(
+                "CKO", card.AcquiringNetwork.CKO, in_memory=CKOAcquiringProcessorProvider()))
+            other = CircuitBreakerAcquiringProcessorProvider(provider=_acquirer_from_env(
+                "OTHER", card.AcquiringNetwork.CKO, in_memory=OTHERAcquiringProcessorProvider()))
+            routes = {card.Franchise.MASTER_CARD: (cko,), card.Franchise.VISA: (other,)} if routes is None else routes
+            default_route = (cko, other) if default_route is None else default_route
+        self._routes = routes
+        self._default_route = default_route
+        self._alpha = alpha
+        self._exploration_rate = exploration_rate
+        self._prior_latency_seconds = prior_latency_seconds
+        self._stats: Dict[Tuple[str, card.Franchise, str], AcquirerStats] = {}
+        self._random = random.Random()
+
+    def get_acquiring_processing_providers(self, package: TransactionPackage) -> Iterator[AcquiringProcessorProvider]:
+        route = self._routes.get(package.franchise, self._default_route)
+        ranked = sorted(((self._stats_of(provider, package), provider) for provider in route),
+                        key=lambda ranked_provider: ranked_provider[0].expected_cost())
+        if len(ranked) > 1 and self._random.random() < self._exploration_rate:
+            ranked.insert(0, ranked.pop(self._random.randrange(1, len(ranked))))
+        for stats, provider in ranked:
+            # Checked when the transaction gets to it, a breaker opened by a previous attempt is skipped.
+            if provider.is_available():
+                yield _MeasuredAcquiringProcessorProvider(provider=provider, stats=stats, alpha=self._alpha)
+
+    def stats(self) -> Dict[Tuple[str, card.Franchise, str], AcquirerStats]:
+        return dict(self._stats)
+
+    def circuit_breakers(self) -> List[CircuitBreakerAcquiringProcessorProvider]:
+        providers = {id(provider): provider for route in (*self._routes.values(), self._default_route)
+                     for provider in route}
+        return [provider for provider in providers.values()
+                if isinstance(provider, CircuitBreakerAcquiringProcessorProvider)]
+
+    def _stats_of(self, provider: AcquiringProcessorProvider, package: TransactionPackage) -> AcquirerStats:
+        key = (provider.name, package.franchise, package.country)
+        stats = self._stats.get(key)
+        if stats is None:
+            # setdefault is atomic, concurrent first captures end up sharing the same stats.
+            stats = self._stats.setdefault(key, AcquirerStats(
+                latency_seconds=self._prior_latency_seconds, approval_rate=1.0, retryable_rate=0.0))
+        return stats
+
+
+_TRANSACTION_ROUTER: Optional[TransactionRouter] = None
+
+
+def get_transaction_router() -> TransactionRouter:
+    """
+    Returns the router of the worker process, its acquirer stats are shared by every transaction.
+    """
+    global _TRANSACTION_ROUTER
+    if _TRANSACTION_ROUTER is None:
+        _TRANSACTION_ROUTER = AdaptiveTransactionRouter()
+    return _TRANSACTION_ROUTER
+
+
+def _collect_router() -> Iterable[metrics.Sample]:
+    router = _TRANSACTION_ROUTER
+    if not isinstance(router, AdaptiveTransactionRouter):
+        return
+    for (acquirer, franchise, country), stats in router.stats().items():
+        labels = (("acquirer", acquirer), ("franchise", franchise.value), ("country", country))
+        yield metrics.Sample(name="checkout_acquirer_expected_latency_seconds",
+                             help="Moving average of the capture latency the router ranks acquirers by.",
+                             type="gauge", labels=labels, value=stats.latency_seconds)
+        yield metrics.Sample(name="checkout_acquirer_approval_rate", help="Moving average of the approval rate.",
+                             type="gauge", labels=labels, value=stats.approval_rate)
+    for breaker in router.circuit_breakers():
+        stats = breaker.stats()
+        for state in CircuitState:
+            yield metrics.Sample(name="checkout_circuit_breaker_state", help="1 for the current state of a breaker.",
+                                 type="gauge", labels=(("acquirer", stats.name), ("state", state.value)),
+                                 value=float(stats.state == state))
+        for transition, count in stats.transitions.items():
+            from_state, to_state = transition.split("->")
+            yield metrics.Sample(name="checkout_circuit_breaker_transitions_total",
+                                 help="Changes of state of a breaker, a breaker flapping keeps adding to them.",
+                                 type="counter", labels=(("acquirer", stats.name), ("from_state", from_state),
+                                                         ("to_state", to_state)), value=count)
+        yield metrics.Sample(name="checkout_circuit_breaker_rejected_calls_total",
+                             help="Captures answered by an open breaker.", type="counter",
+                             labels=(("acquirer", stats.name),), value=stats.rejected_calls)
+
+
+metrics.register_collector(_collect_router)
+
+
 # CARD NOT PRESENT TRANSACTION REPOSITORY #########################################
 class CardNotPresentTransactionRepository(abc.ABC):
 
@@ -198,134 +818,159 @@ class CardNotPresentTransactionRepository(abc.ABC):
     def update_transaction(self, transaction: model.CardNotPresentTransaction) -> model.CardNotPresentTransaction:
         ...
 
+    async def find_by_id_async(self, transaction_id: str) -> Optional[model.CardNotPresentTransaction]:
+        return await asyncio.to_thread(self.find_by_id, transaction_id)
+
+    async def register_transaction_async(
+            self, transaction: model.CardNotPresentTransaction) -> model.CardNotPresentTransaction:
+        return await asyncio.to_thread(self.register_transaction, transaction)
+
+    async def update_transaction_async(
+            self, transaction: model.CardNotPresentTransaction) -> model.CardNotPresentTransaction:
+        return await asyncio.to_thread(self.update_transaction, transaction)
+
+
+TRANSACTIONS_WRITER = database.TableWriter(
+    table="transactions",
+    columns=("transaction_id", "client_id", "client_reference_id", "merchant_id",
+             "transaction_type", "currency", "total_amount", "tip", "vat",
+             "card_data_cardholder_name", "card_data_franchise", "card_data_category", "card_data_country",
+             "card_data_masked_pan", "card_data_expiration_month", "card_data_expiration_year",
+             "status", "response_code", "response_message", "approval_code", "transaction_date", "attempt"),
+    key_columns=("transaction_id",),
+    update_columns=("response_code", "response_message", "approval_code", "status", "attempt"),
+)
+
 
 class PostgresCardNotPresentTransactionRepository(CardNotPresentTransactionRepository):
+    """
+    When created with a unit of work, ``register_transaction`` and ``update_transaction`` stage the transaction
+    in it and nothing is written until the unit of work is flushed.
+    """
+
+    def __init__(self, pool: Optional[database.ConnectionPool] = None,
+                 unit_of_work: Optional[database.PostgresUnitOfWork] = None) -> None:
+        self._pool = pool or database.get_pool()
+        self._unit_of_work = unit_of_work
+
     def generate_id(self) -> str:
         return helpers.IDGenerator.hex_uuid()
 
+    @database.timed_repository("transactions", "find_by_id")
     def find_by_id(self, transaction_id: str) -> Optional[model.CardNotPresentTransaction]:
         pass
 
+    @database.timed_repository("transactions", "register_transaction")
     def register_transaction(self, transaction: model.CardNotPresentTransaction) -> model.CardNotPresentTransaction:
-        conn = None
-        print("transaction.transaction_id ", transaction.transaction_id)
-        print("transaction.client_id ", transaction.client_id)
-        print("transaction.client_reference_id ", transaction.client_reference_id)
-        print("transaction.merchant_id ", transaction.merchant_id)
-        print("transaction.transaction_type.value ", transaction.transaction_type.value)
-        print("transaction.currency.value ", transaction.currency.value)
-        print("transaction.total_amount ", transaction.total_amount)
-        print("transaction.tip ", transaction.tip)
-        print("transaction.vat ", transaction.vat)
-        print("transaction.card_data.cardholder_name ", transaction.card_data.cardholder_name)
-        print("transaction.card_data.franchise ", transaction.card_data.franchise)
-        print("transaction.card_data.category ", transaction.card_data.category)
-        print("transaction.card_data.country ", transaction.card_data.country)
-        print("transaction.card_data.masked_pan ", transaction.card_data.masked_pan)
-        print("transaction.card_data.expiration_month ", transaction.card_data.expiration_month)
-        print("transaction.card_data.expiration_year ", transaction.card_data.expiration_year)
-        print("transaction.status.value ", transaction.status.value)
-        print("transaction.network_response.response_code ", transaction.network_response.response_code)
-        print("transaction.network_response.response_message ", transaction.network_response.response_message)
-        print("transaction.network_response.approval_code ", transaction.network_response.approval_code)
-        print("transaction.transaction_date ", transaction.transaction_date)
-        print("transaction.network_response.attempt ", transaction.network_response.attempt)
-        try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                    INSERT INTO transactions (
-                    transaction_id,
-                    client_id,
-                    client_reference_id,
-                    merchant_id,
-                    transaction_type,
-                    currency,
-                    total_amount,
-                    tip,
-                    vat,
-                    card_data_cardholder_name,
-                    card_data_franchise,
-                    card_data_category,
-                    card_data_country,
-                    card_data_masked_pan,
-                    card_data_expiration_month,
-                    card_data_expiration_year,
-                    status,
-                    response_code,
-                    response_message,
-                    approval_code,
-                    transaction_date,
-                    attempt)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (
-                    transaction.transaction_id,
-                    transaction.client_id,
-                    transaction.client_reference_id,
-                    transaction.merchant_id,
-                    transaction.transaction_type.value,
-                    transaction.currency.value,
-                    transaction.total_amount,
-                    transaction.tip,
-                    transaction.vat,
-                    transaction.card_data.cardholder_name,
-                    transaction.card_data.franchise,
-                    transaction.card_data.category,
-                    transaction.card_data.country,
-                    transaction.card_data.masked_pan,
-                    transaction.card_data.expiration_month,
-                    transaction.card_data.expiration_year,
-                    transaction.status.value,
-                    transaction.network_response.response_code,
-                    transaction.network_response.response_message,
-                    transaction.network_response.approval_code,
-                    transaction.transaction_date,
-                    transaction.network_response.attempt,
-                ))
-            conn.commit()
-            cursor.close()
+        if _LOGGER.enabled(log.DEBUG):
+            _LOGGER.debug("transaction_registered", transaction_id=transaction.transaction_id,
+                          merchant_id=transaction.merchant_id, status=transaction.status,
+                          attempt=transaction.network_response.attempt, franchise=transaction.card_data.franchise,
+                          masked_pan=transaction.card_data.masked_pan)
+        if self._unit_of_work is not None:
+            self._unit_of_work.stage(TRANSACTIONS_WRITER, self._transaction_to_row(transaction))
             return transaction
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                        INSERT INTO transactions (
+                        transaction_id,
+                        client_id,
+                        client_reference_id,
+                        merchant_id,
+                        transaction_type,
+                        currency,
+                        total_amount,
+                        tip,
+                        vat,
+                        card_data_cardholder_name,
+                        card_data_franchise,
+                        card_data_category,
+                        card_data_country,
+                        card_data_masked_pan,
+                        card_data_expiration_month,
+                        card_data_expiration_year,
+                        status,
+                        response_code,
+                        response_message,
+                        approval_code,
+                        transaction_date,
+                        attempt)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    """,
+                    self._transaction_to_row(transaction))
+                conn.commit()
+                cursor.close()
+                return transaction
         except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
+            _LOGGER.error("query_failed", repository="transactions", method="register_transaction", error=error)
             raise
-        finally:
-            if conn is not None:
-                conn.close()
 
+    @database.timed_repository("transactions", "update_transaction")
     def update_transaction(self, transaction: model.CardNotPresentTransaction) -> model.CardNotPresentTransaction:
-        conn = None
-        try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                    UPDATE transactions SET 
-                    response_code = %s, response_message = %s, 
-                    approval_code = %s, status = %s, 
-                    attempt = %s
-                    WHERE client_id = %s AND transaction_id = %s
-                """,
-                (transaction.network_response.response_code, transaction.network_response.response_message,
-                 transaction.network_response.approval_code, transaction.status.value,
-                 transaction.network_response.attempt,
-                 transaction.client_id, transaction.transaction_id))
-            conn.commit()
-            cursor.close()
-
+        if self._unit_of_work is not None:
+            self._unit_of_work.stage(TRANSACTIONS_WRITER, self._transaction_to_row(transaction))
             return transaction
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                        UPDATE transactions SET 
+                        response_code = %s, response_message = %s, 
+                        approval_code = %s, status = %s, 
+                        attempt = %s
+                        WHERE client_id = %s AND transaction_id = %s
+                    """,
+                    (transaction.network_response.response_code, transaction.network_response.response_message,
+                     transaction.network_response.approval_code, transaction.status.value,
+                     transaction.network_response.attempt,
+                     transaction.client_id, transaction.transaction_id))
+                conn.commit()
+                cursor.close()
+
+                return transaction
         except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
+            _LOGGER.error("query_failed", repository="transactions", method="update_transaction", error=error)
             raise
-        finally:
-            if conn is not None:
-                conn.close()
-
-    def _get_connection(self):
-        return psycopg2.connect(
-            host=os.environ.get("POSTGRES_HOST"),
-            dbname=os.environ.get("POSTGRES_DATABASE"),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
+
+    async def register_transaction_async(
+            self, transaction: model.CardNotPresentTransaction) -> model.CardNotPresentTransaction:
+        if self._unit_of_work is not None:
+            return self.register_transaction(transaction)
+        return await super().register_transaction_async(transaction)
+
+    async def update_transaction_async(
+            self, transaction: model.CardNotPresentTransaction) -> model.CardNotPresentTransaction:
+        if self._unit_of_work is not None:
+            return self.update_transaction(transaction)
+        return await super().update_transaction_async(transaction)
+
+    @staticmethod
+    def _transaction_to_row(transaction: model.CardNotPresentTransaction) -> tuple:
+        return (
+            transaction.transaction_id,
+            transaction.client_id,
+            transaction.client_reference_id,
+            transaction.merchant_id,
+            transaction.transaction_type.value,
+            transaction.currency.value,
+            transaction.total_amount,
+            transaction.tip,
+            transaction.vat,
+            transaction.card_data.cardholder_name,
+            transaction.card_data.franchise,
+            transaction.card_data.category,
+            transaction.card_data.country,
+            transaction.card_data.masked_pan,
+            transaction.card_data.expiration_month,
+            transaction.card_data.expiration_year,
+            transaction.status.value,
+            transaction.network_response.response_code,
+            transaction.network_response.response_message,
+            transaction.network_response.approval_code,
+            transaction.transaction_date,
+            transaction.network_response.attempt,
         )
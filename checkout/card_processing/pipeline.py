@@ -0,0 +1,185 @@
+import abc
+import asyncio
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+# Returned by a stage to end the pipeline before its last stage.
+END: str = "END"
+
+# Called with a stage, the ``time.perf_counter`` and traced memory before it ran and whether it raised.
+Recorder = Callable[["Stage", float, int, bool], None]
+
+
+class Stage(abc.ABC):
+    """
+    Step of a ``Pipeline`` working on a shared context. ``run`` returns the name of the stage to go to next,
+    ``None`` to go on with the following stage or ``END`` to stop.
+    """
+    name: str
+
+    @abc.abstractmethod
+    def run(self, context: Any) -> Optional[str]:
+        ...
+
+    async def run_async(self, context: Any) -> Optional[str]:
+        """
+        Non-blocking variant of ``run``. By default ``run`` is called inline, stages doing I/O should override it.
+        """
+        return self.run(context)
+
+
+class ConcurrentStage(Stage):
+    """
+    Runs independent stages together: one after the other in ``run`` and overlapping in ``run_async``, where the
+    stages without a ``run_async`` of their own run in worker threads so their blocking ``run`` overlaps too.
+    The transitions of the grouped stages are ignored. A pipeline passes its ``record``, so every grouped stage is
+    measured under its own name.
+    """
+
+    def __init__(self, name: str, stages: Sequence[Stage]) -> None:
+        self.name = name
+        self.stages = tuple(stages)
+
+    def run(self, context: Any, record: Optional[Recorder] = None) -> Optional[str]:
+        for stage in self.stages:
+            _run_recorded(stage, context, record)
+        return None
+
+    async def run_async(self, context: Any, record: Optional[Recorder] = None) -> Optional[str]:
+        await asyncio.gather(*(
+            _run_recorded_async(stage, context, record) if type(stage).run_async is not Stage.run_async
+            else asyncio.to_thread(_run_recorded, stage, context, record)
+            for stage in self.stages))
+        return None
+
+
+def _run_recorded(stage: Stage, context: Any, record: Optional[Recorder]) -> Optional[str]:
+    if record is None:
+        return stage.run(context)
+    started, allocated = time.perf_counter(), _traced_memory()
+    failed = True
+    try:
+        transition = stage.run(context)
+        failed = False
+        return transition
+    finally:
+        record(stage, started, allocated, failed)
+
+
+async def _run_recorded_async(stage: Stage, context: Any, record: Optional[Recorder]) -> Optional[str]:
+    if record is None:
+        return await stage.run_async(context)
+    started, allocated = time.perf_counter(), _traced_memory()
+    failed = True
+    try:
+        transition = await stage.run_async(context)
+        failed = False
+        return transition
+    finally:
+        record(stage, started, allocated, failed)
+
+
+class StageStats:
+    """
+    Runs, failures and time spent in a stage. While ``tracemalloc`` traces, ``allocated_bytes`` adds up the
+    memory each run left allocated. Updated without locking, concurrent runs may make them slightly off.
+    """
+    __slots__ = ("calls", "errors", "seconds", "allocated_bytes")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.allocated_bytes = 0
+
+    def record(self, seconds: float, allocated_bytes: int, failed: bool) -> None:
+        self.calls += 1
+        self.errors += failed
+        self.seconds += seconds
+        self.allocated_bytes += allocated_bytes
+
+
+class Pipeline:
+    """
+    Iterative state machine over named stages, run in order unless a stage jumps to another one.
+    """
+
+    def __init__(self, stages: Iterable[Stage]) -> None:
+        self._stages: List[Stage] = list(stages)
+        self._positions: Dict[str, int] = {stage.name: position for position, stage in enumerate(self._stages)}
+        names = [name for stage in self._stages for name in _measured_names(stage)]
+        if len(self._positions) != len(self._stages) or len(set(names)) != len(names):
+            raise ValueError("stage names must be unique")
+        self._stats: Dict[str, StageStats] = {name: StageStats() for name in names}
+
+    @property
+    def stage_names(self) -> List[str]:
+        return [stage.name for stage in self._stages]
+
+    def insert_before(self, name: str, stage: Stage) -> "Pipeline":
+        """
+        Returns a new pipeline with ``stage`` running right before the stage called ``name``.
+        """
+        stages = list(self._stages)
+        stages.insert(self._positions[name], stage)
+        return Pipeline(stages=stages)
+
+    def insert_after(self, name: str, stage: Stage) -> "Pipeline":
+        stages = list(self._stages)
+        stages.insert(self._positions[name] + 1, stage)
+        return Pipeline(stages=stages)
+
+    def run(self, context: Any) -> Any:
+        position = 0
+        while position < len(self._stages):
+            stage = self._stages[position]
+            started, allocated = time.perf_counter(), _traced_memory()
+            failed = True
+            try:
+                transition = (stage.run(context, record=self._record) if isinstance(stage, ConcurrentStage)
+                              else stage.run(context))
+                failed = False
+            finally:
+                self._record(stage=stage, started=started, allocated=allocated, failed=failed)
+            position = self._next_position(position=position, transition=transition)
+        return context
+
+    async def run_async(self, context: Any) -> Any:
+        position = 0
+        while position < len(self._stages):
+            stage = self._stages[position]
+            started, allocated = time.perf_counter(), _traced_memory()
+            failed = True
+            try:
+                transition = await (stage.run_async(context, record=self._record) if isinstance(stage, ConcurrentStage)
+                                    else stage.run_async(context))
+                failed = False
+            finally:
+                self._record(stage=stage, started=started, allocated=allocated, failed=failed)
+            position = self._next_position(position=position, transition=transition)
+        return context
+
+    def stats(self) -> Dict[str, StageStats]:
+        return dict(self._stats)
+
+    def _next_position(self, position: int, transition: Optional[str]) -> int:
+        if transition is None:
+            return position + 1
+        if transition == END:
+            return len(self._stages)
+        return self._positions[transition]
+
+    def _record(self, stage: Stage, started: float, allocated: int, failed: bool) -> None:
+        self._stats[stage.name].record(seconds=time.perf_counter() - started,
+                                       allocated_bytes=_traced_memory() - allocated, failed=failed)
+
+
+def _measured_names(stage: Stage) -> List[str]:
+    if isinstance(stage, ConcurrentStage):
+        return [stage.name, *(grouped.name for grouped in stage.stages)]
+    return [stage.name]
+
+
+def _traced_memory() -> int:
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
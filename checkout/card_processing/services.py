@@ -1,23 +1,35 @@
+import asyncio
+import contextvars
+import dataclasses
 import decimal
 import enum
+import threading
+import time
 from collections.abc import Iterator
-from typing import Optional
+from typing import Iterable, Optional
 
 import pydantic
 
-from checkout.card_processing import adapters, model
+from checkout.card_processing import adapters, model, pipeline
+from checkout.infrastructure import database, deadline, metrics
 from checkout.standard_types import money, card
 
 
-class Card(pydantic.BaseModel):
+@dataclasses.dataclass(frozen=True, slots=True, kw_only=True)
+class Card:
     cardholder_name: str
     expiration_month: int
     expiration_year: int
     pan: pydantic.SecretStr
     cvv: pydantic.SecretStr
+    masked_pan: str
 
 
-class TransactionRequest(pydantic.BaseModel):
+@dataclasses.dataclass(frozen=True, slots=True, kw_only=True)
+class TransactionRequest:
+    """
+    Already validated by the caller, like ``Card``, it is not validated again.
+    """
     client_id: str
     client_reference_id: str
     merchant_id: str
@@ -34,7 +46,8 @@ class TransactionStatus(enum.Enum):
     REJECTED = "REJECTED"
 
 
-class TransactionResponse(pydantic.BaseModel):
+@dataclasses.dataclass(frozen=True, slots=True, kw_only=True)
+class TransactionResponse:
     card_franchise: str
     card_country: str
     network: card.AcquiringNetwork
@@ -45,75 +58,310 @@ class TransactionResponse(pydantic.BaseModel):
     attempts: int = 0
 
 
+ACCOUNT_RANGE_LOOKUP_SECONDS = metrics.histogram(
+    "checkout_account_range_lookup_seconds", "Time to get the PAN info of a card.", labels=("provider",))
+CAPTURE_SECONDS = metrics.histogram(
+    "checkout_capture_seconds", "Time an acquirer took to answer a capture, by its answer.",
+    labels=("acquirer", "network", "response_code"))
+
+
 def process_sale(request: TransactionRequest,
                  router: adapters.TransactionRouter,
                  account_range_provider: adapters.AccountRangeProvider,
-                 repo: adapters.CardNotPresentTransactionRepository) -> TransactionResponse:
-    pan_info = account_range_provider.get_pan_info(pan=request.card.pan)
-    processors = router.get_acquiring_processing_providers(
-        package=adapters.TransactionPackage(franchise=card.Franchise.VISA))
+                 repo: adapters.CardNotPresentTransactionRepository,
+                 unit_of_work: database.UnitOfWork = database.ImmediateUnitOfWork(),
+                 sale_pipeline: Optional[pipeline.Pipeline] = None) -> TransactionResponse:
+    context = SaleContext(request=request, router=router, account_range_provider=account_range_provider,
+                          repo=repo, unit_of_work=unit_of_work)
+    return (sale_pipeline or SALE_PIPELINE).run(context).response
 
-    return _process_transaction(processors=processors, repo=repo,
-                                request=request, pan_info=pan_info)
 
+async def process_sale_async(request: TransactionRequest,
+                             router: adapters.TransactionRouter,
+                             account_range_provider: adapters.AccountRangeProvider,
+                             repo: adapters.CardNotPresentTransactionRepository,
+                             unit_of_work: database.UnitOfWork = database.ImmediateUnitOfWork(),
+                             sale_pipeline: Optional[pipeline.Pipeline] = None) -> TransactionResponse:
+    context = SaleContext(request=request, router=router, account_range_provider=account_range_provider,
+                          repo=repo, unit_of_work=unit_of_work)
+    return (await (sale_pipeline or SALE_PIPELINE).run_async(context)).response
 
-def _process_transaction(
-        processors: Iterator[adapters.AcquiringProcessorProvider],
-        repo: adapters.CardNotPresentTransactionRepository,
-        request: TransactionRequest, pan_info: adapters.PANInfo,
-        previous_result: Optional[adapters.FinancialMessageResult] = None, attempt: int = 0) -> TransactionResponse:
-    processor = next(processors, adapters.NoProcessorAvailable(last_financial_message_result=previous_result))
 
-    transaction = repo.register_transaction(
-        transaction=_request_and_pan_into_to_transaction(pan_info=pan_info,
-                                                         request=request,
-                                                         transaction_id=repo.generate_id()))
+# SALE PIPELINE #########################################
+class SaleContext:
+    """
+    State of a sale as it goes through the stages of the sale pipeline.
+    """
+    __slots__ = ("request", "router", "account_range_provider", "repo", "unit_of_work",
+                 "pan_info", "transaction_id", "processors", "message", "processor", "transaction",
+                 "result", "previous_result", "attempt", "retry", "response")
 
-    result = processor.capture(message=_transaction_request_to_capture_message(request=request))
+    def __init__(self, request: TransactionRequest,
+                 router: adapters.TransactionRouter,
+                 account_range_provider: adapters.AccountRangeProvider,
+                 repo: adapters.CardNotPresentTransactionRepository,
+                 unit_of_work: database.UnitOfWork) -> None:
+        self.request = request
+        self.router = router
+        self.account_range_provider = account_range_provider
+        self.repo = repo
+        self.unit_of_work = unit_of_work
+        self.pan_info: Optional[adapters.PANInfo] = None
+        # Generated ahead of the first attempt, every retry generates its own.
+        self.transaction_id: Optional[str] = None
+        self.processors: Optional[Iterator[adapters.AcquiringProcessorProvider]] = None
+        self.message: Optional[adapters.CaptureMessage] = None
+        self.processor: Optional[adapters.AcquiringProcessorProvider] = None
+        self.transaction: Optional[model.CardNotPresentTransaction] = None
+        self.result: Optional[adapters.FinancialMessageResult] = None
+        self.previous_result: Optional[adapters.FinancialMessageResult] = None
+        self.attempt = 0
+        self.retry = False
+        self.response: Optional[TransactionResponse] = None
 
-    if isinstance(result, adapters.ApprovedCapture):
-        return _approve_transaction(attempt=attempt, repo=repo, result=result, transaction=transaction)
 
-    if isinstance(result, adapters.RejectedCapture) and result.is_retryable:
-        return _retry_transaction(attempt=attempt, pan_info=pan_info, processors=processors, repo=repo, request=request,
-                                  result=result, transaction=transaction)
+class AccountRangeLookupStage(pipeline.Stage):
+    name = "account_range_lookup"
 
-    return _reject_transaction(attempt=attempt, repo=repo, result=result, transaction=transaction)
+    def run(self, context: SaleContext) -> Optional[str]:
+        started = time.perf_counter()
+        context.pan_info = context.account_range_provider.get_pan_info(pan=context.request.card.pan)
+        ACCOUNT_RANGE_LOOKUP_SECONDS.labels(type(context.account_range_provider).__name__).observe(
+            time.perf_counter() - started)
+        return None
 
 
-def _retry_transaction(attempt: int, repo: adapters.CardNotPresentTransactionRepository,
-                       pan_info: adapters.PANInfo,
-                       processors: Iterator[adapters.AcquiringProcessorProvider],
-                       request: TransactionRequest,
-                       result: adapters.FinancialMessageResult,
-                       transaction: model.CardNotPresentTransaction) -> TransactionResponse:
+class TransactionIdStage(pipeline.Stage):
+    name = "transaction_id"
+
+    def run(self, context: SaleContext) -> Optional[str]:
+        context.transaction_id = context.repo.generate_id()
+        return None
+
+
+class RouteStage(pipeline.Stage):
+    name = "route"
+
+    def run(self, context: SaleContext) -> Optional[str]:
+        context.processors = context.router.get_acquiring_processing_providers(
+            package=_pan_info_to_package(pan_info=context.pan_info))
+        context.message = _transaction_request_to_capture_message(request=context.request)
+        return None
+
+
+class RegisterStage(pipeline.Stage):
+    """
+    Picks the next processor and registers the transaction of the attempt.
+    """
+    name = "register"
+
+    def run(self, context: SaleContext) -> Optional[str]:
+        context.transaction = context.repo.register_transaction(transaction=self._next_attempt(context))
+        # The acquirer must never capture a transaction we have no durable record of.
+        context.unit_of_work.flush()
+        return None
+
+    async def run_async(self, context: SaleContext) -> Optional[str]:
+        context.transaction = await context.repo.register_transaction_async(transaction=self._next_attempt(context))
+        await context.unit_of_work.flush_async()
+        return None
+
+    @staticmethod
+    def _next_attempt(context: SaleContext) -> model.CardNotPresentTransaction:
+        context.processor = next(context.processors,
+                                 adapters.NoProcessorAvailable(last_financial_message_result=context.previous_result))
+        _ensure_budget_for(processor=context.processor)
+        transaction_id = context.transaction_id or context.repo.generate_id()
+        context.transaction_id = None
+        return _request_and_pan_into_to_transaction(pan_info=context.pan_info, request=context.request,
+                                                    transaction_id=transaction_id)
+
+
+class CaptureStage(pipeline.Stage):
+    name = "capture"
+
+    def run(self, context: SaleContext) -> Optional[str]:
+        context.result = None
+        started = time.perf_counter()
+        try:
+            context.result = _capture_within_deadline(processor=context.processor, message=context.message)
+        except deadline.DeadlineExceededError:
+            self._observe(context, started=started, failure="timeout")
+            raise
+        except BaseException:
+            self._observe(context, started=started, failure="error")
+            raise
+        self._observe(context, started=started)
+        return None
+
+    async def run_async(self, context: SaleContext) -> Optional[str]:
+        context.result = None
+        started = time.perf_counter()
+        try:
+            context.result = await asyncio.wait_for(context.processor.capture_async(message=context.message),
+                                                    timeout=deadline.remaining())
+        except asyncio.TimeoutError as error:
+            self._observe(context, started=started, failure="timeout")
+            # The acquirer may still capture it: the transaction stays PROCESSING until it is resolved.
+            raise deadline.DeadlineExceededError(deadline.DeadlineExceededError.message) from error
+        except BaseException:
+            self._observe(context, started=started, failure="error")
+            raise
+        self._observe(context, started=started)
+        return None
+
+    @staticmethod
+    def _observe(context: SaleContext, started: float, failure: Optional[str] = None) -> None:
+        # ``failure`` labels the captures that did not answer, the others are labelled by their result.
+        if failure is None:
+            result = context.result
+            series = CAPTURE_SECONDS.labels(context.processor.name, result.network.value, result.response_code)
+        else:
+            series = CAPTURE_SECONDS.labels(context.processor.name, card.AcquiringNetwork.NONE.value, failure)
+        series.observe(time.perf_counter() - started)
+
+
+class DecideStage(pipeline.Stage):
+    """
+    Applies the result of the capture to the transaction, a retryable rejection sends the sale to the next
+    processor once persisted.
+    """
+    name = "decide"
+
+    def run(self, context: SaleContext) -> Optional[str]:
+        result, transaction, attempt = context.result, context.transaction, context.attempt
+        if isinstance(result, adapters.ApprovedCapture):
+            _apply_approval(attempt=attempt, result=result, transaction=transaction)
+            context.response = _approved_response(attempt=attempt, result=result, transaction=transaction)
+            return None
+
+        _apply_rejection(attempt=attempt, result=result, transaction=transaction)
+        context.retry = isinstance(result, adapters.RejectedCapture) and result.is_retryable
+        if context.retry:
+            context.previous_result = result
+        else:
+            context.response = _rejected_response(attempt=attempt, result=result, transaction=transaction)
+        return None
+
+
+class PersistStage(pipeline.Stage):
+    name = "persist"
+
+    def run(self, context: SaleContext) -> Optional[str]:
+        context.repo.update_transaction(transaction=context.transaction)
+        return self._retry(context)
+
+    async def run_async(self, context: SaleContext) -> Optional[str]:
+        await context.repo.update_transaction_async(transaction=context.transaction)
+        return self._retry(context)
+
+    @staticmethod
+    def _retry(context: SaleContext) -> Optional[str]:
+        if not context.retry:
+            return pipeline.END
+        context.retry = False
+        context.attempt += 1
+        return RegisterStage.name
+
+
+def build_sale_pipeline() -> pipeline.Pipeline:
+    """
+    Stages of a sale, more can be inserted with ``insert_before`` and ``insert_after``. A stage may end the sale
+    early by setting the response of the context and returning ``pipeline.END``.
+    """
+    return pipeline.Pipeline(stages=(
+        pipeline.ConcurrentStage(name="lookup", stages=(AccountRangeLookupStage(), TransactionIdStage())),
+        RouteStage(),
+        RegisterStage(),
+        CaptureStage(),
+        DecideStage(),
+        PersistStage(),
+    ))
+
+
+SALE_PIPELINE: pipeline.Pipeline = build_sale_pipeline()
+
+
+def _collect_sale_pipeline() -> Iterable[metrics.Sample]:
+    for stage, stats in SALE_PIPELINE.stats().items():
+        labels = (("stage", stage),)
+        yield metrics.Sample(name="checkout_sale_stage_calls_total", help="Runs of a sale pipeline stage.",
+                             type="counter", labels=labels, value=stats.calls)
+        yield metrics.Sample(name="checkout_sale_stage_errors_total", help="Runs of a sale pipeline stage that raised.",
+                             type="counter", labels=labels, value=stats.errors)
+        yield metrics.Sample(name="checkout_sale_stage_seconds_total", help="Time spent in a sale pipeline stage.",
+                             type="counter", labels=labels, value=stats.seconds)
+
+
+metrics.register_collector(_collect_sale_pipeline)
+
+
+def _capture_within_deadline(processor: adapters.AcquiringProcessorProvider,
+                             message: adapters.CaptureMessage) -> adapters.FinancialMessageResult:
+    """
+    Blocking capture given the remaining budget of the request, like ``wait_for`` gives it on the async path: past
+    the deadline it is no longer waited for and the transaction stays PROCESSING until it is resolved.
+    """
+    budget = deadline.remaining()
+    if budget is None:
+        return processor.capture(message=message)
+    if budget <= 0:
+        raise deadline.DeadlineExceededError(deadline.DeadlineExceededError.message)
+    outcome = {}
+
+    def capture() -> None:
+        try:
+            outcome["result"] = processor.capture(message=message)
+        except BaseException as error:
+            outcome["error"] = error
+
+    # The thread gets the deadline too, so an HTTP acquirer caps its own socket timeouts with it.
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(capture,), name="capture", daemon=True)
+    thread.start()
+    thread.join(budget)
+    if thread.is_alive():
+        raise deadline.DeadlineExceededError(deadline.DeadlineExceededError.message)
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+def _ensure_budget_for(processor: adapters.AcquiringProcessorProvider) -> None:
+    """
+    Stops before registering a transaction the processor could not capture within the request deadline.
+    """
+    budget = deadline.remaining()
+    if budget is not None and budget <= processor.expected_latency_seconds():
+        raise deadline.DeadlineExceededError(deadline.DeadlineExceededError.message)
+
+
+def _apply_rejection(attempt: int, result: adapters.FinancialMessageResult,
+                     transaction: model.CardNotPresentTransaction) -> None:
     transaction.reject(
         network=result.network,
         response_code=result.response_code,
         response_message=result.response_message,
         attempt=attempt,
-        was_retryable=result.is_retryable,
-    )
-    repo.update_transaction(transaction=transaction)
-    return _process_transaction(processors=processors, repo=repo,
-                                request=request, pan_info=pan_info,
-                                previous_result=result, attempt=attempt + 1)
+        was_retryable=result.is_retryable)
 
 
-def _reject_transaction(attempt: int, repo: adapters.CardNotPresentTransactionRepository,
-                        result: adapters.FinancialMessageResult,
-                        transaction: model.CardNotPresentTransaction) -> TransactionResponse:
-    transaction.reject(
+def _apply_approval(attempt: int, result: adapters.FinancialMessageResult,
+                    transaction: model.CardNotPresentTransaction) -> None:
+    transaction.approve(
         network=result.network,
         response_code=result.response_code,
         response_message=result.response_message,
         attempt=attempt,
-        was_retryable=result.is_retryable)
-    repo.update_transaction(transaction=transaction)
+        approval_code=result.approval_code
+    )
+
+
+def _rejected_response(attempt: int, result: adapters.FinancialMessageResult,
+                       transaction: model.CardNotPresentTransaction) -> TransactionResponse:
     return TransactionResponse(
         card_franchise=transaction.card_data.franchise,
         card_country=transaction.card_data.country,
-        network=result.network.value,
+        network=result.network,
         response_code=result.response_code,
         response_message=result.response_message,
         status=TransactionStatus.REJECTED,
@@ -122,21 +370,12 @@ def _reject_transaction(attempt: int, repo: adapters.CardNotPresentTransactionRe
     )
 
 
-def _approve_transaction(attempt: int, repo: adapters.CardNotPresentTransactionRepository,
-                         result: adapters.FinancialMessageResult,
-                         transaction: model.CardNotPresentTransaction) -> TransactionResponse:
-    transaction.approve(
-        network=result.network,
-        response_code=result.response_code,
-        response_message=result.response_message,
-        attempt=attempt,
-        approval_code=result.approval_code
-    )
-    repo.update_transaction(transaction=transaction)
+def _approved_response(attempt: int, result: adapters.FinancialMessageResult,
+                       transaction: model.CardNotPresentTransaction) -> TransactionResponse:
     return TransactionResponse(
         card_franchise=transaction.card_data.franchise,
         card_country=transaction.card_data.country,
-        network=result.network.value,
+        network=result.network,
         response_code=result.response_code,
         response_message=result.response_message,
         approval_code=result.approval_code,
@@ -160,7 +399,7 @@ def _request_and_pan_into_to_transaction(request: TransactionRequest, pan_info:
         franchise=pan_info.franchise,
         card_category=pan_info.category,
         card_country=pan_info.country,
-        card_masked_pan=card.PAN.mask(request.card.pan.get_secret_value()),
+        card_masked_pan=request.card.masked_pan,
         card_expiration_month=request.card.expiration_month,
         card_expiration_year=request.card.expiration_year,
     )
@@ -176,6 +415,14 @@ def _transaction_request_to_capture_message(request: TransactionRequest) -> adap
         cardholder_name=request.card.cardholder_name,
         expiration_month=request.card.expiration_month,
         expiration_year=request.card.expiration_year,
-        pan=request.card.pan.get_secret_value(),
-        cvv=request.card.cvv.get_secret_value(),
+        pan=request.card.pan,
+        cvv=request.card.cvv,
     )
+
+
+def _pan_info_to_package(pan_info: adapters.PANInfo) -> adapters.TransactionPackage:
+    try:
+        franchise = card.Franchise(pan_info.franchise)
+    except ValueError:
+        franchise = card.Franchise.UNRECOGNIZED
+    return adapters.TransactionPackage(franchise=franchise, country=pan_info.country)
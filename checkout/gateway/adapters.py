@@ -1,28 +1,42 @@
 import abc
+import asyncio
+import dataclasses
+import datetime
 import decimal
 import enum
 import os
-from typing import Optional, List
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any, Callable, Dict, Iterable, NamedTuple, Optional, List, Sequence, Tuple
 
-import psycopg2
 import pydantic
 
 from checkout.card_processing import services, adapters
 from checkout.gateway import model
 from checkout.gateway.model import CardNotPresentPayment
-from checkout.standard_types import money, helpers
+from checkout.infrastructure import cache, database, log, notifications
+from checkout.standard_types import base_types, money, helpers
+
+_LOGGER = log.get_logger(__name__)
+psycopg2 = database.lazy_import("psycopg2")
 
 
 # CARD PROCESSING ADAPTER #########################################
-class Card(pydantic.BaseModel):
+# The messages exchanged with card processing are plain slotted dataclasses: the payment request is validated once
+# at the API edge and nothing is validated, copied or unwrapped again on the way to the acquirer and back.
+@dataclasses.dataclass(frozen=True, slots=True, kw_only=True)
+class Card:
     cardholder_name: str
     expiration_month: int
     expiration_year: int
     pan: pydantic.SecretStr
     cvv: pydantic.SecretStr
+    masked_pan: str
 
 
-class Transaction(pydantic.BaseModel):
+@dataclasses.dataclass(frozen=True, slots=True, kw_only=True)
+class Transaction:
     client_id: str = "FLASHY_GW"
     client_reference_id: str
     merchant_id: str
@@ -39,7 +53,8 @@ class TransactionStatus(enum.Enum):
     REJECTED = "REJECTED"
 
 
-class TransactionResponse(pydantic.BaseModel):
+@dataclasses.dataclass(frozen=True, slots=True, kw_only=True)
+class TransactionResponse:
     network: str
     response_code: str
     response_message: str
@@ -63,18 +78,52 @@ class CardNotPresentProvider(abc.ABC):
         TransactionResponse
         """
 
+    async def sale_async(self, transaction: Transaction) -> TransactionResponse:
+        """
+        Non-blocking variant of ``sale``. By default the blocking call runs in a worker thread.
+        """
+        return await asyncio.to_thread(self.sale, transaction)
+
 
 class FlashyCardNotPresentProvider(CardNotPresentProvider):
+    def __init__(self,
+                 router: Optional[adapters.TransactionRouter] = None,
+                 account_range_provider: Optional[adapters.AccountRangeProvider] = None,
+                 repo: Optional[adapters.CardNotPresentTransactionRepository] = None,
+                 unit_of_work: Optional[database.PostgresUnitOfWork] = None) -> None:
+        """
+        :param unit_of_work: shared with the caller's repositories, card processing flushes it before reaching
+        the acquirer so the payment and transaction records are durable by then.
+        """
+        self._router = router or adapters.get_transaction_router()
+        self._account_range_provider = account_range_provider or adapters.get_account_range_provider()
+        self._unit_of_work = unit_of_work or database.ImmediateUnitOfWork()
+        self._repo = repo or adapters.PostgresCardNotPresentTransactionRepository(unit_of_work=unit_of_work)
+
     def sale(self, transaction: Transaction) -> TransactionResponse:
         response = services.process_sale(
             request=FlashyCardNotPresentProvider._transaction_to_request(transaction=transaction),
-            router=adapters.FlashyTransactionRouter(),
-            account_range_provider=adapters.FlashyAccountRangeProvider(),
-            repo=adapters.PostgresCardNotPresentTransactionRepository()
+            router=self._router,
+            account_range_provider=self._account_range_provider,
+            repo=self._repo,
+            unit_of_work=self._unit_of_work,
         )
+        return FlashyCardNotPresentProvider._response_from_sale(response=response)
 
+    async def sale_async(self, transaction: Transaction) -> TransactionResponse:
+        response = await services.process_sale_async(
+            request=FlashyCardNotPresentProvider._transaction_to_request(transaction=transaction),
+            router=self._router,
+            account_range_provider=self._account_range_provider,
+            repo=self._repo,
+            unit_of_work=self._unit_of_work,
+        )
+        return FlashyCardNotPresentProvider._response_from_sale(response=response)
+
+    @staticmethod
+    def _response_from_sale(response: services.TransactionResponse) -> TransactionResponse:
         return TransactionResponse(
-            network=response.network,
+            network=response.network.value,
             response_code=response.response_code,
             response_message=response.response_message,
             approval_code=response.approval_code,
@@ -97,11 +146,55 @@ class FlashyCardNotPresentProvider(CardNotPresentProvider):
                 expiration_year=transaction.card.expiration_year,
                 pan=transaction.card.pan,
                 cvv=transaction.card.cvv,
+                masked_pan=transaction.card.masked_pan,
             ),
         )
 
 
 # PAYMENT REPOSITORY #########################################
+class PaymentPosition(base_types.ValueObjet):
+    """
+    Keyset position of a payment in the merchant listing, which is ordered by ``payment_date, payment_id``.
+    """
+    payment_date: int
+    payment_id: str
+
+
+class PaymentView(NamedTuple):
+    """
+    Projection of a payment on the requested fields of ``PAYMENT_VIEW_COLUMNS``, with its listing position.
+    """
+    payment_date: int
+    payment_id: str
+    fields: Dict[str, Any]
+
+
+# Fields a payment can be projected on and the column they are read from.
+PAYMENT_VIEW_COLUMNS: Dict[str, str] = {
+    "payment_id": "payment_id",
+    "currency": "currency",
+    "total_amount": "total_amount",
+    "tip": "tip",
+    "vat": "vat",
+    "last_four_digits": "RIGHT(card_masked_pan, 4)",
+    "status": "status",
+}
+
+
+def payment_to_view(payment: model.CardNotPresentPayment, fields: Sequence[str]) -> PaymentView:
+    values = {
+        "payment_id": payment.payment_id,
+        "currency": payment.currency.value,
+        "total_amount": payment.total_amount,
+        "tip": payment.tip,
+        "vat": payment.vat,
+        "last_four_digits": payment.card.masked_pan[-4:],
+        "status": payment.status.value,
+    }
+    return PaymentView(payment_date=payment.payment_date, payment_id=payment.payment_id,
+                       fields={field: values[field] for field in fields})
+
+
 class CardNotPresentPaymentRepository(abc.ABC):
 
     @abc.abstractmethod
@@ -109,8 +202,18 @@ class CardNotPresentPaymentRepository(abc.ABC):
         ...
 
     @abc.abstractmethod
-    def get_payments(self, merchant_id: str) -> List[model.CardNotPresentPayment]:
-        ...
+    def get_payments(self, merchant_id: str, limit: int,
+                     after: Optional[PaymentPosition] = None) -> List[model.CardNotPresentPayment]:
+        """
+        Returns up to ``limit`` payments of the merchant ordered by ``payment_date, payment_id``,
+        starting right after the ``after`` position when given.
+        """
+
+    @abc.abstractmethod
+    def iter_payments(self, merchant_id: str) -> Iterator[model.CardNotPresentPayment]:
+        """
+        Yields every payment of the merchant in listing order without holding them all in memory.
+        """
 
     @abc.abstractmethod
     def find_payment(self, merchant_id: str, payment_id: str) -> Optional[model.CardNotPresentPayment]:
@@ -124,157 +227,1081 @@ class CardNotPresentPaymentRepository(abc.ABC):
     def update_payment(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
         ...
 
+    @abc.abstractmethod
+    def create_payments(self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        """
+        Creates every payment in a single round trip.
+        """
+
+    @abc.abstractmethod
+    def update_payments(self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        """
+        Updates the receipt and status of every payment in a single round trip.
+        """
+
+    def get_payment_views(self, merchant_id: str, fields: Sequence[str], limit: int,
+                          after: Optional[PaymentPosition] = None) -> List[PaymentView]:
+        """
+        ``get_payments`` projected on ``fields``. By default the payments are loaded and projected, repositories
+        able to read only the needed columns should override it, like the other ``*_view*`` methods.
+        """
+        return [payment_to_view(payment, fields)
+                for payment in self.get_payments(merchant_id=merchant_id, limit=limit, after=after)]
+
+    def iter_payment_views(self, merchant_id: str, fields: Sequence[str]) -> Iterator[PaymentView]:
+        for payment in self.iter_payments(merchant_id=merchant_id):
+            yield payment_to_view(payment, fields)
+
+    def find_payment_view(self, merchant_id: str, payment_id: str, fields: Sequence[str]) -> Optional[PaymentView]:
+        payment = self.find_payment(merchant_id=merchant_id, payment_id=payment_id)
+        return payment_to_view(payment, fields) if payment is not None else None
+
+    async def get_payments_async(self, merchant_id: str, limit: int,
+                                 after: Optional[PaymentPosition] = None) -> List[model.CardNotPresentPayment]:
+        return await asyncio.to_thread(self.get_payments, merchant_id, limit, after)
+
+    async def find_payment_async(self, merchant_id: str, payment_id: str) -> Optional[model.CardNotPresentPayment]:
+        return await asyncio.to_thread(self.find_payment, merchant_id, payment_id)
+
+    async def create_payment_async(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
+        return await asyncio.to_thread(self.create_payment, payment)
+
+    async def update_payment_async(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
+        return await asyncio.to_thread(self.update_payment, payment)
+
+    async def create_payments_async(
+            self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        return await asyncio.to_thread(self.create_payments, payments)
+
+    async def update_payments_async(
+            self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        return await asyncio.to_thread(self.update_payments, payments)
+
+
+PAYMENTS_WRITER = database.TableWriter(
+    table="payments",
+    columns=("merchant_id", "payment_id",
+             "currency", "total_amount", "tip", "vat",
+             "receipt_response_code", "receipt_response_message", "receipt_approval_code",
+             "status", "card_masked_pan", "payment_date"),
+    key_columns=("payment_id",),
+    update_columns=("receipt_response_code", "receipt_response_message", "receipt_approval_code", "status"),
+)
+
 
 class PostgresCardNotPresentPaymentRepository(CardNotPresentPaymentRepository):
+    """
+    When created with a unit of work, ``create_payment`` and ``update_payment`` stage the payment in it and
+    nothing is written until the unit of work is flushed.
+    """
+    _STREAM_BATCH_SIZE: int = 2000
+
+    def __init__(self, pool: Optional[database.ConnectionPool] = None,
+                 unit_of_work: Optional[database.PostgresUnitOfWork] = None) -> None:
+        self._pool = pool or database.get_pool()
+        self._unit_of_work = unit_of_work
 
     def generate_id(self) -> str:
         return helpers.IDGenerator.hex_uuid()
 
-    def get_payments(self, merchant_id: str) -> List[model.CardNotPresentPayment]:
-        conn = None
+    @database.timed_repository("payments", "get_payments")
+    def get_payments(self, merchant_id: str, limit: int,
+                     after: Optional[PaymentPosition] = None) -> List[model.CardNotPresentPayment]:
         try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                    SELECT merchant_id, payment_id, 
-                    currency, total_amount, tip, vat, 
-                    receipt_response_code, receipt_response_message, receipt_approval_code, 
-                    status, card_masked_pan, payment_date 
-                    FROM payments 
-                    WHERE merchant_id = %s
-                """,
-                (merchant_id,))
-
-            rows = cursor.fetchall()
-            payments = []
-            for row in rows:
-                payments.append(CardNotPresentPayment(
-                    merchant_id=merchant_id,
-                    payment_id=row[1],
-                    currency=money.Currency[row[2]],
-                    total_amount=row[3],
-                    tip=row[4],
-                    vat=row[5],
-                    receipt=model.Receipt(
-                        response_code=row[6],
-                        response_message=row[7],
-                        approval_code=row[8]),
-                    status=model.PaymentStatus[row[9]],
-                    card=model.NotPresentCard(
-                        masked_pan=row[10]),
-                    payment_date=row[11],
-                ))
-            cursor.close()
-            return payments
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                if after is None:
+                    cursor.execute(
+                        """
+                            SELECT merchant_id, payment_id, 
+                            currency, total_amount, tip, vat, 
+                            receipt_response_code, receipt_response_message, receipt_approval_code, 
+                            status, card_masked_pan, payment_date 
+                            FROM payments 
+                            WHERE merchant_id = %s
+                            ORDER BY payment_date, payment_id
+                            LIMIT %s
+                        """,
+                        (merchant_id, limit))
+                else:
+                    cursor.execute(
+                        """
+                            SELECT merchant_id, payment_id, 
+                            currency, total_amount, tip, vat, 
+                            receipt_response_code, receipt_response_message, receipt_approval_code, 
+                            status, card_masked_pan, payment_date 
+                            FROM payments 
+                            WHERE merchant_id = %s AND (payment_date, payment_id) > (%s, %s)
+                            ORDER BY payment_date, payment_id
+                            LIMIT %s
+                        """,
+                        (merchant_id, after.payment_date, after.payment_id, limit))
+
+                payments = [self._row_to_payment(row) for row in cursor.fetchall()]
+                cursor.close()
+                return payments
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="payments", method="get_payments", error=error)
+            raise
+
+    @database.timed_repository("payments", "iter_payments")
+    def iter_payments(self, merchant_id: str) -> Iterator[model.CardNotPresentPayment]:
+        try:
+            with self._pool.connection() as conn:
+                # A named cursor lives on the server, rows are fetched in batches of ``itersize``.
+                cursor = conn.cursor(name=f"payments_{helpers.IDGenerator.hex_uuid()}")
+                cursor.itersize = self._STREAM_BATCH_SIZE
+                cursor.execute(
+                    """
+                        SELECT merchant_id, payment_id, 
+                        currency, total_amount, tip, vat, 
+                        receipt_response_code, receipt_response_message, receipt_approval_code, 
+                        status, card_masked_pan, payment_date 
+                        FROM payments 
+                        WHERE merchant_id = %s
+                        ORDER BY payment_date, payment_id
+                    """,
+                    (merchant_id,))
+
+                for row in cursor:
+                    yield self._row_to_payment(row)
+                cursor.close()
         except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
+            _LOGGER.error("query_failed", repository="payments", method="iter_payments", error=error)
             raise
-        finally:
-            if conn is not None:
-                conn.close()
 
+    @database.timed_repository("payments", "find_payment")
     def find_payment(self, merchant_id: str, payment_id: str) -> Optional[model.CardNotPresentPayment]:
-        conn = None
         payment = None
         try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                    SELECT merchant_id, payment_id, 
-                    currency, total_amount, tip, vat, 
-                    receipt_response_code, receipt_response_message, receipt_approval_code, 
-                    status, card_masked_pan, payment_date 
-                    FROM payments 
-                    WHERE merchant_id = %s AND payment_id = %s
-                """,
-                (merchant_id, payment_id))
-
-            row = cursor.fetchone()
-            if row is not None:
-                payment = CardNotPresentPayment(
-                    merchant_id=merchant_id,
-                    payment_id=payment_id,
-                    currency=money.Currency[row[2]],
-                    total_amount=row[3],
-                    tip=row[4],
-                    vat=row[5],
-                    receipt=model.Receipt(
-                        response_code=row[6],
-                        response_message=row[7],
-                        approval_code=row[8]),
-                    status=model.PaymentStatus[row[9]],
-                    card=model.NotPresentCard(
-                        masked_pan=row[10]),
-                    payment_date=row[11],
-                )
-            cursor.close()
-            return payment
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                        SELECT merchant_id, payment_id, 
+                        currency, total_amount, tip, vat, 
+                        receipt_response_code, receipt_response_message, receipt_approval_code, 
+                        status, card_masked_pan, payment_date 
+                        FROM payments 
+                        WHERE merchant_id = %s AND payment_id = %s
+                    """,
+                    (merchant_id, payment_id))
+
+                row = cursor.fetchone()
+                if row is not None:
+                    payment = self._row_to_payment(row)
+                cursor.close()
+                return payment
         except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
+            _LOGGER.error("query_failed", repository="payments", method="find_payment", error=error)
             raise
-        finally:
-            if conn is not None:
-                conn.close()
 
+    @database.timed_repository("payments", "get_payment_views")
+    def get_payment_views(self, merchant_id: str, fields: Sequence[str], limit: int,
+                          after: Optional[PaymentPosition] = None) -> List[PaymentView]:
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                if after is None:
+                    cursor.execute(
+                        f"""
+                            {self._view_select(fields)}
+                            WHERE merchant_id = %s
+                            ORDER BY payment_date, payment_id
+                            LIMIT %s
+                        """,
+                        (merchant_id, limit))
+                else:
+                    cursor.execute(
+                        f"""
+                            {self._view_select(fields)}
+                            WHERE merchant_id = %s AND (payment_date, payment_id) > (%s, %s)
+                            ORDER BY payment_date, payment_id
+                            LIMIT %s
+                        """,
+                        (merchant_id, after.payment_date, after.payment_id, limit))
+
+                views = [self._row_to_view(row, fields) for row in cursor.fetchall()]
+                cursor.close()
+                return views
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="payments", method="get_payment_views", error=error)
+            raise
+
+    @database.timed_repository("payments", "iter_payment_views")
+    def iter_payment_views(self, merchant_id: str, fields: Sequence[str]) -> Iterator[PaymentView]:
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor(name=f"payments_{helpers.IDGenerator.hex_uuid()}")
+                cursor.itersize = self._STREAM_BATCH_SIZE
+                cursor.execute(
+                    f"""
+                        {self._view_select(fields)}
+                        WHERE merchant_id = %s
+                        ORDER BY payment_date, payment_id
+                    """,
+                    (merchant_id,))
+
+                for row in cursor:
+                    yield self._row_to_view(row, fields)
+                cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="payments", method="iter_payment_views", error=error)
+            raise
+
+    @database.timed_repository("payments", "find_payment_view")
+    def find_payment_view(self, merchant_id: str, payment_id: str, fields: Sequence[str]) -> Optional[PaymentView]:
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    f"""
+                        {self._view_select(fields)}
+                        WHERE merchant_id = %s AND payment_id = %s
+                    """,
+                    (merchant_id, payment_id))
+
+                row = cursor.fetchone()
+                cursor.close()
+                return self._row_to_view(row, fields) if row is not None else None
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="payments", method="find_payment_view", error=error)
+            raise
+
+    @database.timed_repository("payments", "create_payment")
     def create_payment(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
-        conn = None
+        if self._unit_of_work is not None:
+            self._unit_of_work.stage(PAYMENTS_WRITER, self._payment_to_row(payment))
+            return payment
         try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                    INSERT INTO payments (
-                    merchant_id, payment_id, 
-                    currency, total_amount, tip, vat, 
-                    receipt_response_code, receipt_response_message, receipt_approval_code, 
-                    status, card_masked_pan, payment_date)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (payment.merchant_id, payment.payment_id,
-                 payment.currency.value, payment.total_amount, payment.tip, payment.vat,
-                 payment.receipt.response_code, payment.receipt.response_message, payment.receipt.approval_code,
-                 payment.status.value, payment.card.masked_pan, payment.payment_date))
-            conn.commit()
-            cursor.close()
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                        INSERT INTO payments (
+                        merchant_id, payment_id, 
+                        currency, total_amount, tip, vat, 
+                        receipt_response_code, receipt_response_message, receipt_approval_code, 
+                        status, card_masked_pan, payment_date)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    """,
+                    self._payment_to_row(payment))
+                conn.commit()
+                cursor.close()
+                return payment
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="payments", method="create_payment", error=error)
+            raise
+
+    @database.timed_repository("payments", "update_payment")
+    def update_payment(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
+        if self._unit_of_work is not None:
+            self._unit_of_work.stage(PAYMENTS_WRITER, self._payment_to_row(payment))
             return payment
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                        UPDATE payments SET 
+                        receipt_response_code = %s, receipt_response_message = %s, 
+                        receipt_approval_code = %s, status = %s
+                        WHERE merchant_id = %s AND payment_id = %s
+                    """,
+                    (payment.receipt.response_code, payment.receipt.response_message, payment.receipt.approval_code,
+                     payment.status.value, payment.merchant_id, payment.payment_id))
+                conn.commit()
+                cursor.close()
+
+                return payment
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="payments", method="update_payment", error=error)
+            raise
+
+    async def create_payment_async(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
+        if self._unit_of_work is not None:
+            return self.create_payment(payment)
+        return await super().create_payment_async(payment)
+
+    async def update_payment_async(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
+        if self._unit_of_work is not None:
+            return self.update_payment(payment)
+        return await super().update_payment_async(payment)
+
+    @database.timed_repository("payments", "create_payments")
+    def create_payments(self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        if not payments:
+            return payments
+        import psycopg2.extras
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                psycopg2.extras.execute_values(
+                    cursor,
+                    """
+                        INSERT INTO payments (
+                        merchant_id, payment_id, 
+                        currency, total_amount, tip, vat, 
+                        receipt_response_code, receipt_response_message, receipt_approval_code, 
+                        status, card_masked_pan, payment_date)
+                        VALUES %s
+                    """,
+                    [self._payment_to_row(payment) for payment in payments],
+                    page_size=len(payments))
+                conn.commit()
+                cursor.close()
+                return payments
         except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
+            _LOGGER.error("query_failed", repository="payments", method="create_payments", error=error)
             raise
-        finally:
-            if conn is not None:
-                conn.close()
+
+    @database.timed_repository("payments", "update_payments")
+    def update_payments(self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        if not payments:
+            return payments
+        import psycopg2.extras
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                psycopg2.extras.execute_values(
+                    cursor,
+                    """
+                        UPDATE payments SET 
+                        receipt_response_code = updated.receipt_response_code, 
+                        receipt_response_message = updated.receipt_response_message, 
+                        receipt_approval_code = updated.receipt_approval_code, status = updated.status
+                        FROM (VALUES %s) AS updated (
+                        receipt_response_code, receipt_response_message, receipt_approval_code, status, 
+                        merchant_id, payment_id)
+                        WHERE payments.merchant_id = updated.merchant_id AND payments.payment_id = updated.payment_id
+                    """,
+                    [(payment.receipt.response_code, payment.receipt.response_message,
+                      payment.receipt.approval_code, payment.status.value,
+                      payment.merchant_id, payment.payment_id) for payment in payments],
+                    page_size=len(payments))
+                conn.commit()
+                cursor.close()
+                return payments
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="payments", method="update_payments", error=error)
+            raise
+
+    @staticmethod
+    def _row_to_payment(row: tuple) -> model.CardNotPresentPayment:
+        return CardNotPresentPayment(
+            merchant_id=row[0],
+            payment_id=row[1],
+            currency=money.Currency[row[2]],
+            total_amount=row[3],
+            tip=row[4],
+            vat=row[5],
+            receipt=model.Receipt(
+                response_code=row[6],
+                response_message=row[7],
+                approval_code=row[8]),
+            status=model.PaymentStatus[row[9]],
+            card=model.NotPresentCard(
+                masked_pan=row[10]),
+            payment_date=row[11],
+        )
+
+    @staticmethod
+    def _view_select(fields: Sequence[str]) -> str:
+        # Only the expressions of PAYMENT_VIEW_COLUMNS get in the statement, never the requested names.
+        columns = "".join(f", {PAYMENT_VIEW_COLUMNS[field]}" for field in fields)
+        return f"SELECT payment_date, payment_id{columns} FROM payments"
+
+    @staticmethod
+    def _row_to_view(row: tuple, fields: Sequence[str]) -> PaymentView:
+        return PaymentView(payment_date=row[0], payment_id=row[1], fields=dict(zip(fields, row[2:])))
+
+    @staticmethod
+    def _payment_to_row(payment: model.CardNotPresentPayment) -> tuple:
+        return (payment.merchant_id, payment.payment_id,
+                payment.currency.value, payment.total_amount, payment.tip, payment.vat,
+                payment.receipt.response_code, payment.receipt.response_message, payment.receipt.approval_code,
+                payment.status.value, payment.card.masked_pan, payment.payment_date)
+
+
+PAYMENT_CACHE_SIZE: int = 50000
+PENDING_PAYMENT_TTL_SECONDS: float = 1.0
+SETTLED_PAYMENT_TTL_SECONDS: float = 300.0
+_PAYMENTS_CACHE: cache.TTLCache[Tuple[str, str], model.CardNotPresentPayment] = cache.TTLCache(
+    max_size=PAYMENT_CACHE_SIZE, ttl_seconds=SETTLED_PAYMENT_TTL_SECONDS)
+_PAYMENTS_IN_FLIGHT: cache.SingleFlight[Tuple[str, str], Optional[model.CardNotPresentPayment]] = \
+    cache.SingleFlight()
+
+
+class CachedCardNotPresentPaymentRepository(CardNotPresentPaymentRepository):
+    """
+    Read-through cache of ``find_payment`` in front of another repository, shared by every request of the worker.
+    Concurrent misses of a payment are served by a single lookup. Approved and rejected payments do not change
+    anymore and are kept for ``SETTLED_PAYMENT_TTL_SECONDS``, pending ones only for
+    ``PENDING_PAYMENT_TTL_SECONDS`` since another worker may settle them. Writes through this repository drop
+    the cached payment once ``unit_of_work``, the one ``repository`` stages its writes in, commits them: a read
+    in between would otherwise cache the state from before the write again.
+    """
+
+    def __init__(self, repository: CardNotPresentPaymentRepository,
+                 payments: Optional[cache.TTLCache[Tuple[str, str], model.CardNotPresentPayment]] = None,
+                 in_flight: Optional[cache.SingleFlight[Tuple[str, str],
+                                                        Optional[model.CardNotPresentPayment]]] = None,
+                 unit_of_work: Optional[database.UnitOfWork] = None) -> None:
+        self._repository = repository
+        self._unit_of_work = unit_of_work or database.ImmediateUnitOfWork()
+        self._payments = _PAYMENTS_CACHE if payments is None else payments
+        self._in_flight = _PAYMENTS_IN_FLIGHT if in_flight is None else in_flight
+
+    def generate_id(self) -> str:
+        return self._repository.generate_id()
+
+    def get_payments(self, merchant_id: str, limit: int,
+                     after: Optional[PaymentPosition] = None) -> List[model.CardNotPresentPayment]:
+        return self._repository.get_payments(merchant_id=merchant_id, limit=limit, after=after)
+
+    def iter_payments(self, merchant_id: str) -> Iterator[model.CardNotPresentPayment]:
+        return self._repository.iter_payments(merchant_id=merchant_id)
+
+    def get_payment_views(self, merchant_id: str, fields: Sequence[str], limit: int,
+                          after: Optional[PaymentPosition] = None) -> List[PaymentView]:
+        return self._repository.get_payment_views(merchant_id=merchant_id, fields=fields, limit=limit, after=after)
+
+    def iter_payment_views(self, merchant_id: str, fields: Sequence[str]) -> Iterator[PaymentView]:
+        return self._repository.iter_payment_views(merchant_id=merchant_id, fields=fields)
+
+    def find_payment(self, merchant_id: str, payment_id: str) -> Optional[model.CardNotPresentPayment]:
+        payment = self._find_cached(merchant_id=merchant_id, payment_id=payment_id)
+        # Callers own the payment they get, the cached one is never handed out.
+        return payment.model_copy(deep=True) if payment is not None else None
+
+    def find_payment_view(self, merchant_id: str, payment_id: str, fields: Sequence[str]) -> Optional[PaymentView]:
+        """
+        Projected from the cached payment: a poller keeps hitting the cache whatever fields it asks for.
+        """
+        payment = self._find_cached(merchant_id=merchant_id, payment_id=payment_id)
+        return payment_to_view(payment, fields) if payment is not None else None
+
+    def create_payment(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
+        written = self._repository.create_payment(payment=payment)
+        self._forget_after_commit([payment])
+        return written
 
     def update_payment(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
-        conn = None
+        written = self._repository.update_payment(payment=payment)
+        self._forget_after_commit([payment])
+        return written
+
+    def create_payments(self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        written = self._repository.create_payments(payments=payments)
+        self._forget_after_commit(payments)
+        return written
+
+    def update_payments(self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        written = self._repository.update_payments(payments=payments)
+        self._forget_after_commit(payments)
+        return written
+
+    async def get_payments_async(self, merchant_id: str, limit: int,
+                                 after: Optional[PaymentPosition] = None) -> List[model.CardNotPresentPayment]:
+        return await self._repository.get_payments_async(merchant_id=merchant_id, limit=limit, after=after)
+
+    async def find_payment_async(self, merchant_id: str, payment_id: str) -> Optional[model.CardNotPresentPayment]:
+        payment = self._payments.get((merchant_id, payment_id))
+        if payment is not None:
+            return payment.model_copy(deep=True)
+        return await super().find_payment_async(merchant_id=merchant_id, payment_id=payment_id)
+
+    async def create_payment_async(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
+        written = await self._repository.create_payment_async(payment=payment)
+        self._forget_after_commit([payment])
+        return written
+
+    async def update_payment_async(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
+        written = await self._repository.update_payment_async(payment=payment)
+        self._forget_after_commit([payment])
+        return written
+
+    async def create_payments_async(
+            self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        written = await self._repository.create_payments_async(payments=payments)
+        self._forget_after_commit(payments)
+        return written
+
+    async def update_payments_async(
+            self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        written = await self._repository.update_payments_async(payments=payments)
+        self._forget_after_commit(payments)
+        return written
+
+    def _find_cached(self, merchant_id: str, payment_id: str) -> Optional[model.CardNotPresentPayment]:
+        key = (merchant_id, payment_id)
+        payment = self._payments.get(key)
+        if payment is None:
+            payment = self._in_flight.do(key, lambda: self._load(merchant_id=merchant_id, payment_id=payment_id))
+        return payment
+
+    def _load(self, merchant_id: str, payment_id: str) -> Optional[model.CardNotPresentPayment]:
+        payment = self._repository.find_payment(merchant_id=merchant_id, payment_id=payment_id)
+        if payment is not None:
+            settled = payment.status != model.PaymentStatus.PENDING
+            self._payments.set((merchant_id, payment_id), payment,
+                               ttl_seconds=SETTLED_PAYMENT_TTL_SECONDS if settled else PENDING_PAYMENT_TTL_SECONDS)
+        return payment
+
+    def _forget_after_commit(self, payments: List[model.CardNotPresentPayment]) -> None:
+        keys = [(payment.merchant_id, payment.payment_id) for payment in payments]
+
+        def forget() -> None:
+            for key in keys:
+                self._payments.invalidate(key)
+
+        self._unit_of_work.after_commit(forget)
+
+
+# PAYMENT TOTALS #########################################
+# Key of the advisory lock that the payment_daily_totals trigger of migration 0005 takes shared for the merchant of
+# every payment it counts, and that rebuilding the totals of a merchant takes exclusively.
+PAYMENT_TOTALS_LOCK_KEY: int = 7310421
+
+
+def summarize_payments(payments: Iterable[model.CardNotPresentPayment]) -> List[model.PaymentTotals]:
+    """
+    Totals of the settled ``payments`` by day, currency and status, in that order: what the payment totals
+    repositories keep, computed from the payments themselves.
+    """
+    totals: Dict[Tuple[datetime.date, str, str], List[Any]] = {}
+    for payment in payments:
+        if payment.status == model.PaymentStatus.PENDING:
+            continue
+        key = (model.payment_day(payment.payment_date), payment.currency.value, payment.status.value)
+        total = totals.setdefault(key, [0, decimal.Decimal(0), decimal.Decimal(0), decimal.Decimal(0)])
+        total[0] += 1
+        total[1] += payment.total_amount
+        total[2] += payment.tip
+        total[3] += payment.vat
+    return [model.PaymentTotals(day=day, currency=money.Currency[currency], status=model.PaymentStatus[status],
+                                payments=count, total_amount=total_amount, tip=tip, vat=vat)
+            for (day, currency, status), (count, total_amount, tip, vat) in sorted(totals.items())]
+
+
+class PaymentTotalsRepository(abc.ABC):
+    @abc.abstractmethod
+    def get_daily_totals(self, merchant_id: str, since: Optional[datetime.date] = None,
+                         until: Optional[datetime.date] = None) -> List[model.PaymentTotals]:
+        """
+        Totals of the merchant's settled payments by day, currency and status, in that order, from ``since`` to
+        ``until`` inclusive when given.
+        """
+
+    @abc.abstractmethod
+    def get_payment_days(self, merchant_id: str) -> Optional[Tuple[datetime.date, datetime.date]]:
+        """
+        Days of the first and the last payment of the merchant, ``None`` when it has none.
+        """
+
+    @abc.abstractmethod
+    def rebuild_daily_totals(self, merchant_id: str, since: datetime.date, until: datetime.date) -> None:
+        """
+        Replaces the merchant's totals from ``since`` to ``until`` inclusive with the totals of its payments.
+        """
+
+
+class PostgresPaymentTotalsRepository(PaymentTotalsRepository):
+    """
+    Reads ``payment_daily_totals``, which a trigger on ``payments`` keeps up to date in the transaction of every
+    payment write, so a summary costs a few rows per day whatever the number of payments.
+    """
+
+    def __init__(self, pool: Optional[database.ConnectionPool] = None) -> None:
+        self._pool = pool or database.get_pool()
+
+    @database.timed_repository("payment_daily_totals", "get_daily_totals")
+    def get_daily_totals(self, merchant_id: str, since: Optional[datetime.date] = None,
+                         until: Optional[datetime.date] = None) -> List[model.PaymentTotals]:
         try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                    UPDATE payments SET 
-                    receipt_response_code = %s, receipt_response_message = %s, 
-                    receipt_approval_code = %s, status = %s
-                    WHERE merchant_id = %s AND payment_id = %s
-                """,
-                (payment.receipt.response_code, payment.receipt.response_message, payment.receipt.approval_code,
-                 payment.status.value, payment.merchant_id, payment.payment_id))
-            conn.commit()
-            cursor.close()
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                # The totals a status change emptied stay behind with no payments, they are not reported.
+                cursor.execute(
+                    """
+                        SELECT day, currency, status, payments, total_amount, tip, vat
+                        FROM payment_daily_totals
+                        WHERE merchant_id = %s AND day BETWEEN %s AND %s AND payments <> 0
+                        ORDER BY day, currency, status
+                    """,
+                    (merchant_id, since or datetime.date.min, until or datetime.date.max))
+                rows = cursor.fetchall()
+                cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="payment_daily_totals", method="get_daily_totals", error=error)
+            raise
+        return [self._row_to_totals(row) for row in rows]
 
-            return payment
+    @database.timed_repository("payments", "get_payment_days")
+    def get_payment_days(self, merchant_id: str) -> Optional[Tuple[datetime.date, datetime.date]]:
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT MIN(payment_date), MAX(payment_date) FROM payments WHERE merchant_id = %s",
+                               (merchant_id,))
+                row = cursor.fetchone()
+                cursor.close()
         except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
+            _LOGGER.error("query_failed", repository="payments", method="get_payment_days", error=error)
             raise
-        finally:
-            if conn is not None:
-                conn.close()
-
-    def _get_connection(self):
-        return psycopg2.connect(
-            host=os.environ.get("POSTGRES_HOST"),
-            dbname=os.environ.get("POSTGRES_DATABASE"),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
+        if not row or row[0] is None:
+            return None
+        return model.payment_day(row[0]), model.payment_day(row[1])
+
+    @database.timed_repository("payment_daily_totals", "rebuild_daily_totals")
+    def rebuild_daily_totals(self, merchant_id: str, since: datetime.date, until: datetime.date) -> None:
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                # Waits for the payments of the merchant being settled to commit and holds the next ones until the
+                # rebuilt totals are committed, so every payment is counted by either the rebuild or the trigger.
+                cursor.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))",
+                               (PAYMENT_TOTALS_LOCK_KEY, merchant_id))
+                cursor.execute("DELETE FROM payment_daily_totals WHERE merchant_id = %s AND day BETWEEN %s AND %s",
+                               (merchant_id, since, until))
+                cursor.execute(
+                    """
+                        INSERT INTO payment_daily_totals (
+                        merchant_id, day, currency, status, payments, total_amount, tip, vat)
+                        SELECT merchant_id, DATE '1970-01-01' + (payment_date / %s)::INTEGER, currency, status,
+                        COUNT(*), SUM(total_amount), SUM(tip), SUM(vat)
+                        FROM payments
+                        WHERE merchant_id = %s AND payment_date >= %s AND payment_date < %s AND status <> 'PENDING'
+                        GROUP BY 1, 2, 3, 4
+                    """,
+                    (model.NANOSECONDS_PER_DAY, merchant_id, model.day_start(since),
+                     model.day_start(until + datetime.timedelta(days=1))))
+                conn.commit()
+                cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="payment_daily_totals", method="rebuild_daily_totals",
+                          error=error)
+            raise
+
+    @staticmethod
+    def _row_to_totals(row: tuple) -> model.PaymentTotals:
+        return model.PaymentTotals(
+            day=row[0],
+            currency=money.Currency[row[1]],
+            status=model.PaymentStatus[row[2]],
+            payments=row[3],
+            total_amount=row[4],
+            tip=row[5],
+            vat=row[6],
         )
+
+
+# MERCHANTS #########################################
+class MerchantRepository(abc.ABC):
+    @abc.abstractmethod
+    def get_merchants(self) -> List[model.Merchant]:
+        ...
+
+    @abc.abstractmethod
+    def find_merchant(self, merchant_id: str) -> Optional[model.Merchant]:
+        ...
+
+    async def find_merchant_async(self, merchant_id: str) -> Optional[model.Merchant]:
+        return await asyncio.to_thread(self.find_merchant, merchant_id)
+
+
+class PostgresMerchantRepository(MerchantRepository):
+    def __init__(self, pool: Optional[database.ConnectionPool] = None) -> None:
+        self._pool = pool or database.get_pool()
+
+    @database.timed_repository("merchants", "get_merchants")
+    def get_merchants(self) -> List[model.Merchant]:
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT merchant_id, status FROM merchants")
+                rows = cursor.fetchall()
+                cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="merchants", method="get_merchants", error=error)
+            raise
+        return [self._row_to_merchant(row) for row in rows]
+
+    @database.timed_repository("merchants", "find_merchant")
+    def find_merchant(self, merchant_id: str) -> Optional[model.Merchant]:
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT merchant_id, status FROM merchants WHERE merchant_id = %s", (merchant_id,))
+                row = cursor.fetchone()
+                cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="merchants", method="find_merchant", error=error)
+            raise
+        return self._row_to_merchant(row) if row else None
+
+    @staticmethod
+    def _row_to_merchant(row: tuple) -> model.Merchant:
+        # Any status other than ACTIVE, or none, keeps the merchant from taking payments.
+        status = model.MerchantStatus.ACTIVE if row[1] == model.MerchantStatus.ACTIVE.value \
+            else model.MerchantStatus.INACTIVE
+        return model.Merchant(merchant_id=row[0], status=status)
+
+
+class CachedMerchantRepository(MerchantRepository):
+    """
+    Every merchant in process, so validating the merchant of a payment is a dict lookup.
+
+    ``load`` reads them all at once. A merchant is read again when a change notification names it, or once its
+    entry is ``ttl_seconds`` old in case a notification was missed. An unknown merchant id is remembered as such for
+    ``unknown_ttl_seconds``, so repeated payments for it do not reach the database every time.
+
+    Every notification bumps the version of its merchant: reads share a query only with reads of the same version,
+    and a read that started before the change never replaces what was read after it.
+    """
+
+    def __init__(self, repository: MerchantRepository, ttl_seconds: float = 300.0,
+                 unknown_ttl_seconds: float = 5.0, max_unknown: int = 10000,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self._repository = repository
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._merchants: Dict[str, Tuple[float, model.Merchant]] = {}
+        self._unknown: cache.TTLCache[str, bool] = cache.TTLCache(max_size=max_unknown, ttl_seconds=unknown_ttl_seconds,
+                                                                  clock=clock)
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._reads: cache.SingleFlight[Tuple[str, int], Optional[model.Merchant]] = cache.SingleFlight()
+
+    def load(self) -> List[model.Merchant]:
+        merchants = self._repository.get_merchants()
+        expires_at = self._clock() + self._ttl_seconds
+        # Swapped in one assignment, lookups never see a half loaded cache.
+        self._merchants = {merchant.merchant_id: (expires_at, merchant) for merchant in merchants}
+        return merchants
+
+    def get_merchants(self) -> List[model.Merchant]:
+        return [merchant for _, merchant in self._merchants.values()]
+
+    def find_merchant(self, merchant_id: str) -> Optional[model.Merchant]:
+        entry = self._merchants.get(merchant_id)
+        if entry is not None and entry[0] > self._clock():
+            return entry[1]
+        if entry is None and self._unknown.get(merchant_id):
+            return None
+        return self._read(merchant_id)
+
+    async def find_merchant_async(self, merchant_id: str) -> Optional[model.Merchant]:
+        entry = self._merchants.get(merchant_id)
+        if entry is not None and entry[0] > self._clock():
+            return entry[1]
+        if entry is None and self._unknown.get(merchant_id):
+            return None
+        return await asyncio.to_thread(self._read, merchant_id)
+
+    def refresh(self, merchant_id: str) -> Optional[model.Merchant]:
+        """
+        Forgets the merchant named by a change notification and reads it again, without joining a read that may
+        have started before the change was committed.
+        """
+        with self._lock:
+            self._versions[merchant_id] = self._versions.get(merchant_id, 0) + 1
+            self._merchants.pop(merchant_id, None)
+            self._unknown.invalidate(merchant_id)
+        return self._read(merchant_id)
+
+    def _read(self, merchant_id: str) -> Optional[model.Merchant]:
+        version = self._versions.get(merchant_id, 0)
+        return self._reads.do((merchant_id, version), lambda: self._remember(
+            merchant_id, version, self._repository.find_merchant(merchant_id)))
+
+    def _remember(self, merchant_id: str, version: int,
+                  merchant: Optional[model.Merchant]) -> Optional[model.Merchant]:
+        with self._lock:
+            if self._versions.get(merchant_id, 0) != version:
+                # Changed while it was read, the read of the newer version is remembered instead.
+                return merchant
+            if merchant is None:
+                self._merchants.pop(merchant_id, None)
+                self._unknown.set(merchant_id, True)
+            else:
+                self._merchants[merchant_id] = (self._clock() + self._ttl_seconds, merchant)
+                self._unknown.invalidate(merchant_id)
+        return merchant
+
+
+# The merchants trigger notifies this channel with the merchant_id of every inserted, updated or deleted merchant.
+MERCHANT_CHANGES_CHANNEL = "merchant_changes"
+
+_MERCHANTS: Optional[CachedMerchantRepository] = None
+_MERCHANTS_LISTENER: Optional[notifications.NotificationListener] = None
+
+
+def get_merchant_repository() -> CachedMerchantRepository:
+    """
+    Returns the merchant cache of the worker process, its entries live ``CHECKOUT_MERCHANT_CACHE_TTL_SECONDS``.
+    """
+    global _MERCHANTS
+    if _MERCHANTS is None:
+        _MERCHANTS = CachedMerchantRepository(
+            repository=PostgresMerchantRepository(),
+            ttl_seconds=float(os.environ.get("CHECKOUT_MERCHANT_CACHE_TTL_SECONDS", "300")))
+    return _MERCHANTS
+
+
+def start_merchant_cache() -> None:
+    """
+    Loads every merchant and, unless ``CHECKOUT_MERCHANT_CACHE_LISTEN`` is ``0``, listens to their changes. Without a
+    database the merchants are read on demand, the listener keeps trying to connect and loads them all again on every
+    connection, as changes may have been missed. Without the listener, changes are seen once entries expire.
+    """
+    global _MERCHANTS_LISTENER
+    merchants = get_merchant_repository()
+    try:
+        merchants.load()
+    except Exception as error:
+        _LOGGER.warning("merchant_cache_load_failed", error=error)
+    listen = os.environ.get("CHECKOUT_MERCHANT_CACHE_LISTEN", "1").lower() not in ("0", "false")
+    if listen and _MERCHANTS_LISTENER is None:
+        _MERCHANTS_LISTENER = notifications.NotificationListener(
+            channel=MERCHANT_CHANGES_CHANNEL, on_notification=merchants.refresh, on_connect=merchants.load)
+        _MERCHANTS_LISTENER.start()
+
+
+def stop_merchant_cache() -> None:
+    global _MERCHANTS_LISTENER
+    if _MERCHANTS_LISTENER is not None:
+        _MERCHANTS_LISTENER.stop()
+        _MERCHANTS_LISTENER = None
+
+
+# IDEMPOTENCY STORE #########################################
+class IdempotencyRecord(pydantic.BaseModel):
+    merchant_id: str
+    idempotency_key: str
+    fingerprint: str
+    response: Optional[str] = None
+    """JSON of the payment response, absent while the payment is being processed."""
+
+
+class IdempotencyStore(abc.ABC):
+
+    @abc.abstractmethod
+    def claim(self, record: IdempotencyRecord) -> Optional[IdempotencyRecord]:
+        """
+        Stores the record unless its key is already taken.
+        :return: ``None`` when the key was claimed, the record holding the key otherwise.
+        """
+
+    @abc.abstractmethod
+    def find(self, merchant_id: str, idempotency_key: str) -> Optional[IdempotencyRecord]:
+        ...
+
+    @abc.abstractmethod
+    def complete(self, record: IdempotencyRecord) -> IdempotencyRecord:
+        """
+        Stores the response of a claimed key.
+        """
+
+    @abc.abstractmethod
+    def release(self, merchant_id: str, idempotency_key: str) -> None:
+        """
+        Frees a claimed key that has no response, so the request can be retried with it.
+        """
+
+    async def claim_async(self, record: IdempotencyRecord) -> Optional[IdempotencyRecord]:
+        return await asyncio.to_thread(self.claim, record)
+
+    async def find_async(self, merchant_id: str, idempotency_key: str) -> Optional[IdempotencyRecord]:
+        return await asyncio.to_thread(self.find, merchant_id, idempotency_key)
+
+    async def complete_async(self, record: IdempotencyRecord) -> IdempotencyRecord:
+        return await asyncio.to_thread(self.complete, record)
+
+    async def release_async(self, merchant_id: str, idempotency_key: str) -> None:
+        await asyncio.to_thread(self.release, merchant_id, idempotency_key)
+
+
+class PostgresIdempotencyStore(IdempotencyStore):
+    """
+    Keys are kept ``ttl_seconds`` after they are claimed, ``delete_expired`` deletes them afterwards.
+    """
+
+    def __init__(self, pool: Optional[database.ConnectionPool] = None, ttl_seconds: Optional[float] = None) -> None:
+        self._pool = pool or database.get_pool()
+        self._ttl_ns = int(1e9 * (ttl_seconds if ttl_seconds is not None
+                                  else float(os.environ.get("CHECKOUT_IDEMPOTENCY_KEY_TTL_SECONDS", "86400"))))
+
+    @database.timed_repository("idempotency_keys", "claim")
+    def claim(self, record: IdempotencyRecord) -> Optional[IdempotencyRecord]:
+        # A single statement: the no-op update of a taken key locks and answers its row, so there is no window
+        # where the holder could release the key between a failed insert and the read of the holder.
+        now = helpers.time_ns()
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                        INSERT INTO idempotency_keys (merchant_id, idempotency_key, fingerprint, created_at,
+                                                      expires_at)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON CONFLICT (merchant_id, idempotency_key)
+                            DO UPDATE SET idempotency_key = EXCLUDED.idempotency_key
+                        RETURNING merchant_id, idempotency_key, fingerprint, response, (xmax = 0) AS claimed
+                    """,
+                    (record.merchant_id, record.idempotency_key, record.fingerprint, now, now + self._ttl_ns))
+                row = cursor.fetchone()
+                conn.commit()
+                cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="idempotency_keys", method="claim", error=error)
+            raise
+        if row[4]:
+            return None
+        return IdempotencyRecord(merchant_id=row[0], idempotency_key=row[1], fingerprint=row[2], response=row[3])
+
+    @database.timed_repository("idempotency_keys", "find")
+    def find(self, merchant_id: str, idempotency_key: str) -> Optional[IdempotencyRecord]:
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                        SELECT merchant_id, idempotency_key, fingerprint, response
+                        FROM idempotency_keys
+                        WHERE merchant_id = %s AND idempotency_key = %s
+                    """,
+                    (merchant_id, idempotency_key))
+                row = cursor.fetchone()
+                cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="idempotency_keys", method="find", error=error)
+            raise
+        if row is None:
+            return None
+        return IdempotencyRecord(merchant_id=row[0], idempotency_key=row[1], fingerprint=row[2], response=row[3])
+
+    @database.timed_repository("idempotency_keys", "complete")
+    def complete(self, record: IdempotencyRecord) -> IdempotencyRecord:
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                        UPDATE idempotency_keys SET response = %s
+                        WHERE merchant_id = %s AND idempotency_key = %s
+                    """,
+                    (record.response, record.merchant_id, record.idempotency_key))
+                conn.commit()
+                cursor.close()
+                return record
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="idempotency_keys", method="complete", error=error)
+            raise
+
+    @database.timed_repository("idempotency_keys", "release")
+    def release(self, merchant_id: str, idempotency_key: str) -> None:
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                        DELETE FROM idempotency_keys
+                        WHERE merchant_id = %s AND idempotency_key = %s AND response IS NULL
+                    """,
+                    (merchant_id, idempotency_key))
+                conn.commit()
+                cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="idempotency_keys", method="release", error=error)
+            raise
+
+    @database.timed_repository("idempotency_keys", "delete_expired")
+    def delete_expired(self, now: int, limit: int) -> int:
+        """
+        Deletes at most ``limit`` keys that expired before ``now``, in one short transaction.
+        :return: the number of keys deleted.
+        """
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                        DELETE FROM idempotency_keys
+                        WHERE ctid IN (SELECT ctid FROM idempotency_keys WHERE expires_at < %s LIMIT %s)
+                        RETURNING merchant_id
+                    """,
+                    (now, limit))
+                deleted = len(cursor.fetchall())
+                conn.commit()
+                cursor.close()
+                return deleted
+        except (Exception, psycopg2.DatabaseError) as error:
+            _LOGGER.error("query_failed", repository="idempotency_keys", method="delete_expired", error=error)
+            raise
+
+
+class CachedIdempotencyStore(IdempotencyStore):
+    """
+    Keeps the completed records in process, so a retried payment is answered without reaching the database.
+    Records still being processed are never cached, they are about to change.
+    """
+
+    def __init__(self, store: IdempotencyStore, max_size: int = 10000, ttl_seconds: float = 3600.0) -> None:
+        self._store = store
+        self._cache: cache.TTLCache[Tuple[str, str], IdempotencyRecord] = cache.TTLCache(
+            max_size=max_size, ttl_seconds=ttl_seconds)
+
+    def claim(self, record: IdempotencyRecord) -> Optional[IdempotencyRecord]:
+        cached = self._cache.get((record.merchant_id, record.idempotency_key))
+        if cached is not None:
+            return cached
+        return self._remember(self._store.claim(record))
+
+    def find(self, merchant_id: str, idempotency_key: str) -> Optional[IdempotencyRecord]:
+        cached = self._cache.get((merchant_id, idempotency_key))
+        if cached is not None:
+            return cached
+        return self._remember(self._store.find(merchant_id=merchant_id, idempotency_key=idempotency_key))
+
+    def complete(self, record: IdempotencyRecord) -> IdempotencyRecord:
+        return self._remember(self._store.complete(record))
+
+    def release(self, merchant_id: str, idempotency_key: str) -> None:
+        self._store.release(merchant_id=merchant_id, idempotency_key=idempotency_key)
+
+    async def claim_async(self, record: IdempotencyRecord) -> Optional[IdempotencyRecord]:
+        cached = self._cache.get((record.merchant_id, record.idempotency_key))
+        if cached is not None:
+            return cached
+        return self._remember(await self._store.claim_async(record))
+
+    async def find_async(self, merchant_id: str, idempotency_key: str) -> Optional[IdempotencyRecord]:
+        cached = self._cache.get((merchant_id, idempotency_key))
+        if cached is not None:
+            return cached
+        return self._remember(await self._store.find_async(merchant_id=merchant_id, idempotency_key=idempotency_key))
+
+    async def complete_async(self, record: IdempotencyRecord) -> IdempotencyRecord:
+        return self._remember(await self._store.complete_async(record))
+
+    async def release_async(self, merchant_id: str, idempotency_key: str) -> None:
+        await self._store.release_async(merchant_id=merchant_id, idempotency_key=idempotency_key)
+
+    def _remember(self, record: Optional[IdempotencyRecord]) -> Optional[IdempotencyRecord]:
+        if record is not None and record.response is not None:
+            self._cache.set((record.merchant_id, record.idempotency_key), record)
+        return record
+
+
+_IDEMPOTENCY_STORE: Optional[IdempotencyStore] = None
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """
+    Returns the idempotency store of the worker process, its cache is shared by every request.
+    """
+    global _IDEMPOTENCY_STORE
+    if _IDEMPOTENCY_STORE is None:
+        _IDEMPOTENCY_STORE = CachedIdempotencyStore(store=PostgresIdempotencyStore())
+    return _IDEMPOTENCY_STORE
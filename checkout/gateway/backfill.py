@@ -0,0 +1,74 @@
+"""
+Rebuilds the payment totals that merchant summaries are answered from, out of the payments of the database configured
+by the POSTGRES_* variables. Run it once after migration 0005 to count the payments written before it, or to repair
+the totals of some merchants.
+
+    python -m checkout.gateway.backfill
+    python -m checkout.gateway.backfill --merchant 42 --since 2024-01-01 --until 2024-03-31 --chunk-days 7
+
+Every chunk of ``--chunk-days`` days of a merchant is rebuilt in its own transaction, payments of that merchant wait
+for it to commit, so it can run while the gateway takes payments.
+"""
+import argparse
+import datetime
+from typing import Iterable, Iterator, Optional, Tuple
+
+from checkout.gateway import adapters
+from checkout.infrastructure import log
+
+_LOGGER = log.get_logger(__name__)
+
+DEFAULT_CHUNK_DAYS: int = 31
+
+
+def chunk_days(since: datetime.date, until: datetime.date,
+               days: int) -> Iterator[Tuple[datetime.date, datetime.date]]:
+    """
+    Splits the days from ``since`` to ``until`` inclusive in ranges of at most ``days`` days.
+    """
+    if days < 1:
+        raise ValueError("A chunk must span at least one day")
+    while since <= until:
+        last = min(until, since + datetime.timedelta(days=days - 1))
+        yield since, last
+        since = last + datetime.timedelta(days=1)
+
+
+def backfill_payment_totals(totals: adapters.PaymentTotalsRepository, merchant_ids: Iterable[str],
+                            since: Optional[datetime.date] = None, until: Optional[datetime.date] = None,
+                            days: int = DEFAULT_CHUNK_DAYS) -> int:
+    """
+    Rebuilds the totals of every merchant from ``since`` to ``until``, by default from its first to its last
+    payment. :return: the number of chunks rebuilt.
+    """
+    rebuilt = 0
+    for merchant_id in merchant_ids:
+        payment_days = totals.get_payment_days(merchant_id=merchant_id)
+        if payment_days is None and (since is None or until is None):
+            continue
+        first = since or payment_days[0]
+        last = until or payment_days[1]
+        for chunk_since, chunk_until in chunk_days(first, last, days=days):
+            totals.rebuild_daily_totals(merchant_id=merchant_id, since=chunk_since, until=chunk_until)
+            rebuilt += 1
+        _LOGGER.info("payment_totals_rebuilt", merchant_id=merchant_id, since=first, until=last)
+    return rebuilt
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--merchant", action="append", dest="merchants", help="every merchant when not given")
+    parser.add_argument("--since", type=datetime.date.fromisoformat, default=None)
+    parser.add_argument("--until", type=datetime.date.fromisoformat, default=None)
+    parser.add_argument("--chunk-days", type=int, default=DEFAULT_CHUNK_DAYS)
+    args = parser.parse_args()
+
+    merchant_ids = args.merchants or [merchant.merchant_id
+                                      for merchant in adapters.PostgresMerchantRepository().get_merchants()]
+    rebuilt = backfill_payment_totals(totals=adapters.PostgresPaymentTotalsRepository(), merchant_ids=merchant_ids,
+                                      since=args.since, until=args.until, days=args.chunk_days)
+    print(f"rebuilt {rebuilt} chunks of {len(merchant_ids)} merchants")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Deletes the idempotency keys that expired, from the database configured by the POSTGRES_* variables. A key expires
+``CHECKOUT_IDEMPOTENCY_KEY_TTL_SECONDS`` after it is claimed, schedule this to keep the table from growing forever.
+
+    python -m checkout.gateway.cleanup
+    python -m checkout.gateway.cleanup --batch-size 1000
+
+Keys are deleted ``--batch-size`` at a time, each batch in its own short transaction, so it can run while the
+gateway takes payments.
+"""
+import argparse
+
+from checkout.gateway import adapters
+from checkout.infrastructure import log
+from checkout.standard_types import helpers
+
+_LOGGER = log.get_logger(__name__)
+
+DEFAULT_BATCH_SIZE: int = 5000
+
+
+def delete_expired_idempotency_keys(store: adapters.PostgresIdempotencyStore,
+                                    batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """
+    Deletes the keys that expired before the cleanup started. :return: the number of keys deleted.
+    """
+    now = helpers.time_ns()
+    deleted = 0
+    while True:
+        batch = store.delete_expired(now=now, limit=batch_size)
+        deleted += batch
+        if batch < batch_size:
+            break
+    _LOGGER.info("idempotency_keys_deleted", deleted=deleted)
+    return deleted
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    deleted = delete_expired_idempotency_keys(store=adapters.PostgresIdempotencyStore(), batch_size=args.batch_size)
+    print(f"deleted {deleted} expired idempotency keys")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,99 @@
-from typing import List
+import datetime
+import os
+from typing import Optional
 
 import fastapi
+import fastapi.responses
 from fastapi import FastAPI
 
+from checkout.card_processing import adapters as card_processing_adapters
 from checkout.gateway import services, adapters
+from checkout.infrastructure import database, deadline, log, metrics, write_behind
+
+_LOGGER = log.get_logger(__name__)
 
 app = FastAPI()
 
+# Time a payment has to be answered in, a sale still going on by then is answered as PENDING.
+PAYMENT_DEADLINE_SECONDS: float = float(os.environ.get("CHECKOUT_PAYMENT_DEADLINE_SECONDS", "10"))
+
+app.add_middleware(metrics.RouteMetrics)
+
+if os.environ.get("CHECKOUT_TRAFFIC_RECORD_FILE"):
+    from checkout.gateway import recording
+
+    app.add_middleware(recording.TrafficRecorder, path=os.environ["CHECKOUT_TRAFFIC_RECORD_FILE"])
+
+
+@app.on_event("startup")
+def apply_migrations() -> None:
+    if os.environ.get("CHECKOUT_MIGRATE_ON_STARTUP", "").lower() in ("1", "true"):
+        # Imported here, a cold start without migrations to apply does not pay for the runner.
+        from checkout.infrastructure.migrations import runner
+
+        runner.migrate()
+
+
+@app.on_event("startup")
+def warmup_on_startup() -> None:
+    if os.environ.get("CHECKOUT_WARMUP_ON_STARTUP", "").lower() in ("1", "true"):
+        warmup()
+
+
+def warmup() -> None:
+    """
+    Builds ahead of the first request what it would otherwise build: the OpenAPI schema with the examples of the
+    request models, the singletons of the worker and the connections of the pool. A database that cannot be reached
+    is logged, the first payment tries again.
+    """
+    app.openapi()
+    card_processing_adapters.get_account_range_provider()
+    card_processing_adapters.get_transaction_router()
+    adapters.get_idempotency_store()
+    adapters.get_merchant_repository()
+    try:
+        database.get_pool().warmup()
+    except Exception as error:
+        _LOGGER.warning("pool_warmup_failed", error=error)
+
+
+@app.on_event("startup")
+def start_write_behind() -> None:
+    write_behind.start_write_behind()
+
+
+@app.on_event("shutdown")
+def stop_write_behind() -> None:
+    write_behind.stop_write_behind()
+
+
+@app.on_event("startup")
+def start_merchant_cache() -> None:
+    adapters.start_merchant_cache()
+
+
+@app.on_event("shutdown")
+def stop_merchant_cache() -> None:
+    adapters.stop_merchant_cache()
+
+
+@app.on_event("startup")
+def start_metrics_publishing() -> None:
+    metrics.start_publishing()
+
+
+@app.on_event("shutdown")
+def stop_metrics_publishing() -> None:
+    metrics.stop_publishing()
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics() -> fastapi.Response:
+    """
+    Prometheus metrics of every worker when they share `CHECKOUT_METRICS_DIR`, of the worker answering otherwise.
+    """
+    return fastapi.Response(content=metrics.REGISTRY.exposition(), media_type=metrics.CONTENT_TYPE)
+
 
 #
 #
@@ -22,45 +109,158 @@ app = FastAPI()
 
 @app.post("/v1/payments",
           summary="Makes a payment with the usage of the payment provider services.")
-async def make_payment(request: services.PaymentRequest) -> services.PaymentResponse:
+async def make_payment(
+        request: services.PaymentRequest,
+        idempotency_key: Optional[str] = fastapi.Header(
+            default=None, alias="Idempotency-Key", min_length=1, max_length=255)) -> services.PaymentResponse:
     """
     Cards:
     - 4444444444444444 rejects
     - 5555555555555555 rejects,
     - any other causes an approval ex.: 3333111122223333
+
+    Retrying with the same `Idempotency-Key` header returns the response of the first request instead of paying
+    again. Reusing a key with a different request is rejected with a 422.
+
+    A payment not settled within `CHECKOUT_PAYMENT_DEADLINE_SECONDS` is answered as `PENDING`, one for an unknown
+    or inactive merchant is rejected with a 422 without being recorded.
     """
-    return services.process_payment(
-        request=request,
-        repository=adapters.PostgresCardNotPresentPaymentRepository(),
-        processor=adapters.FlashyCardNotPresentProvider()
-    )
+    with deadline.scope(PAYMENT_DEADLINE_SECONDS):
+        unit_of_work = write_behind.create_unit_of_work()
+        repository = adapters.CachedCardNotPresentPaymentRepository(
+            repository=adapters.PostgresCardNotPresentPaymentRepository(unit_of_work=unit_of_work),
+            unit_of_work=unit_of_work)
+        processor = adapters.FlashyCardNotPresentProvider(unit_of_work=unit_of_work)
+        try:
+            if idempotency_key is None:
+                return await services.process_payment_async(
+                    request=request,
+                    repository=repository,
+                    processor=processor,
+                    unit_of_work=unit_of_work,
+                    merchants=adapters.get_merchant_repository(),
+                )
+
+            return await services.process_payment_idempotently_async(
+                request=request,
+                idempotency_key=idempotency_key,
+                repository=repository,
+                processor=processor,
+                idempotency_store=adapters.get_idempotency_store(),
+                unit_of_work=unit_of_work,
+                merchants=adapters.get_merchant_repository(),
+            )
+        except (services.UnknownMerchantError, services.InactiveMerchantError) as error:
+            raise fastapi.HTTPException(status_code=422, detail=str(error))
+        except services.IdempotencyKeyReusedError as error:
+            raise fastapi.HTTPException(status_code=422, detail=error.message)
+        except services.IdempotencyKeyInProgressError as error:
+            raise fastapi.HTTPException(status_code=409, detail=error.message)
 
 
-@app.get("/v1/merchants/{merchant_id}/payments")
-async def get_payment(merchant_id: str) -> List[services.GetPaymentResponse]:
+@app.post("/v1/payments/batch",
+          summary="Makes a batch of payments with the usage of the payment provider services.")
+async def make_payments(request: services.BatchPaymentRequest) -> services.BatchPaymentResponse:
     """
-    Get a payment from a merchant.
+    Processes up to 500 payments concurrently, answering each one in the order of the request.
+    A payment that could not be processed is answered as PENDING without failing the batch.
+    A payment for an unknown or inactive merchant is answered as REJECTED with response code F97, without a
+    `payment_id` since nothing is recorded, and the rest of the batch goes on.
+
+    The batch has `CHECKOUT_PAYMENT_DEADLINE_SECONDS` to complete, a payment not settled by then is answered as
+    `PENDING`.
     """
-    return services.get_payments(
-        merchant_id=merchant_id,
-        repository=adapters.PostgresCardNotPresentPaymentRepository()
-    )
+    with deadline.scope(PAYMENT_DEADLINE_SECONDS):
+        return await services.process_payments_async(
+            request=request,
+            repository=adapters.CachedCardNotPresentPaymentRepository(
+                repository=adapters.PostgresCardNotPresentPaymentRepository()),
+            processor=adapters.FlashyCardNotPresentProvider(),
+            merchants=adapters.get_merchant_repository(),
+        )
 
 
-@app.get("/v1/merchants/{merchant_id}/payments/{payment_id}")
-async def get_payment(merchant_id: str, payment_id: str) -> services.GetPaymentResponse:
+@app.get("/v1/merchants/{merchant_id}/payments", response_model=services.GetPaymentsResponse)
+def get_payments(
+        merchant_id: str,
+        limit: int = fastapi.Query(services.DEFAULT_PAGE_SIZE, ge=1, le=services.MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+        stream: bool = False,
+        fields: Optional[str] = None) -> fastapi.Response:
+    """
+    Get the payments of a merchant, oldest first.
+    - Pass the returned `next_cursor` as `cursor` to get the next page, it is absent on the last page.
+    - `stream=true` returns every payment as newline delimited JSON instead of a page.
+    - `fields=payment_id,status` returns only those fields of every payment.
+    """
+    repository = adapters.PostgresCardNotPresentPaymentRepository()
+    try:
+        selected_fields = services.parse_fields(fields)
+        if stream:
+            return fastapi.responses.StreamingResponse(
+                services.stream_payment_views(merchant_id=merchant_id, repository=repository,
+                                              fields=selected_fields),
+                media_type="application/x-ndjson")
+
+        return _json_response(services.get_payment_views(
+            merchant_id=merchant_id,
+            repository=repository,
+            fields=selected_fields,
+            limit=limit,
+            cursor=cursor,
+        ))
+    except (services.InvalidCursorError, services.InvalidFieldsError) as error:
+        raise fastapi.HTTPException(status_code=400, detail=error.message)
+
+
+@app.get("/v1/merchants/{merchant_id}/summary")
+def get_merchant_summary(
+        merchant_id: str,
+        since: Optional[datetime.date] = None,
+        until: Optional[datetime.date] = None) -> services.MerchantSummaryResponse:
+    """
+    Get the count and the `total_amount`, `tip` and `vat` sums of the settled payments of a merchant by day,
+    currency and status. Days are UTC.
+    - `since=2024-01-01&until=2024-01-31` returns only the totals of those days.
+    """
+    try:
+        return services.get_merchant_summary(
+            merchant_id=merchant_id,
+            repository=adapters.PostgresPaymentTotalsRepository(),
+            since=since,
+            until=until,
+        )
+    except services.InvalidDateRangeError as error:
+        raise fastapi.HTTPException(status_code=400, detail=error.message)
+
+
+@app.get("/v1/merchants/{merchant_id}/payments/{payment_id}", response_model=services.GetPaymentResponse)
+def get_payment(merchant_id: str, payment_id: str, fields: Optional[str] = None) -> fastapi.Response:
     """
     Get a payment from a merchant.
+    - `fields=payment_id,status` returns only those fields, for clients polling the status.
     """
-    response = services.get_payment(
+    try:
+        selected_fields = services.parse_fields(fields)
+    except services.InvalidFieldsError as error:
+        raise fastapi.HTTPException(status_code=400, detail=error.message)
+
+    response = services.get_payment_view(
         merchant_id=merchant_id,
         payment_id=payment_id,
-        repository=adapters.PostgresCardNotPresentPaymentRepository()
+        repository=adapters.CachedCardNotPresentPaymentRepository(
+            repository=adapters.PostgresCardNotPresentPaymentRepository()),
+        fields=selected_fields,
     )
     if not response:
         raise fastapi.HTTPException(status_code=404, detail="Item not found")
 
-    return response
+    return _json_response(response)
+
+
+def _json_response(content: dict) -> fastapi.Response:
+    # The views are already shaped like the response models, they are not validated again.
+    return fastapi.Response(content=services.encode_json(content), media_type="application/json")
 
 # @app.get("/api/python")
 # def hello_world():
@@ -1,3 +1,4 @@
+import datetime
 import decimal
 import enum
 
@@ -80,3 +81,48 @@ class CardNotPresentPayment(base_types.Aggregate):
             response_code=response_code,
             response_message=response_message,
         )
+
+
+NANOSECONDS_PER_DAY: int = 86_400_000_000_000
+_EPOCH = datetime.date(1970, 1, 1)
+
+
+def payment_day(payment_date: int) -> datetime.date:
+    """
+    UTC day of a ``payment_date``, which is in nanoseconds since the epoch.
+    """
+    return _EPOCH + datetime.timedelta(days=payment_date // NANOSECONDS_PER_DAY)
+
+
+def day_start(day: datetime.date) -> int:
+    """
+    ``payment_date`` of the first nanosecond of the UTC day.
+    """
+    return (day - _EPOCH).days * NANOSECONDS_PER_DAY
+
+
+class PaymentTotals(base_types.ValueObjet):
+    """
+    Totals of the payments of a merchant settled with ``status``, dated on ``day`` and in ``currency``.
+    """
+    day: datetime.date
+    currency: money.Currency
+    status: PaymentStatus
+    payments: int
+    total_amount: decimal.Decimal
+    tip: decimal.Decimal
+    vat: decimal.Decimal
+
+
+class MerchantStatus(enum.Enum):
+    ACTIVE = "ACTIVE"
+    INACTIVE = "INACTIVE"
+
+
+class Merchant(base_types.ValueObjet):
+    merchant_id: str
+    status: MerchantStatus
+
+    @property
+    def is_active(self) -> bool:
+        return self.status == MerchantStatus.ACTIVE
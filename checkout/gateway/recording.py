@@ -0,0 +1,98 @@
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# Card numbers the gateway itself documents as test cards, they are recorded as is to keep their outcome.
+TEST_PANS = frozenset({"4444444444444444", "5555555555555555"})
+RECORDED_PATHS = frozenset({"/v1/payments", "/v1/payments/batch"})
+
+
+def sanitize_pan(pan: str) -> str:
+    """
+    Keeps the BIN, that routing depends on, and the last four digits, that are printed on receipts anyway,
+    and zeroes the rest.
+    """
+    if pan in TEST_PANS or len(pan) <= 10:
+        return pan
+    return pan[:6] + "0" * (len(pan) - 10) + pan[-4:]
+
+
+def sanitize_payment(payment: Dict[str, Any]) -> Dict[str, Any]:
+    card = payment.get("card")
+    if not isinstance(card, dict):
+        return payment
+    return {**payment, "card": {**card,
+                                "pan": sanitize_pan(str(card.get("pan", ""))),
+                                "cvv": "000",
+                                "cardholder_name": "TEST CARDHOLDER"}}
+
+
+def sanitize_body(path: str, body: bytes) -> Optional[Any]:
+    """
+    Returns the sanitized JSON of a payment request, ``None`` when the body is not JSON and cannot be recorded
+    without leaking the card.
+    """
+    try:
+        content = json.loads(body)
+    except ValueError:
+        return None
+    if path == "/v1/payments/batch" and isinstance(content, dict) and isinstance(content.get("payments"), list):
+        return {**content, "payments": [sanitize_payment(payment) if isinstance(payment, dict) else payment
+                                        for payment in content["payments"]]}
+    return sanitize_payment(content) if isinstance(content, dict) else None
+
+
+class TrafficRecorder:
+    """
+    ASGI middleware appending every payment request, with its card sanitized, to a JSON lines file that
+    ``benchmark.replay`` plays back. Each line holds when the request arrived, relative to the first one, its
+    path, its ``Idempotency-Key`` and its body. Meant for test environments: the file is written from the event
+    loop.
+    """
+
+    def __init__(self, app: Callable, path: str, clock: Callable[[], float] = time.monotonic) -> None:
+        self.app = app
+        self._path = path
+        self._clock = clock
+        self._started: Optional[float] = None
+        self._lock = threading.Lock()
+        self.recorded = 0
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in RECORDED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        arrived = self._clock()
+        chunks: List[bytes] = []
+
+        async def recording_receive() -> Dict[str, Any]:
+            message = await receive()
+            if message["type"] == "http.request":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    self._record(scope=scope, arrived=arrived, body=b"".join(chunks))
+            return message
+
+        await self.app(scope, recording_receive, send)
+
+    def _record(self, scope: Dict[str, Any], arrived: float, body: bytes) -> None:
+        content = sanitize_body(path=scope["path"], body=body)
+        if content is None:
+            return
+        headers = dict(scope.get("headers", ()))
+        idempotency_key = headers.get(b"idempotency-key")
+        with self._lock:
+            if self._started is None:
+                self._started = arrived
+            line = json.dumps({
+                "offset_seconds": round(arrived - self._started, 6),
+                "method": "POST",
+                "path": scope["path"],
+                "idempotency_key": idempotency_key.decode() if idempotency_key is not None else None,
+                "body": content,
+            }, separators=(",", ":"))
+            with open(self._path, "a") as recording:
+                recording.write(line + "\n")
+            self.recorded += 1
@@ -1,12 +1,23 @@
+import asyncio
+import base64
+import datetime
 import decimal
 import enum
-from typing import Optional, List
+import hashlib
+import json
+import time
+from collections.abc import Iterator
+from typing import Any, Dict, Optional, List, Tuple
 
 import pydantic
+import pydantic_core
 
 from checkout.gateway import adapters, model
+from checkout.infrastructure import cache, database, deadline, log
 from checkout.standard_types import money, card
 
+_LOGGER = log.get_logger(__name__)
+
 
 class CardRequest(pydantic.BaseModel):
     cardholder_name: str
@@ -78,6 +89,7 @@ class PaymentStatus(enum.Enum):
     PENDING = "PENDING"
     APPROVED = "APPROVED"
     REJECTED = "REJECTED"
+    VOIDED = "VOIDED"
 
 
 class PaymentResponse(pydantic.BaseModel):
@@ -88,6 +100,18 @@ class PaymentResponse(pydantic.BaseModel):
     approval_code: str = ""
 
 
+MAX_BATCH_SIZE: int = 500
+BATCH_CONCURRENCY: int = 32
+
+
+class BatchPaymentRequest(pydantic.BaseModel):
+    payments: List[PaymentRequest] = pydantic.Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+
+class BatchPaymentResponse(pydantic.BaseModel):
+    payments: List[PaymentResponse]
+
+
 class GetPaymentResponse(pydantic.BaseModel):
     payment_id: str
     currency: money.Currency
@@ -98,24 +122,97 @@ class GetPaymentResponse(pydantic.BaseModel):
     status: PaymentStatus
 
 
+class GetPaymentsResponse(pydantic.BaseModel):
+    payments: List[GetPaymentResponse]
+    next_cursor: Optional[str] = None
+
+
+class PaymentTotalsResponse(pydantic.BaseModel):
+    day: datetime.date
+    currency: money.Currency
+    status: PaymentStatus
+    payments: int
+    total_amount: decimal.Decimal
+    tip: decimal.Decimal
+    vat: decimal.Decimal
+
+
+class MerchantSummaryResponse(pydantic.BaseModel):
+    merchant_id: str
+    totals: List[PaymentTotalsResponse]
+
+
 class PaymentNotFoundError(Exception):
     message: str = "Payment not found"
 
 
+class InvalidCursorError(Exception):
+    message: str = "The cursor is not valid"
+
+
+DEFAULT_PAGE_SIZE: int = 100
+MAX_PAGE_SIZE: int = 1000
+
+
+class InvalidFieldsError(Exception):
+    message: str = "Unknown payment fields requested"
+
+
+PAYMENT_FIELDS: Tuple[str, ...] = tuple(GetPaymentResponse.model_fields)
+
+
+class InvalidDateRangeError(Exception):
+    message: str = "since must not be after until"
+
+
+class UnknownMerchantError(Exception):
+    message: str = "The merchant does not exist"
+
+
+class InactiveMerchantError(Exception):
+    message: str = "The merchant is not active"
+
+
+# Answers a payment of a batch whose merchant is unknown or not active.
+MERCHANT_REFUSED_RESPONSE_CODE: str = "F97"
+
+
+class IdempotencyKeyReusedError(Exception):
+    message: str = "The Idempotency-Key was already used with a different request"
+
+
+class IdempotencyKeyInProgressError(Exception):
+    message: str = "A request with the same Idempotency-Key is still being processed"
+
+
+IDEMPOTENCY_WAIT_SECONDS: float = 5.0
+IDEMPOTENCY_POLL_SECONDS: float = 0.05
+_IDEMPOTENT_PAYMENTS: cache.AsyncSingleFlight = cache.AsyncSingleFlight()
+
+
 def get_payments(
         merchant_id: str,
-        repository: adapters.CardNotPresentPaymentRepository) -> List[GetPaymentResponse]:
-    payments = repository.get_payments(merchant_id=merchant_id)
+        repository: adapters.CardNotPresentPaymentRepository,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None) -> GetPaymentsResponse:
+    payments = repository.get_payments(merchant_id=merchant_id, limit=limit + 1, after=_decode_cursor(cursor))
 
-    return [GetPaymentResponse(
-        payment_id=payment.payment_id,
-        currency=payment.currency,
-        total_amount=payment.total_amount,
-        tip=payment.tip,
-        vat=payment.vat,
-        last_four_digits=payment.card.masked_pan[-4:],
-        status=PaymentStatus[payment.status.value],
-    ) for payment in payments]
+    next_cursor = _encode_cursor(payment_date=payments[limit - 1].payment_date,
+                                 payment_id=payments[limit - 1].payment_id) if len(payments) > limit else None
+    return GetPaymentsResponse(
+        payments=[_map_payment_to_response(payment) for payment in payments[:limit]],
+        next_cursor=next_cursor,
+    )
+
+
+def stream_payments(
+        merchant_id: str,
+        repository: adapters.CardNotPresentPaymentRepository) -> Iterator[str]:
+    """
+    Yields every payment of the merchant as newline delimited JSON, one payment per line.
+    """
+    for payment in repository.iter_payments(merchant_id=merchant_id):
+        yield _map_payment_to_response(payment).model_dump_json() + "\n"
 
 
 def get_payment(
@@ -124,6 +221,83 @@ def get_payment(
     payment: model.CardNotPresentPayment = repository.find_payment(merchant_id=merchant_id, payment_id=payment_id)
     if not payment:
         return None
+    return _map_payment_to_response(payment)
+
+
+def get_merchant_summary(
+        merchant_id: str,
+        repository: adapters.PaymentTotalsRepository,
+        since: Optional[datetime.date] = None,
+        until: Optional[datetime.date] = None) -> MerchantSummaryResponse:
+    """
+    Totals of the merchant's settled payments by day, currency and status. They are read from the totals kept up
+    to date as payments settle, so the answer costs as much for a merchant with millions of payments as for one
+    with a few.
+    """
+    if since is not None and until is not None and since > until:
+        raise InvalidDateRangeError(InvalidDateRangeError.message)
+    return MerchantSummaryResponse(
+        merchant_id=merchant_id,
+        totals=[_map_totals_to_response(totals)
+                for totals in repository.get_daily_totals(merchant_id=merchant_id, since=since, until=until)],
+    )
+
+
+def parse_fields(fields: Optional[str]) -> Tuple[str, ...]:
+    """
+    Parses a comma separated ``fields`` selection, every field of ``GetPaymentResponse`` when not given.
+    """
+    if not fields:
+        return PAYMENT_FIELDS
+    selected = tuple(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+    if not selected or any(field not in PAYMENT_FIELDS for field in selected):
+        raise InvalidFieldsError(InvalidFieldsError.message)
+    return selected
+
+
+def get_payment_views(
+        merchant_id: str,
+        repository: adapters.CardNotPresentPaymentRepository,
+        fields: Tuple[str, ...] = PAYMENT_FIELDS,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None) -> Dict[str, Any]:
+    """
+    ``get_payments`` reading only the columns of ``fields`` and answering plain dicts shaped like
+    ``GetPaymentsResponse``, without building the payments nor validating the responses.
+    """
+    views = repository.get_payment_views(merchant_id=merchant_id, fields=fields, limit=limit + 1,
+                                         after=_decode_cursor(cursor))
+
+    next_cursor = _encode_cursor(payment_date=views[limit - 1].payment_date,
+                                 payment_id=views[limit - 1].payment_id) if len(views) > limit else None
+    return {"payments": [view.fields for view in views[:limit]], "next_cursor": next_cursor}
+
+
+def stream_payment_views(
+        merchant_id: str,
+        repository: adapters.CardNotPresentPaymentRepository,
+        fields: Tuple[str, ...] = PAYMENT_FIELDS) -> Iterator[str]:
+    for view in repository.iter_payment_views(merchant_id=merchant_id, fields=fields):
+        yield encode_json(view.fields) + "\n"
+
+
+def get_payment_view(
+        merchant_id: str, payment_id: str,
+        repository: adapters.CardNotPresentPaymentRepository,
+        fields: Tuple[str, ...] = PAYMENT_FIELDS) -> Optional[Dict[str, Any]]:
+    view = repository.find_payment_view(merchant_id=merchant_id, payment_id=payment_id, fields=fields)
+    return view.fields if view is not None else None
+
+
+def encode_json(content: Any) -> str:
+    """
+    Serializes the views like pydantic serializes the responses, decimals as strings. pydantic-core encodes them
+    natively, where ``json.dumps`` calls back into Python for every decimal.
+    """
+    return pydantic_core.to_json(content).decode()
+
+
+def _map_payment_to_response(payment: model.CardNotPresentPayment) -> GetPaymentResponse:
     return GetPaymentResponse(
         payment_id=payment.payment_id,
         currency=payment.currency,
@@ -135,39 +309,248 @@ def get_payment(
     )
 
 
+def _map_totals_to_response(totals: model.PaymentTotals) -> PaymentTotalsResponse:
+    return PaymentTotalsResponse(
+        day=totals.day,
+        currency=totals.currency,
+        status=PaymentStatus[totals.status.value],
+        payments=totals.payments,
+        total_amount=totals.total_amount,
+        tip=totals.tip,
+        vat=totals.vat,
+    )
+
+
+def _encode_cursor(payment_date: int, payment_id: str) -> str:
+    position = json.dumps([payment_date, payment_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def _decode_cursor(cursor: Optional[str]) -> Optional[adapters.PaymentPosition]:
+    if not cursor:
+        return None
+    try:
+        payment_date, payment_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return adapters.PaymentPosition(payment_date=payment_date, payment_id=payment_id)
+    except (ValueError, TypeError) as error:
+        raise InvalidCursorError(InvalidCursorError.message) from error
+
+
 def process_payment(request: PaymentRequest,
                     repository: adapters.CardNotPresentPaymentRepository,
-                    processor: adapters.CardNotPresentProvider) -> PaymentResponse:
+                    processor: adapters.CardNotPresentProvider,
+                    unit_of_work: database.UnitOfWork = database.ImmediateUnitOfWork(),
+                    merchants: Optional[adapters.MerchantRepository] = None) -> PaymentResponse:
+    """
+    When the repository stages its writes in ``unit_of_work``, the processor must share it: the pending payment
+    is made durable by the processor's flush before the acquirer is reached, and the final state by the commit.
+    A sale cut short by the request deadline leaves the payment PENDING, to be resolved from its transactions.
+    With ``merchants``, a payment for a merchant that is unknown or not active is refused before it is written.
+    """
+    if merchants is not None:
+        _ensure_merchant_can_pay(merchant_id=request.merchant_id,
+                                 merchant=merchants.find_merchant(merchant_id=request.merchant_id))
     payment_id = repository.generate_id()
 
     payment = repository.create_payment(payment=_map_request_to_model(
         payment_id=payment_id, request=request))
 
-    response = processor.sale(
-        transaction=_map_request_to_adapter_transaction(
-            payment_id=payment_id, request=request))
+    try:
+        response = processor.sale(
+            transaction=_map_request_to_adapter_transaction(payment=payment, request=request))
+    except deadline.DeadlineExceededError:
+        with deadline.shielded():
+            unit_of_work.commit()
+        return _map_pending_payment_to_payment_response(payment=payment)
+
+    _apply_transaction_response(payment=payment, response=response)
+    # Once the acquirer answered, its answer is recorded whatever is left of the request deadline.
+    with deadline.shielded():
+        repository.update_payment(payment=payment)
+        unit_of_work.commit()
+    return _map_transaction_response_to_payment_response(payment_id=payment_id, response=response)
+
+
+async def process_payment_async(request: PaymentRequest,
+                                repository: adapters.CardNotPresentPaymentRepository,
+                                processor: adapters.CardNotPresentProvider,
+                                unit_of_work: database.UnitOfWork = database.ImmediateUnitOfWork(),
+                                merchants: Optional[adapters.MerchantRepository] = None) -> PaymentResponse:
+    if merchants is not None:
+        _ensure_merchant_can_pay(merchant_id=request.merchant_id,
+                                 merchant=await merchants.find_merchant_async(merchant_id=request.merchant_id))
+    payment_id = repository.generate_id()
+
+    payment = await repository.create_payment_async(payment=_map_request_to_model(
+        payment_id=payment_id, request=request))
+
+    try:
+        response = await processor.sale_async(
+            transaction=_map_request_to_adapter_transaction(payment=payment, request=request))
+    except deadline.DeadlineExceededError:
+        with deadline.shielded():
+            await unit_of_work.commit_async()
+        return _map_pending_payment_to_payment_response(payment=payment)
+
+    _apply_transaction_response(payment=payment, response=response)
+    with deadline.shielded():
+        await repository.update_payment_async(payment=payment)
+        await unit_of_work.commit_async()
+    return _map_transaction_response_to_payment_response(payment_id=payment_id, response=response)
+
+
+async def process_payment_idempotently_async(
+        request: PaymentRequest,
+        idempotency_key: str,
+        repository: adapters.CardNotPresentPaymentRepository,
+        processor: adapters.CardNotPresentProvider,
+        idempotency_store: adapters.IdempotencyStore,
+        unit_of_work: database.UnitOfWork = database.ImmediateUnitOfWork(),
+        merchants: Optional[adapters.MerchantRepository] = None) -> PaymentResponse:
+    """
+    Processes the payment once per merchant and ``idempotency_key``, a retry gets the stored response back.
+    Duplicates arriving while the payment is processed wait for its response, in process they share the same
+    call. A failed payment frees its key, so it can be retried. A payment cut short by the deadline keeps its key
+    with the PENDING response, which only points to the payment: a retry answers the payment as it is by then.
+    """
+    if merchants is not None:
+        # Checked before claiming the key, a refused merchant does not write anything.
+        _ensure_merchant_can_pay(merchant_id=request.merchant_id,
+                                 merchant=await merchants.find_merchant_async(merchant_id=request.merchant_id))
+    fingerprint = _fingerprint(request=request)
+
+    async def process() -> PaymentResponse:
+        record = adapters.IdempotencyRecord(
+            merchant_id=request.merchant_id, idempotency_key=idempotency_key, fingerprint=fingerprint)
+        holder = await idempotency_store.claim_async(record=record)
+        if holder is not None:
+            return await _wait_for_idempotent_response(record=holder, fingerprint=fingerprint,
+                                                       idempotency_store=idempotency_store, repository=repository)
+        try:
+            response = await process_payment_async(request=request, repository=repository, processor=processor,
+                                                   unit_of_work=unit_of_work)
+        except BaseException:
+            with deadline.shielded():
+                await idempotency_store.release_async(merchant_id=request.merchant_id,
+                                                      idempotency_key=idempotency_key)
+            raise
+        record.response = response.model_dump_json()
+        with deadline.shielded():
+            await idempotency_store.complete_async(record=record)
+        return response
+
+    return await _IDEMPOTENT_PAYMENTS.do((request.merchant_id, idempotency_key, fingerprint), process)
+
+
+async def process_payments_async(request: BatchPaymentRequest,
+                                 repository: adapters.CardNotPresentPaymentRepository,
+                                 processor: adapters.CardNotPresentProvider,
+                                 concurrency: int = BATCH_CONCURRENCY,
+                                 merchants: Optional[adapters.MerchantRepository] = None) -> BatchPaymentResponse:
+    """
+    Processes the payments of the batch concurrently, at most ``concurrency`` sales at a time.
+    The pending payments and their final states are each written in a single round trip. A payment whose sale
+    fails, or is cut short by the request deadline, stays pending and is answered as such, without failing the
+    rest of the batch. A payment for a merchant that is unknown or not active is answered as rejected without
+    being written.
+    """
+    refusals: Dict[str, PaymentResponse] = {}
+    if merchants is not None:
+        for merchant_id in dict.fromkeys(payment_request.merchant_id for payment_request in request.payments):
+            try:
+                _ensure_merchant_can_pay(merchant_id=merchant_id,
+                                         merchant=await merchants.find_merchant_async(merchant_id=merchant_id))
+            except (UnknownMerchantError, InactiveMerchantError) as error:
+                refusals[merchant_id] = _map_refused_merchant_to_payment_response(error=error)
+    accepted = [payment_request for payment_request in request.payments if payment_request.merchant_id not in refusals]
+    payments = [_map_request_to_model(payment_id=repository.generate_id(), request=payment_request)
+                for payment_request in accepted]
+    if payments:
+        await repository.create_payments_async(payments=payments)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def sale(payment: model.CardNotPresentPayment, payment_request: PaymentRequest) -> PaymentResponse:
+        async with semaphore:
+            try:
+                response = await processor.sale_async(
+                    transaction=_map_request_to_adapter_transaction(payment=payment, request=payment_request))
+            except Exception as error:
+                _LOGGER.error("batch_sale_failed", payment_id=payment.payment_id, error=error)
+                return _map_pending_payment_to_payment_response(payment=payment)
+        _apply_transaction_response(payment=payment, response=response)
+        return _map_transaction_response_to_payment_response(payment_id=payment.payment_id, response=response)
+
+    responses = iter(await asyncio.gather(*(sale(payment, payment_request)
+                                            for payment, payment_request in zip(payments, accepted))))
+
+    settled = [payment for payment in payments if payment.status != model.PaymentStatus.PENDING]
+    if settled:
+        # The answers of the acquirers are recorded whatever is left of the request deadline.
+        with deadline.shielded():
+            await repository.update_payments_async(payments=settled)
+    return BatchPaymentResponse(payments=[refusals.get(payment_request.merchant_id) or next(responses)
+                                          for payment_request in request.payments])
+
+
+def _ensure_merchant_can_pay(merchant_id: str, merchant: Optional[model.Merchant]) -> None:
+    if merchant is None:
+        raise UnknownMerchantError(f"{UnknownMerchantError.message}: {merchant_id}")
+    if not merchant.is_active:
+        raise InactiveMerchantError(f"{InactiveMerchantError.message}: {merchant_id}")
+
+
+def _map_refused_merchant_to_payment_response(error: Exception) -> PaymentResponse:
+    # Nothing was recorded, so there is no payment to point to.
+    return PaymentResponse(
+        payment_id="",
+        status=PaymentStatus.REJECTED,
+        response_code=MERCHANT_REFUSED_RESPONSE_CODE,
+        response_message=str(error),
+    )
+
+
+def _apply_transaction_response(payment: model.CardNotPresentPayment,
+                                response: adapters.TransactionResponse) -> None:
     if response.status == adapters.TransactionStatus.APPROVED:
         payment.approve(response_code=response.response_code,
                         response_message=response.response_message,
                         approval_code=response.approval_code)
-        repository.update_payment(payment=payment)
-        return PaymentResponse(
-            payment_id=payment_id,
-            response_code=response.response_code,
-            response_message=response.response_message,
-            approval_code=response.approval_code,
-            status=PaymentStatus.APPROVED
-        )
+        return
 
     payment.reject(response_code=response.response_code,
                    response_message=response.response_message)
-    repository.update_payment(payment=payment)
+
+
+def _map_transaction_response_to_payment_response(
+        payment_id: str, response: adapters.TransactionResponse) -> PaymentResponse:
     return PaymentResponse(
         payment_id=payment_id,
         response_code=response.response_code,
         response_message=response.response_message,
         approval_code=response.approval_code,
-        status=PaymentStatus.REJECTED
+        status=PaymentStatus.APPROVED
+        if response.status == adapters.TransactionStatus.APPROVED else PaymentStatus.REJECTED
+    )
+
+
+def _map_pending_payment_to_payment_response(payment: model.CardNotPresentPayment) -> PaymentResponse:
+    return PaymentResponse(
+        payment_id=payment.payment_id,
+        response_code=payment.receipt.response_code,
+        response_message=payment.receipt.response_message,
+        approval_code=payment.receipt.approval_code,
+        status=PaymentStatus.PENDING
+    )
+
+
+def _map_settled_payment_to_payment_response(payment: model.CardNotPresentPayment) -> PaymentResponse:
+    return PaymentResponse(
+        payment_id=payment.payment_id,
+        response_code=payment.receipt.response_code,
+        response_message=payment.receipt.response_message,
+        approval_code=payment.receipt.approval_code,
+        status=PaymentStatus(payment.status.value)
     )
 
 
@@ -183,9 +566,10 @@ def _map_request_to_model(payment_id: str, request: PaymentRequest) -> model.Car
     )
 
 
-def _map_request_to_adapter_transaction(payment_id: str, request: PaymentRequest) -> adapters.Transaction:
+def _map_request_to_adapter_transaction(payment: model.CardNotPresentPayment,
+                                        request: PaymentRequest) -> adapters.Transaction:
     return adapters.Transaction(
-        client_reference_id=payment_id,
+        client_reference_id=payment.payment_id,
         currency=request.currency,
         merchant_id=request.merchant_id,
         total_amount=request.total_amount,
@@ -195,8 +579,9 @@ def _map_request_to_adapter_transaction(payment_id: str, request: PaymentRequest
             cardholder_name=request.card.cardholder_name,
             expiration_month=request.card.expiration_month,
             expiration_year=request.card.expiration_year,
-            pan=request.card.pan.get_secret_value(),
-            cvv=request.card.cvv.get_secret_value(),
+            pan=request.card.pan,
+            cvv=request.card.cvv,
+            masked_pan=payment.card.masked_pan,
         ),
     )
 
@@ -208,3 +593,48 @@ def _map_request_to_adapter_transaction(payment_id: str, request: PaymentRequest
 #
 # class MerchantResponse:
 #     merchants: List[Merchant]
+
+
+async def _wait_for_idempotent_response(record: adapters.IdempotencyRecord, fingerprint: str,
+                                        idempotency_store: adapters.IdempotencyStore,
+                                        repository: adapters.CardNotPresentPaymentRepository) -> PaymentResponse:
+    wait_until = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        if record.fingerprint != fingerprint:
+            raise IdempotencyKeyReusedError(IdempotencyKeyReusedError.message)
+        if record.response is not None:
+            response = PaymentResponse.model_validate_json(record.response)
+            if response.status == PaymentStatus.PENDING:
+                return await _resolve_pending_idempotent_response(record=record, response=response,
+                                                                  idempotency_store=idempotency_store,
+                                                                  repository=repository)
+            return response
+        if time.monotonic() >= wait_until:
+            raise IdempotencyKeyInProgressError(IdempotencyKeyInProgressError.message)
+        await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+        record = await idempotency_store.find_async(merchant_id=record.merchant_id,
+                                                    idempotency_key=record.idempotency_key)
+        if record is None:
+            # The payment holding the key failed and freed it.
+            raise IdempotencyKeyInProgressError(IdempotencyKeyInProgressError.message)
+
+
+async def _resolve_pending_idempotent_response(record: adapters.IdempotencyRecord, response: PaymentResponse,
+                                              idempotency_store: adapters.IdempotencyStore,
+                                              repository: adapters.CardNotPresentPaymentRepository
+                                              ) -> PaymentResponse:
+    payment = await repository.find_payment_async(merchant_id=record.merchant_id, payment_id=response.payment_id)
+    if payment is None or payment.status == model.PaymentStatus.PENDING:
+        return response
+    # Settled since the key was stored, later retries get the final response without reading the payment.
+    resolved = _map_settled_payment_to_payment_response(payment=payment)
+    record.response = resolved.model_dump_json()
+    await idempotency_store.complete_async(record=record)
+    return resolved
+
+
+def _fingerprint(request: PaymentRequest) -> str:
+    # Stored with the key: a hash of the full PAN could be brute forced from its BIN, and the CVV must not be kept.
+    body = request.model_dump(mode="json", exclude={"card": {"pan", "cvv"}})
+    body["card"]["masked_pan"] = card.PAN.mask(request.card.pan.get_secret_value())
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
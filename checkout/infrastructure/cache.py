@@ -0,0 +1,132 @@
+import asyncio
+import collections
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional, OrderedDict, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """
+    Thread safe, size bounded cache. Entries expire ``ttl_seconds`` after being set and the least recently used
+    one is evicted to make room for a new key.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float, clock: Callable[[], float] = time.monotonic) -> None:
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[K, Tuple[float, V]] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: K, value: V, ttl_seconds: Optional[float] = None) -> None:
+        expires_at = self._clock() + (self._ttl_seconds if ttl_seconds is None else ttl_seconds)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: K) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class AsyncSingleFlight(Generic[K, V]):
+    """
+    Coalesces concurrent calls for the same key: while a call is in flight, callers with the same key await its
+    outcome instead of starting their own.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[K, asyncio.Future] = {}
+
+    async def do(self, key: K, call: Callable[[], Awaitable[V]]) -> V:
+        in_flight = self._calls.get(key)
+        if in_flight is not None:
+            return await asyncio.shield(in_flight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as error:
+            future.set_exception(error)
+            # Retrieved here so an outcome nobody else awaited is not reported as never retrieved.
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    Thread based ``AsyncSingleFlight``: while a call is in flight, threads calling with the same key block
+    until it finishes and get its outcome.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[K, _Call] = {}
+
+    def do(self, key: K, call: Callable[[], V]) -> V:
+        with self._lock:
+            in_flight = self._calls.get(key)
+            if in_flight is None:
+                in_flight = self._calls[key] = _Call()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+
+        try:
+            in_flight.result = call()
+            return in_flight.result
+        except BaseException as error:
+            in_flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            in_flight.done.set()
@@ -0,0 +1,459 @@
+import abc
+import asyncio
+import importlib
+import os
+import threading
+import time
+import types
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pydantic
+
+from checkout.infrastructure import deadline, log, metrics
+
+_LOGGER = log.get_logger(__name__)
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Stands for a module until one of its attributes is read, the module is imported then under the import lock.
+    """
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(importlib.import_module(self.__name__), attribute)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    ``psycopg2 = database.lazy_import("psycopg2")`` keeps the driver out of a cold start, it is imported by the
+    first connection or the first ``except psycopg2.DatabaseError`` reached.
+    """
+    return _LazyModule(name)
+
+
+psycopg2 = lazy_import("psycopg2")
+
+
+class PoolTimeoutError(Exception):
+    message: str = "Timed out waiting for a database connection"
+
+
+class PoolSettings(pydantic.BaseModel):
+    min_size: int = 1
+    max_size: int = 10
+    acquire_timeout_seconds: float = 5.0
+    max_idle_seconds: float = 300.0
+    health_check_after_seconds: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "PoolSettings":
+        defaults = cls()
+        return cls(
+            min_size=int(os.environ.get("POSTGRES_POOL_MIN_SIZE", defaults.min_size)),
+            max_size=int(os.environ.get("POSTGRES_POOL_MAX_SIZE", defaults.max_size)),
+            acquire_timeout_seconds=float(
+                os.environ.get("POSTGRES_POOL_ACQUIRE_TIMEOUT_SECONDS", defaults.acquire_timeout_seconds)),
+            max_idle_seconds=float(os.environ.get("POSTGRES_POOL_MAX_IDLE_SECONDS", defaults.max_idle_seconds)),
+            health_check_after_seconds=float(
+                os.environ.get("POSTGRES_POOL_HEALTH_CHECK_AFTER_SECONDS", defaults.health_check_after_seconds)),
+        )
+
+
+class PoolStats(pydantic.BaseModel):
+    size: int
+    idle: int
+    in_use: int
+    waiting: int
+    acquisitions: int
+    waits: int
+    wait_seconds_total: float
+    wait_seconds_max: float
+    timeouts: int
+    health_check_failures: int
+    reaped: int
+
+
+class _IdleConnection:
+    __slots__ = ("connection", "idle_since")
+
+    def __init__(self, connection: Any, idle_since: float) -> None:
+        self.connection = connection
+        self.idle_since = idle_since
+
+
+def connect_from_env() -> Any:
+    return psycopg2.connect(
+        host=os.environ.get("POSTGRES_HOST"),
+        dbname=os.environ.get("POSTGRES_DATABASE"),
+        user=os.environ.get("POSTGRES_USER"),
+        password=os.environ.get("POSTGRES_PASSWORD"),
+    )
+
+
+class ConnectionPool:
+    """
+    Bounded pool of DB-API connections shared by the repositories of a worker process.
+
+    Connections are opened on demand up to ``max_size``; callers block up to ``acquire_timeout_seconds``
+    once the pool is exhausted. Idle connections are health checked before being handed out again and
+    the ones above ``min_size`` are closed after ``max_idle_seconds``.
+    """
+
+    def __init__(self, settings: PoolSettings, connect: Callable[[], Any] = connect_from_env) -> None:
+        if settings.min_size < 0 or settings.max_size < 1 or settings.min_size > settings.max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1")
+        self._settings = settings
+        self._connect = connect
+        self._condition = threading.Condition()
+        self._idle: List[_IdleConnection] = []
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._acquisitions = 0
+        self._waits = 0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+        self._timeouts = 0
+        self._health_check_failures = 0
+        self._reaped = 0
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """
+        Lends a connection. Under a request deadline, acquiring waits at most the remaining budget and every
+        statement of the transaction is given that budget as its ``statement_timeout``.
+        """
+        budget = deadline.remaining()
+        conn = self._acquire(timeout=budget)
+        try:
+            if budget is not None:
+                cursor = conn.cursor()
+                cursor.execute("SET LOCAL statement_timeout = %s", (max(1, int(budget * 1000)),))
+                cursor.close()
+            yield conn
+        finally:
+            self._release(conn)
+
+    def warmup(self) -> None:
+        """Opens connections until ``min_size`` of them are available."""
+        while True:
+            with self._condition:
+                if self._closed or self._size >= self._settings.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except BaseException:
+                self._forget()
+                raise
+            with self._condition:
+                self._idle.append(_IdleConnection(conn, time.monotonic()))
+                self._condition.notify()
+
+    def stats(self) -> PoolStats:
+        with self._condition:
+            return PoolStats(
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._size - len(self._idle),
+                waiting=self._waiting,
+                acquisitions=self._acquisitions,
+                waits=self._waits,
+                wait_seconds_total=self._wait_seconds_total,
+                wait_seconds_max=self._wait_seconds_max,
+                timeouts=self._timeouts,
+                health_check_failures=self._health_check_failures,
+                reaped=self._reaped,
+            )
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for entry in idle:
+            _close_quietly(entry.connection)
+
+    def _acquire(self, timeout: Optional[float] = None) -> Any:
+        while True:
+            entry = self._checkout(timeout=timeout)
+            if entry is None:
+                try:
+                    return self._connect()
+                except BaseException:
+                    self._forget()
+                    raise
+            if self._is_healthy(entry):
+                return entry.connection
+            self._forget()
+            _close_quietly(entry.connection)
+
+    def _checkout(self, timeout: Optional[float] = None) -> Optional[_IdleConnection]:
+        """Returns an idle connection or ``None`` when the caller was granted a slot to open a new one."""
+        with self._condition:
+            started = time.monotonic()
+            acquire_timeout = self._settings.acquire_timeout_seconds
+            acquire_until = started + (acquire_timeout if timeout is None else min(timeout, acquire_timeout))
+            waited = False
+            while not self._idle and self._size >= self._settings.max_size and not self._closed:
+                remaining = acquire_until - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(PoolTimeoutError.message)
+                waited = True
+                self._waiting += 1
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            if self._closed:
+                raise PoolTimeoutError("The connection pool is closed")
+
+            self._acquisitions += 1
+            if waited:
+                wait_seconds = time.monotonic() - started
+                self._waits += 1
+                self._wait_seconds_total += wait_seconds
+                self._wait_seconds_max = max(self._wait_seconds_max, wait_seconds)
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+            return None
+
+    def _is_healthy(self, entry: _IdleConnection) -> bool:
+        if entry.connection.closed:
+            return False
+        if time.monotonic() - entry.idle_since < self._settings.health_check_after_seconds:
+            return True
+        try:
+            cursor = entry.connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            entry.connection.rollback()
+            return True
+        except Exception:
+            with self._condition:
+                self._health_check_failures += 1
+            return False
+
+    def _release(self, conn: Any) -> None:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                _close_quietly(conn)
+        if conn.closed:
+            self._forget()
+            return
+
+        now = time.monotonic()
+        with self._condition:
+            if self._closed:
+                self._size -= 1
+                reaped = [conn]
+            else:
+                self._idle.append(_IdleConnection(conn, now))
+                reaped = self._reap_locked(now)
+            self._condition.notify()
+        for stale in reaped:
+            _close_quietly(stale)
+
+    def _reap_locked(self, now: float) -> List[Any]:
+        # The idle list is used as a stack, so the least recently used connections sit at the front.
+        reaped = []
+        while (self._idle and self._size > self._settings.min_size
+               and now - self._idle[0].idle_since >= self._settings.max_idle_seconds):
+            reaped.append(self._idle.pop(0).connection)
+            self._size -= 1
+            self._reaped += 1
+        return reaped
+
+    def _forget(self) -> None:
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+
+def _close_quietly(conn: Any) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+_POOL: Optional[ConnectionPool] = None
+_POOL_PID: Optional[int] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns the connection pool of the current worker process, creating it on first use.
+    A forked worker gets its own pool instead of sharing the parent's sockets.
+    """
+    global _POOL, _POOL_PID
+    pid = os.getpid()
+    if _POOL is not None and _POOL_PID == pid:
+        return _POOL
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_PID != pid:
+            _POOL = ConnectionPool(settings=PoolSettings.from_env())
+            _POOL_PID = pid
+        return _POOL
+
+
+# UNIT OF WORK #########################################
+class UnitOfWork(abc.ABC):
+    """
+    Groups the writes of a business operation so they reach the database in as few statements and commits
+    as possible. Repositories created with a unit of work stage their writes instead of running them.
+    """
+
+    @abc.abstractmethod
+    def flush(self) -> None:
+        """
+        Makes the writes staged so far durable in a single commit.
+        Call it before reaching out to a third party that must find those records already stored.
+        """
+
+    @abc.abstractmethod
+    def commit(self) -> None:
+        """
+        Makes every staged write durable, ending the unit of work.
+        """
+
+    async def flush_async(self) -> None:
+        await asyncio.to_thread(self.flush)
+
+    async def commit_async(self) -> None:
+        await asyncio.to_thread(self.commit)
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """
+        Calls ``callback`` once the writes staged so far are durable, straight away when nothing is staged.
+        """
+        callback()
+
+
+class ImmediateUnitOfWork(UnitOfWork):
+    """
+    Unit of work of repositories that write straight away, there is never anything staged.
+    """
+
+    def flush(self) -> None:
+        ...
+
+    def commit(self) -> None:
+        ...
+
+    async def flush_async(self) -> None:
+        ...
+
+    async def commit_async(self) -> None:
+        ...
+
+
+class TableWriter(pydantic.BaseModel):
+    """
+    Describes how the rows of a table are upserted: the whole row is inserted, or ``update_columns`` are
+    overwritten when a row with the same ``key_columns`` already exists.
+    """
+    model_config = pydantic.ConfigDict(frozen=True)
+
+    table: str
+    columns: Tuple[str, ...]
+    key_columns: Tuple[str, ...]
+    update_columns: Tuple[str, ...]
+
+    def key_of(self, row: tuple) -> tuple:
+        return tuple(row[self.columns.index(column)] for column in self.key_columns)
+
+    def upsert_sql(self, rows: int) -> str:
+        values = "(" + ", ".join(["%s"] * len(self.columns)) + ")"
+        return (f"INSERT INTO {self.table} ({', '.join(self.columns)}) "
+                f"VALUES {', '.join([values] * rows)} "
+                f"ON CONFLICT ({', '.join(self.key_columns)}) DO UPDATE SET "
+                + ", ".join(f"{column} = EXCLUDED.{column}" for column in self.update_columns))
+
+
+class PostgresUnitOfWork(UnitOfWork):
+    """
+    Stages the latest state of every written entity and upserts them on ``flush``/``commit``: one statement per
+    table and one commit, however many state transitions the entities went through in between.
+    """
+
+    def __init__(self, pool: Optional[ConnectionPool] = None) -> None:
+        self._pool = pool or get_pool()
+        self._staged: Dict[Tuple[str, tuple], Tuple[TableWriter, tuple]] = {}
+        self._after_commit: List[Callable[[], None]] = []
+
+    def stage(self, writer: TableWriter, row: tuple) -> None:
+        # Re-staging an entity replaces its row but keeps its position, so inserts keep their original order.
+        self._staged[(writer.table, writer.key_of(row))] = (writer, row)
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        if not self._staged:
+            callback()
+            return
+        self._after_commit.append(callback)
+
+    def flush(self) -> None:
+        if not self._staged:
+            return
+        rows_by_writer: Dict[TableWriter, List[tuple]] = {}
+        for writer, row in self._staged.values():
+            rows_by_writer.setdefault(writer, []).append(row)
+
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()
+            for writer, rows in rows_by_writer.items():
+                cursor.execute(writer.upsert_sql(rows=len(rows)), [value for row in rows for value in row])
+            conn.commit()
+            cursor.close()
+        self._staged.clear()
+        self._run_after_commit()
+
+    def commit(self) -> None:
+        self.flush()
+
+    def _run_after_commit(self) -> None:
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+
+# METRICS #########################################
+REPOSITORY_SECONDS = metrics.histogram("checkout_repository_seconds", "Time spent in a repository method.",
+                                       labels=("repository", "method"))
+REPOSITORY_ERRORS = metrics.counter("checkout_repository_errors_total", "Repository calls that raised.",
+                                    labels=("repository", "method"))
+
+
+def timed_repository(repository: str, method: str) -> Callable[[Callable], Callable]:
+    return metrics.timed(REPOSITORY_SECONDS.labels(repository, method),
+                         errors=REPOSITORY_ERRORS.labels(repository, method))
+
+
+_POOL_COUNTERS = frozenset({"acquisitions", "waits", "wait_seconds_total", "timeouts", "health_check_failures",
+                            "reaped"})
+
+
+def stats_samples(prefix: str, stats: pydantic.BaseModel, counters: frozenset) -> Iterator[metrics.Sample]:
+    for field, value in stats.model_dump().items():
+        if field in counters:
+            name = f"{prefix}_{field}" if field.endswith("_total") else f"{prefix}_{field}_total"
+            yield metrics.Sample(name=name, help=f"{prefix} {field}.", type="counter", labels=(), value=value)
+        else:
+            yield metrics.Sample(name=f"{prefix}_{field}", help=f"{prefix} {field}.", type="gauge", labels=(),
+                                 value=value)
+
+
+def _collect_pool() -> Iterable[metrics.Sample]:
+    # Reads the pool without creating it, a scrape must not open connections.
+    if _POOL is not None and _POOL_PID == os.getpid():
+        yield from stats_samples("checkout_db_pool", _POOL.stats(), counters=_POOL_COUNTERS)
+
+
+metrics.register_collector(_collect_pool)
@@ -0,0 +1,48 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# Monotonic instant by which the current request must be answered, carried to every thread and task it starts.
+_DEADLINE: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceededError(Exception):
+    message: str = "The request ran out of time"
+
+
+@contextmanager
+def scope(seconds: float) -> Iterator[None]:
+    """
+    Gives the enclosed calls ``seconds`` to complete, or less when an enclosing scope ends earlier.
+    """
+    current = _DEADLINE.get()
+    deadline = time.monotonic() + seconds
+    token = _DEADLINE.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+@contextmanager
+def shielded() -> Iterator[None]:
+    """
+    Runs the enclosed calls without a deadline, for work that must complete once started, like recording the
+    answer of an acquirer.
+    """
+    token = _DEADLINE.set(None)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left before the deadline, never negative, ``None`` when there is no deadline.
+    """
+    deadline = _DEADLINE.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
@@ -0,0 +1,347 @@
+import http.client
+import os
+import select
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import pydantic
+
+from checkout.infrastructure import deadline, metrics
+
+# Scheme, host and port, the pool keeps the connections of every origin apart.
+Origin = Tuple[str, str, int]
+# Sending one of these again has the same effect as sending it once.
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+
+
+class HTTPPoolTimeoutError(Exception):
+    message: str = "Timed out waiting for an HTTP connection"
+
+
+class HTTPConnectError(ConnectionError):
+    """The connection could not be opened, so nothing was sent."""
+    message: str = "Could not connect"
+
+
+class HTTPPoolSettings(pydantic.BaseModel):
+    max_connections_per_host: int = 10
+    acquire_timeout_seconds: float = 1.0
+    connect_timeout_seconds: float = 1.0
+    read_timeout_seconds: float = 5.0
+    max_idle_seconds: float = 15.0
+
+    @classmethod
+    def from_env(cls) -> "HTTPPoolSettings":
+        defaults = cls()
+        return cls(
+            max_connections_per_host=int(
+                os.environ.get("CHECKOUT_HTTP_MAX_CONNECTIONS_PER_HOST", defaults.max_connections_per_host)),
+            acquire_timeout_seconds=float(
+                os.environ.get("CHECKOUT_HTTP_ACQUIRE_TIMEOUT_SECONDS", defaults.acquire_timeout_seconds)),
+            connect_timeout_seconds=float(
+                os.environ.get("CHECKOUT_HTTP_CONNECT_TIMEOUT_SECONDS", defaults.connect_timeout_seconds)),
+            read_timeout_seconds=float(
+                os.environ.get("CHECKOUT_HTTP_READ_TIMEOUT_SECONDS", defaults.read_timeout_seconds)),
+            max_idle_seconds=float(os.environ.get("CHECKOUT_HTTP_MAX_IDLE_SECONDS", defaults.max_idle_seconds)),
+        )
+
+
+class HTTPPoolStats(pydantic.BaseModel):
+    host: str
+    size: int
+    idle: int
+    in_use: int
+    waiting: int
+    requests: int
+    connections_opened: int
+    waits: int
+    timeouts: int
+    stale_retries: int
+
+
+class Response(NamedTuple):
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+
+
+def connect(origin: Origin, timeout: float) -> http.client.HTTPConnection:
+    scheme, host, port = origin
+    connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+    connection = connection_class(host, port, timeout=timeout)
+    connection.connect()
+    return connection
+
+
+def _closed_by_server(connection: http.client.HTTPConnection) -> bool:
+    """
+    Whether an idle keep-alive connection can be read from: with no request pending, that means the server closed
+    it, or sent something it should not have, and it cannot be used anymore.
+    """
+    if connection.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+class _IdleConnection:
+    __slots__ = ("connection", "idle_since")
+
+    def __init__(self, connection: http.client.HTTPConnection, idle_since: float) -> None:
+        self.connection = connection
+        self.idle_since = idle_since
+
+
+class _HostPool:
+    __slots__ = ("condition", "idle", "size", "waiting", "requests", "connections_opened", "waits", "timeouts",
+                 "stale_retries")
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.idle: List[_IdleConnection] = []
+        self.size = 0
+        self.waiting = 0
+        self.requests = 0
+        self.connections_opened = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.stale_retries = 0
+
+
+class HTTPConnectionPool:
+    """
+    Keep-alive HTTP/1.1 connections shared by the threads of a worker process, at most
+    ``max_connections_per_host`` to every origin.
+
+    A request waits up to ``acquire_timeout_seconds`` for a connection of a busy origin. Under a request deadline
+    every wait, connect and read is given at most the remaining budget. Connections idle for ``max_idle_seconds``
+    are closed rather than reused, before the server closes them on its side.
+    """
+
+    def __init__(self, settings: HTTPPoolSettings,
+                 connect: Callable[[Origin, float], http.client.HTTPConnection] = connect) -> None:
+        if settings.max_connections_per_host < 1:
+            raise ValueError("max_connections_per_host must be at least 1")
+        self._settings = settings
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._hosts: Dict[Origin, _HostPool] = {}
+        self._closed = False
+
+    def request(self, method: str, url: str, body: Optional[bytes] = None,
+                headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None) -> Response:
+        """
+        Sends the request and reads the whole response. Raises ``HTTPPoolTimeoutError`` or ``HTTPConnectError``
+        when nothing could be sent, and ``TimeoutError`` when the response did not come within ``timeout``, or
+        ``read_timeout_seconds``, or the request deadline. An idle connection the server closed is replaced before
+        anything is sent on it; one that breaks after the request was sent is only retried for
+        ``IDEMPOTENT_METHODS``, the error is raised otherwise.
+        """
+        parts = urllib.parse.urlsplit(url)
+        origin = (parts.scheme, parts.hostname or "", parts.port or (443 if parts.scheme == "https" else 80))
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        read_timeout = self._settings.read_timeout_seconds if timeout is None else timeout
+        host = self._host(origin)
+
+        connection, reused = self._acquire(host, origin)
+        if reused and _closed_by_server(connection):
+            # Nothing was sent on it yet, any request can go on a new connection.
+            self._discard(host, connection)
+            with host.condition:
+                host.stale_retries += 1
+            connection, reused = self._acquire(host, origin, fresh=True)
+        while True:
+            try:
+                response, will_close = self._send(connection, method, target, body, headers or {},
+                                                  self._budget(read_timeout))
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._discard(host, connection)
+                # The server may have acted on the request before the connection broke: a capture sent again
+                # could be captured twice, so only idempotent requests are sent again.
+                if not reused or method.upper() not in IDEMPOTENT_METHODS:
+                    raise
+                with host.condition:
+                    host.stale_retries += 1
+                connection, reused = self._acquire(host, origin, fresh=True)
+                continue
+            except BaseException:
+                self._discard(host, connection)
+                raise
+            if will_close:
+                self._discard(host, connection)
+            else:
+                self._release(host, connection)
+            return response
+
+    def stats(self) -> List[HTTPPoolStats]:
+        with self._lock:
+            hosts = list(self._hosts.items())
+        stats = []
+        for (scheme, hostname, port), host in hosts:
+            with host.condition:
+                stats.append(HTTPPoolStats(
+                    host=f"{scheme}://{hostname}:{port}",
+                    size=host.size,
+                    idle=len(host.idle),
+                    in_use=host.size - len(host.idle),
+                    waiting=host.waiting,
+                    requests=host.requests,
+                    connections_opened=host.connections_opened,
+                    waits=host.waits,
+                    timeouts=host.timeouts,
+                    stale_retries=host.stale_retries,
+                ))
+        return stats
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            hosts = list(self._hosts.values())
+        for host in hosts:
+            with host.condition:
+                idle, host.idle = host.idle, []
+                host.size -= len(idle)
+                host.condition.notify_all()
+            for entry in idle:
+                entry.connection.close()
+
+    def _host(self, origin: Origin) -> _HostPool:
+        host = self._hosts.get(origin)
+        if host is None:
+            with self._lock:
+                host = self._hosts.setdefault(origin, _HostPool())
+        return host
+
+    def _budget(self, seconds: float) -> float:
+        remaining = deadline.remaining()
+        if remaining is None:
+            return seconds
+        if remaining <= 0:
+            raise deadline.DeadlineExceededError(deadline.DeadlineExceededError.message)
+        return min(seconds, remaining)
+
+    def _acquire(self, host: _HostPool, origin: Origin,
+                 fresh: bool = False) -> Tuple[http.client.HTTPConnection, bool]:
+        """Returns a connection to the origin and whether it was used before."""
+        acquire_timeout = self._budget(self._settings.acquire_timeout_seconds)
+        stale = []
+        with host.condition:
+            started = time.monotonic()
+            waited = False
+            while not (host.idle and not fresh) and host.size >= self._settings.max_connections_per_host:
+                if fresh and host.idle:
+                    # A retry must not land on another connection that may have gone stale as well.
+                    stale.append(host.idle.pop(0).connection)
+                    host.size -= 1
+                    continue
+                remaining = started + acquire_timeout - time.monotonic()
+                if remaining <= 0 or self._closed:
+                    host.timeouts += 1
+                    raise HTTPPoolTimeoutError(HTTPPoolTimeoutError.message)
+                waited = True
+                host.waiting += 1
+                try:
+                    host.condition.wait(remaining)
+                finally:
+                    host.waiting -= 1
+            host.requests += 1
+            host.waits += waited
+            now = time.monotonic()
+            # The idle list is used as a stack, so the least recently used connections sit at the front.
+            while host.idle and now - host.idle[0].idle_since >= self._settings.max_idle_seconds:
+                stale.append(host.idle.pop(0).connection)
+                host.size -= 1
+            entry = host.idle.pop() if host.idle and not fresh else None
+            if entry is None:
+                host.size += 1
+                host.connections_opened += 1
+        for connection in stale:
+            connection.close()
+        if entry is not None:
+            return entry.connection, True
+
+        try:
+            return self._connect(origin, self._budget(self._settings.connect_timeout_seconds)), False
+        except BaseException as error:
+            self._forget(host)
+            if isinstance(error, OSError):
+                raise HTTPConnectError(f"{HTTPConnectError.message} to {origin[1]}:{origin[2]}: {error}") from error
+            raise
+
+    @staticmethod
+    def _send(connection: http.client.HTTPConnection, method: str, target: str, body: Optional[bytes],
+              headers: Dict[str, str], timeout: float) -> Tuple[Response, bool]:
+        connection.sock.settimeout(timeout)
+        connection.request(method, target, body=body, headers=headers)
+        response = connection.getresponse()
+        payload = response.read()
+        headers = {name.lower(): value for name, value in response.getheaders()}
+        return Response(status=response.status, headers=headers, body=payload), response.will_close
+
+    def _release(self, host: _HostPool, connection: http.client.HTTPConnection) -> None:
+        with host.condition:
+            if not self._closed:
+                host.idle.append(_IdleConnection(connection, time.monotonic()))
+                host.condition.notify()
+                return
+            host.size -= 1
+        connection.close()
+
+    def _discard(self, host: _HostPool, connection: http.client.HTTPConnection) -> None:
+        connection.close()
+        self._forget(host)
+
+    @staticmethod
+    def _forget(host: _HostPool) -> None:
+        with host.condition:
+            host.size -= 1
+            host.condition.notify()
+
+
+_POOL: Optional[HTTPConnectionPool] = None
+_POOL_PID: Optional[int] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> HTTPConnectionPool:
+    """
+    Returns the HTTP connection pool of the current worker process, creating it on first use.
+    A forked worker gets its own pool instead of sharing the parent's sockets.
+    """
+    global _POOL, _POOL_PID
+    pid = os.getpid()
+    if _POOL is not None and _POOL_PID == pid:
+        return _POOL
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_PID != pid:
+            _POOL = HTTPConnectionPool(settings=HTTPPoolSettings.from_env())
+            _POOL_PID = pid
+        return _POOL
+
+
+_POOL_COUNTERS = frozenset({"requests", "connections_opened", "waits", "timeouts", "stale_retries"})
+
+
+def _collect_pool() -> Iterable[metrics.Sample]:
+    # Reads the pool without creating it.
+    if _POOL is None or _POOL_PID != os.getpid():
+        return
+    for stats in _POOL.stats():
+        labels = (("host", stats.host),)
+        for field, value in stats.model_dump(exclude={"host"}).items():
+            if field in _POOL_COUNTERS:
+                yield metrics.Sample(name=f"checkout_http_pool_{field}_total", help=f"HTTP pool {field}.",
+                                     type="counter", labels=labels, value=value)
+            else:
+                yield metrics.Sample(name=f"checkout_http_pool_{field}", help=f"HTTP pool {field}.", type="gauge",
+                                     labels=labels, value=value)
+
+
+metrics.register_collector(_collect_pool)
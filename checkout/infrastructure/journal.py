@@ -0,0 +1,339 @@
+import collections
+import fcntl
+import json
+import os
+import threading
+import time
+from typing import IO, Any, Callable, Deque, List, NamedTuple, Optional, Tuple
+
+import pydantic
+
+from checkout.infrastructure import log
+
+_LOGGER = log.get_logger(__name__)
+_SEGMENT_SUFFIX = ".log"
+_CHECKPOINT_FILE = "checkpoint"
+_LOCK_FILE = "lock"
+_TAIL_CHUNK_BYTES = 64 * 1024
+
+
+class JournalFullError(Exception):
+    message: str = "The write-behind journal is full"
+
+
+class JournalSettings(pydantic.BaseModel):
+    segment_max_bytes: int = 16 * 1024 * 1024
+    max_pending_bytes: int = 256 * 1024 * 1024
+    backpressure_timeout_seconds: float = 1.0
+
+    @classmethod
+    def from_env(cls) -> "JournalSettings":
+        defaults = cls()
+        return cls(
+            segment_max_bytes=int(os.environ.get("CHECKOUT_WRITE_BEHIND_SEGMENT_MAX_BYTES",
+                                                 defaults.segment_max_bytes)),
+            max_pending_bytes=int(os.environ.get("CHECKOUT_WRITE_BEHIND_MAX_PENDING_BYTES",
+                                                 defaults.max_pending_bytes)),
+            backpressure_timeout_seconds=float(os.environ.get("CHECKOUT_WRITE_BEHIND_BACKPRESSURE_TIMEOUT_SECONDS",
+                                                              defaults.backpressure_timeout_seconds)),
+        )
+
+
+class JournalStats(pydantic.BaseModel):
+    pending_entries: int
+    pending_bytes: int
+    segments: int
+    lag_seconds: float
+    appended: int
+    drained: int
+    backpressure_waits: int
+    rejected: int
+
+
+class JournalPosition(NamedTuple):
+    segment: int
+    offset: int
+
+
+class JournalBatch(NamedTuple):
+    entries: List[Any]
+    position: JournalPosition
+    size: int
+
+
+class Journal:
+    """
+    Append-only, fsync'd journal of JSON entries split in numbered segment files.
+
+    ``append`` returns once the entries are on disk. A single consumer reads them in order with ``read_batch`` and
+    ``acknowledge``s them once processed: the position is checkpointed and fully consumed segments are deleted,
+    so whatever was not acknowledged is read again after a restart. Appends wait, and eventually fail with
+    ``JournalFullError``, while the unacknowledged entries take more than ``max_pending_bytes``.
+    """
+
+    def __init__(self, directory: str, settings: Optional[JournalSettings] = None,
+                 lock: Optional[IO[Any]] = None) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._settings = settings or JournalSettings()
+        self._lock = lock
+        self._condition = threading.Condition()
+        self._appended = 0
+        self._drained = 0
+        self._backpressure_waits = 0
+        self._rejected = 0
+
+        segments = self._segments()
+        self._checkpoint = self._read_checkpoint() or JournalPosition(segments[0] if segments else 1, 0)
+        self._segment = segments[-1] if segments else self._checkpoint.segment
+        self._size = self._truncate_torn_tail(self._path(self._segment))
+        self._file = open(self._path(self._segment), "ab")
+
+        self._pending_entries, self._pending_bytes = self._count_pending()
+        # End position of every append not acknowledged yet and when it happened, the oldest one gives the lag.
+        self._pending_since: Deque[Tuple[JournalPosition, float]] = collections.deque()
+        if self._pending_entries:
+            age = max(0.0, time.time() - os.path.getmtime(self._path(self._checkpoint.segment)))
+            self._pending_since.append((JournalPosition(self._segment, self._size), time.monotonic() - age))
+
+    def append(self, entries: List[Any]) -> None:
+        data = b"".join(json.dumps(entry, default=str, separators=(",", ":")).encode() + b"\n"
+                        for entry in entries)
+        with self._condition:
+            self._wait_for_room(len(data))
+            if self._size and self._size + len(data) > self._settings.segment_max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._size += len(data)
+            self._pending_bytes += len(data)
+            self._pending_entries += len(entries)
+            self._appended += len(entries)
+            self._pending_since.append((JournalPosition(self._segment, self._size), time.monotonic()))
+            self._condition.notify_all()
+
+    def read_batch(self, max_entries: int) -> JournalBatch:
+        """
+        Reads up to ``max_entries`` entries following the last acknowledged position.
+        """
+        with self._condition:
+            end = JournalPosition(self._segment, self._size)
+            segment, offset = self._checkpoint
+
+        entries: List[Any] = []
+        size = 0
+        while len(entries) < max_entries and (segment, offset) < end:
+            limit = end.offset if segment == end.segment else None
+            with open(self._path(segment), "rb") as segment_file:
+                segment_file.seek(offset)
+                for line in segment_file:
+                    if limit is not None and offset + len(line) > limit:
+                        break
+                    entries.append(json.loads(line))
+                    offset += len(line)
+                    size += len(line)
+                    if len(entries) == max_entries:
+                        break
+            if len(entries) == max_entries or segment == end.segment:
+                break
+            segment, offset = segment + 1, 0
+        return JournalBatch(entries=entries, position=JournalPosition(segment, offset), size=size)
+
+    def acknowledge(self, batch: JournalBatch) -> None:
+        if not batch.entries:
+            return
+        self._write_checkpoint(batch.position)
+        with self._condition:
+            previous = self._checkpoint
+            self._checkpoint = batch.position
+            self._pending_bytes -= batch.size
+            self._pending_entries -= len(batch.entries)
+            self._drained += len(batch.entries)
+            while self._pending_since and self._pending_since[0][0] <= batch.position:
+                self._pending_since.popleft()
+            self._condition.notify_all()
+        for segment in range(previous.segment, batch.position.segment):
+            os.unlink(self._path(segment))
+
+    def wait_for_entries(self, timeout: float) -> bool:
+        with self._condition:
+            if not self._pending_entries:
+                self._condition.wait(timeout)
+            return self._pending_entries > 0
+
+    def stats(self) -> JournalStats:
+        with self._condition:
+            lag = time.monotonic() - self._pending_since[0][1] if self._pending_since else 0.0
+            return JournalStats(
+                pending_entries=self._pending_entries,
+                pending_bytes=self._pending_bytes,
+                segments=self._segment - self._checkpoint.segment + 1,
+                lag_seconds=lag,
+                appended=self._appended,
+                drained=self._drained,
+                backpressure_waits=self._backpressure_waits,
+                rejected=self._rejected,
+            )
+
+    def close(self) -> None:
+        with self._condition:
+            self._file.close()
+            self._condition.notify_all()
+        if self._lock is not None:
+            self._lock.close()
+
+    def _wait_for_room(self, size: int) -> None:
+        # An entry bigger than the whole journal is still accepted once nothing else is pending.
+        if not self._pending_bytes or self._pending_bytes + size <= self._settings.max_pending_bytes:
+            return
+        self._backpressure_waits += 1
+        deadline = time.monotonic() + self._settings.backpressure_timeout_seconds
+        while self._pending_bytes and self._pending_bytes + size > self._settings.max_pending_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._rejected += 1
+                raise JournalFullError(JournalFullError.message)
+            self._condition.wait(remaining)
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self._segment += 1
+        self._size = 0
+        self._file = open(self._path(self._segment), "ab")
+        self._fsync_directory()
+
+    def _count_pending(self) -> Tuple[int, int]:
+        entries = 0
+        size = 0
+        for segment in range(self._checkpoint.segment, self._segment + 1):
+            path = self._path(segment)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as segment_file:
+                if segment == self._checkpoint.segment:
+                    segment_file.seek(self._checkpoint.offset)
+                for line in segment_file:
+                    entries += 1
+                    size += len(line)
+        return entries, size
+
+    def _segments(self) -> List[int]:
+        return sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self._directory)
+                      if name.endswith(_SEGMENT_SUFFIX))
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self._directory, f"{segment:012d}{_SEGMENT_SUFFIX}")
+
+    def _read_checkpoint(self) -> Optional[JournalPosition]:
+        try:
+            with open(os.path.join(self._directory, _CHECKPOINT_FILE)) as checkpoint:
+                segment, offset = json.load(checkpoint)
+                return JournalPosition(segment, offset)
+        except FileNotFoundError:
+            return None
+
+    def _write_checkpoint(self, position: JournalPosition) -> None:
+        path = os.path.join(self._directory, _CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as checkpoint:
+            json.dump(list(position), checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _fsync_directory(self) -> None:
+        descriptor = os.open(self._directory, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    @staticmethod
+    def _truncate_torn_tail(path: str) -> int:
+        """Drops the partial entry a crash may have left at the end of the segment, returns the segment size."""
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r+b") as segment_file:
+            end = segment_file.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(0, position - _TAIL_CHUNK_BYTES)
+                segment_file.seek(start)
+                newline = segment_file.read(position - start).rfind(b"\n")
+                if newline >= 0:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position != end:
+                segment_file.truncate(position)
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+            return position
+
+
+def open_worker_journal(root: str, settings: Optional[JournalSettings] = None) -> Journal:
+    """
+    Opens the first ``slot-N`` journal under ``root`` that no other process holds, so every worker gets its own
+    journal and a restarted worker picks up what its predecessor left behind.
+    """
+    slot = 0
+    while True:
+        directory = os.path.join(root, f"slot-{slot}")
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, _LOCK_FILE), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            slot += 1
+            continue
+        return Journal(directory=directory, settings=settings, lock=lock)
+
+
+class JournalDrainer:
+    """
+    Background thread handing the journal entries, in order and in batches, to ``sink``. Entries are only
+    acknowledged once the sink returns, a failing sink is retried with the same entries: it must be idempotent.
+    """
+
+    def __init__(self, journal: Journal, sink: Callable[[List[Any]], None], batch_size: int = 500,
+                 idle_interval_seconds: float = 0.5, retry_interval_seconds: float = 1.0) -> None:
+        self._journal = journal
+        self._sink = sink
+        self._batch_size = batch_size
+        self._idle_interval_seconds = idle_interval_seconds
+        self._retry_interval_seconds = retry_interval_seconds
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.failures = 0
+
+    def drain(self) -> int:
+        """Hands every pending entry to the sink, returns how many there were."""
+        drained = 0
+        while True:
+            batch = self._journal.read_batch(max_entries=self._batch_size)
+            if not batch.entries:
+                return drained
+            self._sink(batch.entries)
+            self._journal.acknowledge(batch)
+            drained += len(batch.entries)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="journal-drainer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self.drain()
+            except Exception as error:
+                _LOGGER.error("journal_drain_failed", failures=self.failures + 1, error=error)
+                self.failures += 1
+                self._stopping.wait(self._retry_interval_seconds)
+                continue
+            self._journal.wait_for_entries(timeout=self._idle_interval_seconds)
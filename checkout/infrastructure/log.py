@@ -0,0 +1,231 @@
+import atexit
+import datetime
+import decimal
+import enum
+import json
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from typing import IO, Any, Dict, Mapping, Optional, Tuple
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+_LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+
+# Never written, whatever the event: the card data PCI DSS forbids logging or requires masked.
+REDACTED_FIELDS = frozenset({"pan", "cvv", "card_number", "cardholder_name", "expiration_month", "expiration_year",
+                             "track_data", "password"})
+_REDACTED = "[REDACTED]"
+# Digit runs as long as a PAN, in any value, e.g. the detail of a database error quoting a row.
+_PAN_PATTERN = re.compile(r"(?<!\d)(\d{6})\d{3,9}(\d{4})(?!\d)")
+
+
+class LogSettings:
+    __slots__ = ("level", "sample_rates", "queue_size")
+
+    def __init__(self, level: int = INFO, sample_rates: Optional[Mapping[str, float]] = None,
+                 queue_size: int = 10_000) -> None:
+        self.level = level
+        self.sample_rates: Dict[str, float] = dict(sample_rates or {})
+        self.queue_size = queue_size
+
+    @classmethod
+    def from_env(cls) -> "LogSettings":
+        """
+        ``CHECKOUT_LOG_SAMPLE_RATES`` keeps a share of some events, e.g. ``transaction_registered=0.01``.
+        """
+        level_name = os.environ.get("CHECKOUT_LOG_LEVEL", "info").lower()
+        levels = {name: level for level, name in _LEVEL_NAMES.items()}
+        sample_rates = {}
+        for rate in filter(None, os.environ.get("CHECKOUT_LOG_SAMPLE_RATES", "").split(",")):
+            event, _, share = rate.partition("=")
+            sample_rates[event.strip()] = float(share)
+        return cls(level=levels.get(level_name, INFO), sample_rates=sample_rates,
+                   queue_size=int(os.environ.get("CHECKOUT_LOG_QUEUE_SIZE", "10000")))
+
+
+# REDACTION #########################################
+def redact(value: Any) -> Any:
+    if isinstance(value, str):
+        return _PAN_PATTERN.sub(lambda match: match.group(1) + "******" + match.group(2), value)
+    if isinstance(value, (bool, int, float)) or value is None:
+        return value
+    if isinstance(value, Mapping):
+        return redact_fields(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [redact(item) for item in value]
+    if isinstance(value, enum.Enum):
+        return redact(value.value)
+    if isinstance(value, (decimal.Decimal, datetime.date, datetime.datetime)):
+        return str(value)
+    if isinstance(value, BaseException):
+        return redact(f"{type(value).__name__}: {value}")
+    # SecretStr and the like print masked, anything else is logged by its text.
+    return redact(str(value))
+
+
+def redact_fields(fields: Mapping[str, Any]) -> Dict[str, Any]:
+    return {key: _REDACTED if key.lower() in REDACTED_FIELDS else redact(value) for key, value in fields.items()}
+
+
+# WRITER #########################################
+class LogWriter:
+    """
+    Background thread writing the queued events as JSON lines. Events are redacted and encoded there, logging
+    only queues them: when the queue is full an event is dropped and counted rather than making the caller wait.
+    """
+
+    def __init__(self, stream: IO[str], queue_size: int) -> None:
+        self._stream = stream
+        self._queue: "queue.Queue[Optional[Tuple[float, int, str, str, Dict[str, Any]]]]" = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        self.dropped = 0
+        self.written = 0
+
+    def put(self, timestamp: float, level: int, logger: str, event: str, fields: Dict[str, Any]) -> None:
+        try:
+            self._queue.put_nowait((timestamp, level, logger, event, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self) -> None:
+        """Waits until every queued event is written."""
+        self._queue.join()
+
+    def close(self, timeout: float = 5.0) -> None:
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            entry = self._queue.get()
+            try:
+                if entry is None:
+                    return
+                self._stream.write(self._encode(*entry) + "\n")
+                self.written += 1
+                # Flushed once the queue is empty, a burst of events costs a single write to the stream.
+                if self._queue.empty():
+                    self._stream.flush()
+            except Exception as error:
+                sys.stderr.write(f"log writer failed: {error}\n")
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _encode(timestamp: float, level: int, logger: str, event: str, fields: Dict[str, Any]) -> str:
+        record = {
+            "timestamp": datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat(),
+            "level": _LEVEL_NAMES.get(level, str(level)),
+            "logger": logger,
+            "event": event,
+        }
+        record.update(redact_fields(fields))
+        return json.dumps(record, separators=(",", ":"), default=str)
+
+
+# LOGGERS #########################################
+_SETTINGS = LogSettings.from_env()
+_STREAM: IO[str] = sys.stderr
+_WRITER: Optional[LogWriter] = None
+_WRITER_PID: Optional[int] = None
+_WRITER_LOCK = threading.Lock()
+
+
+class Logger:
+    """
+    Structured logger: ``logger.info("payment_approved", payment_id=payment_id)`` writes the event with its
+    fields. An event below the configured level returns at the first comparison; callers building costly fields
+    check ``enabled`` first.
+    """
+    __slots__ = ("name",)
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def enabled(self, level: int) -> bool:
+        return level >= _SETTINGS.level
+
+    def debug(self, event: str, **fields: Any) -> None:
+        if DEBUG >= _SETTINGS.level:
+            self._log(DEBUG, event, fields)
+
+    def info(self, event: str, **fields: Any) -> None:
+        if INFO >= _SETTINGS.level:
+            self._log(INFO, event, fields)
+
+    def warning(self, event: str, **fields: Any) -> None:
+        if WARNING >= _SETTINGS.level:
+            self._log(WARNING, event, fields)
+
+    def error(self, event: str, **fields: Any) -> None:
+        if ERROR >= _SETTINGS.level:
+            self._log(ERROR, event, fields)
+
+    def _log(self, level: int, event: str, fields: Dict[str, Any]) -> None:
+        rate = _SETTINGS.sample_rates.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        _get_writer().put(time.time(), level, self.name, event, fields)
+
+
+def get_logger(name: str) -> Logger:
+    return Logger(name)
+
+
+def _get_writer() -> LogWriter:
+    """
+    Writer of the current process, started on the first event. A forked worker starts its own, the parent's
+    thread does not survive the fork.
+    """
+    global _WRITER, _WRITER_PID
+    pid = os.getpid()
+    if _WRITER is not None and _WRITER_PID == pid:
+        return _WRITER
+    with _WRITER_LOCK:
+        if _WRITER is None or _WRITER_PID != pid:
+            _WRITER = LogWriter(stream=_STREAM, queue_size=_SETTINGS.queue_size)
+            _WRITER_PID = pid
+        return _WRITER
+
+
+def configure(settings: Optional[LogSettings] = None, stream: Optional[IO[str]] = None) -> None:
+    """
+    Replaces the settings read from the environment, events already queued are written to the previous stream.
+    """
+    global _SETTINGS, _STREAM
+    shutdown()
+    if settings is not None:
+        _SETTINGS = settings
+    if stream is not None:
+        _STREAM = stream
+
+
+def flush() -> None:
+    if _WRITER is not None and _WRITER_PID == os.getpid():
+        _WRITER.flush()
+
+
+def shutdown() -> None:
+    global _WRITER
+    with _WRITER_LOCK:
+        writer, _WRITER = (_WRITER if _WRITER_PID == os.getpid() else None), None
+    if writer is not None:
+        writer.close()
+
+
+def dropped() -> int:
+    return _WRITER.dropped if _WRITER is not None else 0
+
+
+atexit.register(shutdown)
@@ -0,0 +1,475 @@
+import abc
+import bisect
+import contextlib
+import functools
+import glob
+import inspect
+import json
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, TypeVar
+
+from checkout.infrastructure import log
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+_LOGGER = log.get_logger(__name__)
+
+# Seconds, from a cache hit to an acquirer timing out.
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                                      2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+_SNAPSHOT_PREFIX = "metrics-"
+
+
+class Sample(NamedTuple):
+    """
+    Value read by a collector when the metrics are scraped, for the state kept by other components.
+    """
+    name: str
+    help: str
+    type: str
+    labels: Tuple[Tuple[str, str], ...]
+    value: float
+
+
+# SERIES #########################################
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self) -> float:
+        return self.value
+
+
+class _HistogramChild:
+    __slots__ = ("_bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self._bounds = bounds
+        # One count per bucket plus +Inf, allocated once: observing only increments.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self) -> List[Any]:
+        with self._lock:
+            return [list(self.counts), self.sum]
+
+
+class _Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...]) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> Any:
+        """
+        Series of the given label values, in the order of the label names. Callers on a hot path should keep
+        the series of labels known in advance instead of looking it up on every call.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} expects the labels {self.label_names}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            children = list(self._children.items())
+        return {"type": self.type, "help": self.help, "labels": list(self.label_names),
+                "series": [[list(values), child.snapshot()] for values, child in children]}
+
+    @abc.abstractmethod
+    def _new_child(self) -> Any:
+        """
+        Series of a new combination of label values.
+        """
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...],
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name=name, help=help, labels=labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**super().snapshot(), "buckets": list(self.buckets)}
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+
+# REGISTRY #########################################
+def _publish_interval_seconds() -> float:
+    return float(os.environ.get("CHECKOUT_METRICS_PUBLISH_INTERVAL_SECONDS", "1"))
+
+
+class Registry:
+    """
+    Metrics of the worker process. With a ``directory``, every worker publishes its snapshot there and a scrape
+    of any of them adds up those of the live workers, the samples of collectors labelled with their ``pid``. The
+    snapshot of a worker that exited is deleted, like a restarted process its counters start again from zero. One not
+    published for ``stale_seconds`` is left out.
+    """
+
+    def __init__(self, directory: Optional[str] = None, stale_seconds: Optional[float] = None) -> None:
+        self.directory = directory
+        self.stale_seconds = stale_seconds if stale_seconds is not None else 5 * _publish_interval_seconds()
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name=name, help=help, labels=labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name=name, help=help, labels=labels, buckets=buckets))
+
+    def register_collector(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        with self._lock:
+            self._collectors.append(collector)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        samples = []
+        for collector in collectors:
+            try:
+                samples.extend(collector())
+            except Exception as error:
+                _LOGGER.error("metrics_collector_failed", collector=getattr(collector, "__name__", ""), error=error)
+        return {
+            "pid": os.getpid(),
+            "metrics": {metric.name: metric.snapshot() for metric in metrics},
+            "samples": [[sample.name, sample.help, sample.type, [list(label) for label in sample.labels],
+                         sample.value] for sample in samples],
+        }
+
+    def publish(self) -> None:
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._snapshot_path(os.getpid())
+        with open(path + ".tmp", "w") as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    def unpublish(self) -> None:
+        if not self.directory:
+            return
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._snapshot_path(os.getpid()))
+
+    def collect(self) -> List[Dict[str, Any]]:
+        """
+        Snapshots to expose: this worker's only, or every worker's when publishing to a directory.
+        """
+        if not self.directory:
+            return [self.snapshot()]
+        self.publish()
+        snapshots = []
+        for path in sorted(glob.glob(self._snapshot_path("*"))):
+            try:
+                if not self._is_current(path):
+                    continue
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (OSError, ValueError) as error:
+                _LOGGER.warning("metrics_snapshot_unreadable", path=path, error=error)
+        return snapshots
+
+    def exposition(self) -> str:
+        return render(self.collect(), per_process_samples=bool(self.directory))
+
+    def _snapshot_path(self, pid: Any) -> str:
+        return os.path.join(self.directory, f"{_SNAPSHOT_PREFIX}{pid}.json")
+
+    def _is_current(self, path: str) -> bool:
+        pid = int(os.path.basename(path)[len(_SNAPSHOT_PREFIX):-len(".json")])
+        if pid == os.getpid():
+            return True
+        if not _is_alive(pid):
+            # Pruned, a process reusing the pid starts from its own snapshot. Another worker may have pruned it.
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            return False
+        return time.time() - os.path.getmtime(path) <= self.stale_seconds
+
+    def _register(self, metric: Any) -> Any:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError(f"{metric.name} is already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+
+def render(snapshots: List[Dict[str, Any]], per_process_samples: bool) -> str:
+    """
+    Adds the snapshots up into the Prometheus text format.
+    """
+    families: Dict[str, Dict[str, Any]] = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot["metrics"].items():
+            family = families.setdefault(name, {**metric, "series": {}})
+            for values, value in metric["series"]:
+                key = tuple(values)
+                previous = family["series"].get(key)
+                if metric["type"] == "histogram":
+                    family["series"][key] = value if previous is None else [
+                        [a + b for a, b in zip(previous[0], value[0])], previous[1] + value[1]]
+                else:
+                    family["series"][key] = value + (previous or 0.0)
+
+    samples: Dict[str, Dict[str, Any]] = {}
+    for snapshot in snapshots:
+        if per_process_samples and not _is_alive(snapshot["pid"]):
+            continue
+        for name, help_text, sample_type, labels, value in snapshot["samples"]:
+            family = samples.setdefault(name, {"help": help_text, "type": sample_type, "series": []})
+            label_pairs = [tuple(label) for label in labels]
+            if per_process_samples:
+                label_pairs.append(("pid", str(snapshot["pid"])))
+            family["series"].append((label_pairs, value))
+
+    lines: List[str] = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {_escape_help(family['help'])}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for values, value in sorted(family["series"].items()):
+            pairs = list(zip(family["labels"], values))
+            if family["type"] != "histogram":
+                lines.append(f"{name}{_labels(pairs)} {_number(value)}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip([*family["buckets"], "+Inf"], counts):
+                cumulative += count
+                le = bound if isinstance(bound, str) else _number(bound)
+                lines.append(f"{name}_bucket{_labels([*pairs, ('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(pairs)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(pairs)} {cumulative}")
+    for name in sorted(samples):
+        family = samples[name]
+        lines.append(f"# HELP {name} {_escape_help(family['help'])}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for pairs, value in family["series"]:
+            lines.append(f"{name}{_labels(pairs)} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _labels(pairs: List[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    if math.isfinite(value) and value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+REGISTRY = Registry(directory=os.environ.get("CHECKOUT_METRICS_DIR"))
+
+
+def counter(name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.counter(name=name, help=help, labels=labels)
+
+
+def histogram(name: str, help: str, labels: Tuple[str, ...] = (),
+              buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name=name, help=help, labels=labels, buckets=buckets)
+
+
+def register_collector(collector: Callable[[], Iterable[Sample]]) -> None:
+    REGISTRY.register_collector(collector)
+
+
+def _collect_log() -> Iterable[Sample]:
+    yield Sample(name="checkout_log_dropped_events_total", help="Log events dropped because the log queue was full.",
+                 type="counter", labels=(), value=log.dropped())
+
+
+register_collector(_collect_log)
+
+
+# INSTRUMENTATION #########################################
+def timed(seconds: _HistogramChild, errors: Optional[_CounterChild] = None) -> Callable[[F], F]:
+    """
+    Times every call of the decorated function, coroutine function or generator function, a generator until it
+    is exhausted or closed. The series are bound when decorating, a call only reads the clock twice.
+    """
+    def decorate(function: F) -> F:
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed_coroutine(*args: Any, **kwargs: Any) -> Any:
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                except BaseException:
+                    if errors is not None:
+                        errors.inc()
+                    raise
+                finally:
+                    seconds.observe(time.perf_counter() - started)
+            return timed_coroutine  # type: ignore[return-value]
+
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def timed_generator(*args: Any, **kwargs: Any) -> Iterator[Any]:
+                started = time.perf_counter()
+                try:
+                    return (yield from function(*args, **kwargs))
+                except GeneratorExit:
+                    raise
+                except BaseException:
+                    if errors is not None:
+                        errors.inc()
+                    raise
+                finally:
+                    seconds.observe(time.perf_counter() - started)
+            return timed_generator  # type: ignore[return-value]
+
+        @functools.wraps(function)
+        def timed_function(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except BaseException:
+                if errors is not None:
+                    errors.inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started)
+        return timed_function  # type: ignore[return-value]
+    return decorate
+
+
+HTTP_REQUEST_SECONDS = histogram("checkout_http_request_seconds", "Time to answer an HTTP request, by route.",
+                                 labels=("method", "route", "status"))
+
+
+class RouteMetrics:
+    """
+    ASGI middleware timing every HTTP request, labelled by the path template of the route that handled it.
+    """
+
+    def __init__(self, app: Callable, seconds: Histogram = HTTP_REQUEST_SECONDS) -> None:
+        self.app = app
+        self._seconds = seconds
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            # Unmatched paths share a label, raw paths would grow the series without bound.
+            self._seconds.labels(scope["method"], getattr(route, "path", "unmatched"), str(status)).observe(
+                time.perf_counter() - started)
+
+
+# PUBLISHING #########################################
+_PUBLISHER: Optional[Tuple[threading.Thread, threading.Event]] = None
+
+
+def start_publishing(interval_seconds: Optional[float] = None) -> None:
+    """
+    Publishes the snapshot of this worker every ``CHECKOUT_METRICS_PUBLISH_INTERVAL_SECONDS`` when
+    ``CHECKOUT_METRICS_DIR`` is set, so a scrape answered by another worker is at most that old.
+    """
+    global _PUBLISHER
+    if not REGISTRY.directory or _PUBLISHER is not None:
+        return
+    interval = interval_seconds or _publish_interval_seconds()
+    stopping = threading.Event()
+
+    def publish_periodically() -> None:
+        while not stopping.wait(interval):
+            try:
+                REGISTRY.publish()
+            except OSError as error:
+                _LOGGER.error("metrics_publish_failed", error=error)
+
+    thread = threading.Thread(target=publish_periodically, name="metrics-publisher", daemon=True)
+    thread.start()
+    _PUBLISHER = (thread, stopping)
+
+
+def stop_publishing() -> None:
+    global _PUBLISHER
+    if _PUBLISHER is None:
+        return
+    thread, stopping = _PUBLISHER
+    _PUBLISHER = None
+    stopping.set()
+    thread.join(timeout=5.0)
+    REGISTRY.unpublish()
+
+
@@ -0,0 +1,27 @@
+"""
+Applies the pending schema migrations to the database configured by the POSTGRES_* variables.
+
+    python -m checkout.infrastructure.migrations upgrade
+    python -m checkout.infrastructure.migrations status
+"""
+import argparse
+
+from checkout.infrastructure.migrations import runner
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["upgrade", "status"])
+    args = parser.parse_args()
+
+    if args.command == "status":
+        for migration in runner.pending():
+            print(f"pending {migration.version:04d}_{migration.name}")
+        return
+
+    for migration in runner.migrate():
+        print(f"applied {migration.version:04d}_{migration.name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import pathlib
+import re
+from typing import List, Optional, Set
+
+import pydantic
+
+from checkout.infrastructure import database
+
+VERSIONS_DIRECTORY = pathlib.Path(__file__).parent / "versions"
+# Arbitrary application wide key, it keeps two workers starting at the same time from migrating concurrently.
+_ADVISORY_LOCK_KEY: int = 7_310_420_117
+_FILE_NAME = re.compile(r"^(?P<version>\d{4})_(?P<name>\w+)\.sql$")
+
+
+class MigrationError(Exception):
+    message: str = "The migrations are not consistent"
+
+
+class Migration(pydantic.BaseModel):
+    version: int
+    name: str
+    sql: str
+
+
+def discover(directory: pathlib.Path = VERSIONS_DIRECTORY) -> List[Migration]:
+    """
+    Loads the ``NNNN_name.sql`` files of the directory ordered by version.
+    """
+    migrations = {}
+    for path in sorted(directory.glob("*.sql")):
+        match = _FILE_NAME.match(path.name)
+        if not match:
+            raise MigrationError(f"{path.name} does not follow the NNNN_name.sql convention")
+        version = int(match.group("version"))
+        if version in migrations:
+            raise MigrationError(f"Version {version} is defined more than once")
+        migrations[version] = Migration(version=version, name=match.group("name"), sql=path.read_text())
+    return [migrations[version] for version in sorted(migrations)]
+
+
+def pending(pool: Optional[database.ConnectionPool] = None,
+            migrations: Optional[List[Migration]] = None) -> List[Migration]:
+    pool = pool or database.get_pool()
+    migrations = discover() if migrations is None else migrations
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        _ensure_history_table(cursor)
+        conn.commit()
+        applied = _applied_versions(cursor)
+        cursor.close()
+    return [migration for migration in migrations if migration.version not in applied]
+
+
+def migrate(pool: Optional[database.ConnectionPool] = None,
+            migrations: Optional[List[Migration]] = None) -> List[Migration]:
+    """
+    Applies, in order, the migrations that are not recorded in ``schema_migrations`` yet.
+    Each migration runs and is recorded in its own transaction, so running it again is a no-op.
+    :return: the migrations applied by this call.
+    """
+    pool = pool or database.get_pool()
+    migrations = discover() if migrations is None else migrations
+    applied_now = []
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        _ensure_history_table(cursor)
+        cursor.execute("SELECT pg_advisory_lock(%s)", (_ADVISORY_LOCK_KEY,))
+        conn.commit()
+        try:
+            applied = _applied_versions(cursor)
+            for migration in migrations:
+                if migration.version in applied:
+                    continue
+                cursor.execute(migration.sql)
+                cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                               (migration.version, migration.name))
+                conn.commit()
+                applied_now.append(migration)
+        finally:
+            conn.rollback()
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (_ADVISORY_LOCK_KEY,))
+            conn.commit()
+            cursor.close()
+    return applied_now
+
+
+def _ensure_history_table(cursor) -> None:
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS schema_migrations
+            (
+                version    INT PRIMARY KEY,
+                name       VARCHAR(100) NOT NULL,
+                applied_at TIMESTAMPTZ  NOT NULL DEFAULT now()
+            )
+        """)
+
+
+def _applied_versions(cursor) -> Set[int]:
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
@@ -0,0 +1,11 @@
+-- Merchant listing and streaming: WHERE merchant_id = ? [AND (payment_date, payment_id) > (?, ?)]
+-- ORDER BY payment_date, payment_id. The index also serves the ordering, so pages are read without a sort.
+CREATE INDEX IF NOT EXISTS payments_merchant_id_payment_date_payment_id_idx
+    ON payments (merchant_id, payment_date, payment_id);
+
+-- find_payment/update_payment filter on merchant_id AND payment_id and are served by the payments primary key,
+-- update_transaction filters on client_id AND transaction_id and is served by the transactions primary key.
+
+-- Transactions of a payment: WHERE client_id = ? AND client_reference_id = ?
+CREATE INDEX IF NOT EXISTS transactions_client_id_client_reference_id_idx
+    ON transactions (client_id, client_reference_id);
@@ -0,0 +1,10 @@
+-- One row per Idempotency-Key of a merchant, the response is stored once the payment is done.
+CREATE TABLE IF NOT EXISTS idempotency_keys
+(
+    merchant_id     VARCHAR(50)  NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    fingerprint     CHAR(64)     NOT NULL,
+    response        TEXT,
+    created_at      BIGINT       NOT NULL,
+    PRIMARY KEY (merchant_id, idempotency_key)
+);
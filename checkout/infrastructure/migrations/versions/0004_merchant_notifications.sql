@@ -0,0 +1,16 @@
+-- Every change of a merchant is announced on the merchant_changes channel with its merchant_id, so the merchant
+-- cache of every worker refreshes that merchant instead of waiting for its TTL.
+CREATE OR REPLACE FUNCTION notify_merchant_change() RETURNS trigger AS
+$$
+BEGIN
+    PERFORM pg_notify('merchant_changes', COALESCE(NEW.merchant_id, OLD.merchant_id));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS merchants_notify_change ON merchants;
+CREATE TRIGGER merchants_notify_change
+    AFTER INSERT OR UPDATE OR DELETE
+    ON merchants
+    FOR EACH ROW
+EXECUTE FUNCTION notify_merchant_change();
@@ -0,0 +1,7 @@
+-- Idempotency keys are kept until expires_at, in nanoseconds since the epoch, and deleted afterwards by
+-- python -m checkout.gateway.cleanup. The keys written before this migration expire a day after they were created.
+ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS expires_at BIGINT;
+UPDATE idempotency_keys SET expires_at = created_at + 86400000000000 WHERE expires_at IS NULL;
+ALTER TABLE idempotency_keys ALTER COLUMN expires_at SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at ON idempotency_keys (expires_at);
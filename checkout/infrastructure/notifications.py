@@ -0,0 +1,77 @@
+import select
+import threading
+from typing import Any, Callable, Optional
+
+from checkout.infrastructure import database, log
+
+_LOGGER = log.get_logger(__name__)
+
+sql = database.lazy_import("psycopg2.sql")
+
+
+class NotificationListener:
+    """
+    Background thread running ``LISTEN channel`` on a connection of its own and calling ``on_notification`` with
+    the payload of every notification. A lost connection is opened again after ``retry_seconds``; notifications
+    sent while it was lost are gone, so ``on_connect`` is called on every connection to catch up.
+    """
+
+    def __init__(self, channel: str,
+                 on_notification: Callable[[str], Any],
+                 on_connect: Callable[[], Any] = lambda: None,
+                 connect: Callable[[], Any] = database.connect_from_env,
+                 retry_seconds: float = 5.0,
+                 poll_seconds: float = 1.0) -> None:
+        self._channel = channel
+        self._on_notification = on_notification
+        self._on_connect = on_connect
+        self._connect = connect
+        self._retry_seconds = retry_seconds
+        self._poll_seconds = poll_seconds
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.connected = False
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name=f"listen-{self._channel}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self._channel)))
+                cursor.close()
+                self.connected = True
+                self._on_connect()
+                self._listen(conn)
+            except Exception as error:
+                _LOGGER.warning("listen_failed", channel=self._channel, error=error)
+            finally:
+                self.connected = False
+                if conn is not None:
+                    _close_quietly(conn)
+            self._stopped.wait(self._retry_seconds)
+
+    def _listen(self, conn: Any) -> None:
+        while not self._stopped.is_set():
+            if not select.select([conn], [], [], self._poll_seconds)[0]:
+                continue
+            conn.poll()
+            while conn.notifies:
+                self._on_notification(conn.notifies.pop(0).payload)
+
+
+def _close_quietly(conn: Any) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
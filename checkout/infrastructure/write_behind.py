@@ -0,0 +1,97 @@
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from checkout.infrastructure import database, journal, metrics
+
+
+# UNIT OF WORK #########################################
+class WriteBehindUnitOfWork(database.PostgresUnitOfWork):
+    """
+    Flushes like ``PostgresUnitOfWork``, but ``commit`` appends the staged rows to the write-behind journal and
+    returns: the final state reaches Postgres once the journal drainer applies it, until then reads still see the
+    state of the last flush. The ``after_commit`` callbacks run once the rows are journaled.
+    """
+
+    def __init__(self, write_behind_journal: journal.Journal,
+                 pool: Optional[database.ConnectionPool] = None) -> None:
+        super().__init__(pool=pool)
+        self._journal = write_behind_journal
+
+    def commit(self) -> None:
+        if not self._staged:
+            return
+        self._journal.append([{"writer": writer.model_dump(), "row": row} for writer, row in self._staged.values()])
+        self._staged.clear()
+        self._run_after_commit()
+
+
+def apply_journal_entries(entries: List[Dict[str, Any]], pool: Optional[database.ConnectionPool] = None) -> None:
+    """
+    Journal sink of the write-behind mode, upserts the journaled rows in a single commit.
+    Applying an entry twice leaves the same row, so replaying the journal after a crash is harmless.
+    """
+    unit_of_work = database.PostgresUnitOfWork(pool=pool)
+    writers: Dict[str, database.TableWriter] = {}
+    for entry in entries:
+        table = entry["writer"]["table"]
+        if table not in writers:
+            writers[table] = database.TableWriter(**entry["writer"])
+        unit_of_work.stage(writers[table], tuple(entry["row"]))
+    unit_of_work.commit()
+
+
+_WRITE_BEHIND: Optional[Tuple[journal.Journal, journal.JournalDrainer]] = None
+
+
+def start_write_behind() -> Optional[journal.Journal]:
+    """
+    Opens the journal of this worker and starts draining it when ``CHECKOUT_WRITE_BEHIND_DIR`` is set,
+    the entries left behind by a previous run are replayed first.
+    """
+    global _WRITE_BEHIND
+    directory = os.environ.get("CHECKOUT_WRITE_BEHIND_DIR")
+    if not directory or _WRITE_BEHIND is not None:
+        return get_write_behind_journal()
+    write_behind_journal = journal.open_worker_journal(root=directory, settings=journal.JournalSettings.from_env())
+    drainer = journal.JournalDrainer(journal=write_behind_journal, sink=apply_journal_entries)
+    drainer.start()
+    _WRITE_BEHIND = (write_behind_journal, drainer)
+    return write_behind_journal
+
+
+def stop_write_behind() -> None:
+    global _WRITE_BEHIND
+    if _WRITE_BEHIND is None:
+        return
+    write_behind_journal, drainer = _WRITE_BEHIND
+    _WRITE_BEHIND = None
+    drainer.stop()
+    write_behind_journal.close()
+
+
+def get_write_behind_journal() -> Optional[journal.Journal]:
+    return _WRITE_BEHIND[0] if _WRITE_BEHIND is not None else None
+
+
+def create_unit_of_work() -> database.PostgresUnitOfWork:
+    """
+    Unit of work for a request: final states go through the write-behind journal when it is running.
+    """
+    write_behind_journal = get_write_behind_journal()
+    if write_behind_journal is not None:
+        return WriteBehindUnitOfWork(write_behind_journal=write_behind_journal)
+    return database.PostgresUnitOfWork()
+
+
+# METRICS #########################################
+_JOURNAL_COUNTERS = frozenset({"appended", "drained", "backpressure_waits", "rejected"})
+
+
+def _collect_journal() -> Iterable[metrics.Sample]:
+    write_behind_journal = get_write_behind_journal()
+    if write_behind_journal is not None:
+        yield from database.stats_samples("checkout_write_behind", write_behind_journal.stats(),
+                                          counters=_JOURNAL_COUNTERS)
+
+
+metrics.register_collector(_collect_journal)
@@ -1,12 +1,15 @@
+import asyncio
 import decimal
+import time
 from collections.abc import Iterator
 from datetime import datetime
 from typing import Optional, Dict, List
 
 import pydantic
 
-from checkout.card_processing import services, adapters, model
+from checkout.card_processing import services, adapters, model, pipeline
 from checkout.card_processing.adapters import PANInfo
+from checkout.infrastructure import database
 from checkout.standard_types import money, card
 
 
@@ -25,8 +28,9 @@ class TransactionFake:
                 cardholder_name="fake-cardholder-name",
                 expiration_month=datetime.today().month,
                 expiration_year=datetime.today().year,
-                pan="1234567890123456",
-                cvv="000",
+                pan=pydantic.SecretStr("1234567890123456"),
+                cvv=pydantic.SecretStr("000"),
+                masked_pan=card.PAN.mask("1234567890123456"),
             ),
         )
 
@@ -67,6 +71,41 @@ class StubRetryableRejectedAcquiringProcessorTransactionProvider(adapters.Acquir
 
 # ROUTER #########################################
 
+class StubUnreachableAcquiringProcessorTransactionProvider(StubApprovedAcquiringProcessorTransactionProvider):
+    def __init__(self) -> None:
+        self.reachable = False
+
+    def capture(self, message: adapters.CaptureMessage) -> adapters.FinancialMessageResult:
+        if not self.reachable:
+            raise TimeoutError("the acquirer did not answer in time")
+        return super().capture(message=message)
+
+
+class StubSlowApprovedAcquiringProcessorTransactionProvider(StubApprovedAcquiringProcessorTransactionProvider):
+    def __init__(self, latency_seconds: float, expected_latency_seconds: float = 0.0) -> None:
+        self.latency_seconds = latency_seconds
+        self._expected_latency_seconds = expected_latency_seconds
+
+    def expected_latency_seconds(self) -> float:
+        return self._expected_latency_seconds
+
+    def capture(self, message: adapters.CaptureMessage) -> adapters.FinancialMessageResult:
+        time.sleep(self.latency_seconds)
+        return super().capture(message=message)
+
+    async def capture_async(self, message: adapters.CaptureMessage) -> adapters.FinancialMessageResult:
+        await asyncio.sleep(self.latency_seconds)
+        return super().capture(message=message)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
 class StubApprovedTransactionRouter(adapters.TransactionRouter):
     def get_acquiring_processing_providers(
             self, package: adapters.TransactionPackage) -> Iterator[adapters.AcquiringProcessorProvider]:
@@ -100,6 +139,37 @@ class StubAllRetryableRejectedTransactionRouter(adapters.TransactionRouter):
         yield StubRetryableRejectedAcquiringProcessorTransactionProvider()
 
 
+class StubRetryableSlowTransactionRouter(adapters.TransactionRouter):
+    def get_acquiring_processing_providers(
+            self, package: adapters.TransactionPackage) -> Iterator[adapters.AcquiringProcessorProvider]:
+        yield StubRetryableRejectedAcquiringProcessorTransactionProvider()
+        yield StubSlowApprovedAcquiringProcessorTransactionProvider(latency_seconds=1.0, expected_latency_seconds=1.0)
+
+
+class StubSlowTransactionRouter(adapters.TransactionRouter):
+    def __init__(self, latency_seconds: float) -> None:
+        self.latency_seconds = latency_seconds
+
+    def get_acquiring_processing_providers(
+            self, package: adapters.TransactionPackage) -> Iterator[adapters.AcquiringProcessorProvider]:
+        yield StubSlowApprovedAcquiringProcessorTransactionProvider(latency_seconds=self.latency_seconds)
+
+
+class SpyTransactionRouter(adapters.TransactionRouter):
+    def __init__(self) -> None:
+        self.packages: List[adapters.TransactionPackage] = []
+
+    def get_acquiring_processing_providers(
+            self, package: adapters.TransactionPackage) -> Iterator[adapters.AcquiringProcessorProvider]:
+        self.packages.append(package)
+        yield StubApprovedAcquiringProcessorTransactionProvider()
+
+
+class StubVisaAccountRangeProvider(adapters.AccountRangeProvider):
+    def get_pan_info(self, pan: pydantic.SecretStr) -> PANInfo:
+        return PANInfo(country="UK", category="BLACK", franchise="VISA", issuer="HSBC")
+
+
 # REPOSITORY #########################################
 class StubAccountRangeProvider(adapters.AccountRangeProvider):
     def get_pan_info(self, pan: pydantic.SecretStr) -> PANInfo:
@@ -130,3 +200,65 @@ class FakeCardNotPresentTransactionRepository(adapters.CardNotPresentTransaction
     def update_transaction(self, transaction: model.CardNotPresentTransaction) -> model.CardNotPresentTransaction:
         self.transaction[transaction.transaction_id] = transaction
         return transaction
+
+
+class SpyUnitOfWork(database.UnitOfWork):
+    def __init__(self) -> None:
+        self.flushes = 0
+        self.commits = 0
+
+    def flush(self) -> None:
+        self.flushes += 1
+
+    def commit(self) -> None:
+        self.commits += 1
+
+
+# PIPELINE #########################################
+
+class StubFraudRejectionStage(pipeline.Stage):
+    name = "fraud"
+
+    def run(self, context: services.SaleContext) -> Optional[str]:
+        context.response = services.TransactionResponse(
+            card_franchise=context.pan_info.franchise,
+            card_country=context.pan_info.country,
+            network=card.AcquiringNetwork.CKO,
+            response_code="59",
+            response_message="Suspected fraud",
+            approval_code="",
+            status=services.TransactionStatus.REJECTED,
+        )
+        return pipeline.END
+
+
+class StubSleepingStage(pipeline.Stage):
+    def __init__(self, name: str, seconds: float) -> None:
+        self.name = name
+        self.seconds = seconds
+
+    def run(self, context: None) -> Optional[str]:
+        time.sleep(self.seconds)
+        return None
+
+    async def run_async(self, context: None) -> Optional[str]:
+        await asyncio.sleep(self.seconds)
+        return None
+
+
+class StubBlockingStage(pipeline.Stage):
+    def __init__(self, name: str, seconds: float) -> None:
+        self.name = name
+        self.seconds = seconds
+
+    def run(self, context: None) -> Optional[str]:
+        time.sleep(self.seconds)
+        return None
+
+
+class StubAllocatingStage(pipeline.Stage):
+    name = "allocate"
+
+    def run(self, context: List[bytearray]) -> Optional[str]:
+        context.append(bytearray(1024 * 1024))
+        return None
@@ -0,0 +1,97 @@
+import pathlib
+from typing import List
+
+import pydantic
+import pytest
+
+from checkout.card_processing import adapters, account_ranges
+
+_VISA_FR = adapters.PANInfo(country="FR", franchise="VISA", category="CLASSIC", issuer="LCL")
+_VISA_FR_BLACK = adapters.PANInfo(country="FR", franchise="VISA", category="BLACK", issuer="LCL")
+_VISA_UK = adapters.PANInfo(country="UK", franchise="VISA", category="BLACK", issuer="HSBC")
+_MASTER_CARD = adapters.PANInfo(country="VE", franchise="MASTER_CARD", category="BLACK", issuer="Banco de Venezuela")
+
+
+def _provider() -> adapters.IntervalAccountRangeProvider:
+    return adapters.IntervalAccountRangeProvider(ranges=[
+        adapters.AccountRange(low="444444", high="444444", pan_info=_VISA_FR),
+        adapters.AccountRange(low="4444444444", high="4444444499", pan_info=_VISA_FR_BLACK),
+        adapters.AccountRange(low="4444455555", high="4444455555", pan_info=_VISA_UK),
+        adapters.AccountRange(low="51", high="55", pan_info=_MASTER_CARD),
+    ])
+
+
+@pytest.mark.parametrize(
+    "pan, expected_pan_info",
+    [("4444440000000000", _VISA_FR),
+     ("4444444444444444", _VISA_FR_BLACK),
+     ("4444444499999999999", _VISA_FR_BLACK),
+     ("4444444500000000", _VISA_FR),
+     ("4444455555000000", _VISA_UK),
+     ("5100000000000000", _MASTER_CARD),
+     ("5599999999999999", _MASTER_CARD),
+     ("5600000000000000", adapters.UnknownPANInfo()),
+     ("3333111122223333", adapters.UnknownPANInfo()), ])
+def test_should_resolve_the_most_specific_account_range_of_the_pan(
+        pan: str, expected_pan_info: adapters.PANInfo) -> None:
+    pan_info = _provider().get_pan_info(pan=pydantic.SecretStr(pan))
+    assert pan_info == expected_pan_info
+
+
+def test_should_split_nested_ranges_into_disjoint_segments() -> None:
+    segments = account_ranges.flatten([(0, 99, 0), (10, 19, 1), (15, 15, 2), (50, 149, 3)])
+
+    assert segments == [(0, 9, 0), (10, 14, 1), (15, 15, 2), (16, 19, 1), (20, 99, 0), (100, 149, 3)]
+
+
+def test_should_refuse_a_range_whose_low_bound_is_above_its_high_bound() -> None:
+    with pytest.raises(ValueError):
+        account_ranges.AccountRangeIndex([("5", "4", _MASTER_CARD)])
+
+
+def _write_ranges(path: pathlib.Path, rows: List[str]) -> None:
+    path.write_text("\n".join([",".join(account_ranges.CSV_COLUMNS), *rows]) + "\n")
+
+
+def test_should_resolve_the_pan_info_from_a_compiled_account_range_file(tmp_path: pathlib.Path) -> None:
+    _write_ranges(tmp_path / "ranges.csv", ["444444,444444,FR,VISA,CLASSIC,LCL",
+                                            "4444455555,4444455555,UK,VISA,BLACK,HSBC",
+                                            "51,55,VE,MASTER_CARD,BLACK,Banco de Venezuela"])
+    account_ranges.compile_csv(str(tmp_path / "ranges.csv"), str(tmp_path / "ranges.bin"))
+
+    provider = adapters.MappedAccountRangeProvider(path=str(tmp_path / "ranges.bin"))
+
+    assert provider.get_pan_info(pan=pydantic.SecretStr("4444455555000000")) == _VISA_UK
+    assert provider.get_pan_info(pan=pydantic.SecretStr("5200000000000000")) == _MASTER_CARD
+    assert provider.get_pan_info(pan=pydantic.SecretStr("4444440000000000")) == _VISA_FR
+    assert provider.get_pan_info(pan=pydantic.SecretStr("3333111122223333")) == adapters.UnknownPANInfo()
+
+
+def test_should_pick_up_a_new_version_of_the_account_range_file(tmp_path: pathlib.Path) -> None:
+    _write_ranges(tmp_path / "ranges.csv", ["51,55,VE,MASTER_CARD,BLACK,Banco de Venezuela"])
+    account_ranges.compile_csv(str(tmp_path / "ranges.csv"), str(tmp_path / "ranges.bin"))
+    provider = adapters.MappedAccountRangeProvider(path=str(tmp_path / "ranges.bin"), reload_interval_seconds=0)
+    assert provider.get_pan_info(pan=pydantic.SecretStr("4444455555000000")) == adapters.UnknownPANInfo()
+
+    _write_ranges(tmp_path / "ranges.csv", ["4444455555,4444455555,UK,VISA,BLACK,HSBC"])
+    account_ranges.compile_csv(str(tmp_path / "ranges.csv"), str(tmp_path / "ranges.bin"))
+
+    assert provider.get_pan_info(pan=pydantic.SecretStr("4444455555000000")) == _VISA_UK
+    assert provider.get_pan_info(pan=pydantic.SecretStr("5200000000000000")) == adapters.UnknownPANInfo()
+
+
+def test_should_keep_the_previous_account_ranges_when_the_new_file_is_truncated(tmp_path: pathlib.Path) -> None:
+    _write_ranges(tmp_path / "ranges.csv", ["51,55,VE,MASTER_CARD,BLACK,Banco de Venezuela"])
+    account_ranges.compile_csv(str(tmp_path / "ranges.csv"), str(tmp_path / "ranges.bin"))
+    provider = adapters.MappedAccountRangeProvider(path=str(tmp_path / "ranges.bin"), reload_interval_seconds=0)
+
+    _write_ranges(tmp_path / "ranges.csv", ["4444455555,4444455555,UK,VISA,BLACK,HSBC",
+                                            "444444,444444,FR,VISA,CLASSIC,LCL"])
+    account_ranges.compile_csv(str(tmp_path / "ranges.csv"), str(tmp_path / "new.bin"))
+    (tmp_path / "truncated.bin").write_bytes((tmp_path / "new.bin").read_bytes()[:-20])
+    (tmp_path / "truncated.bin").replace(tmp_path / "ranges.bin")
+
+    with pytest.raises(account_ranges.InvalidAccountRangeFileError):
+        account_ranges.MappedAccountRangeTable(str(tmp_path / "ranges.bin"))
+    assert provider.reload_if_changed() is False
+    assert provider.get_pan_info(pan=pydantic.SecretStr("5200000000000000")) == _MASTER_CARD
@@ -0,0 +1,100 @@
+import time
+from typing import Iterator
+
+import pydantic
+import pytest
+
+from benchmark import acquirer_simulator
+from checkout.card_processing import adapters
+from checkout.infrastructure import deadline, http_client
+from checkout.standard_types import card, money
+
+
+def _simulator(**behaviour) -> acquirer_simulator.AcquirerSimulator:
+    behaviour.setdefault("latency", acquirer_simulator.parse_latency("constant:0"))
+    behaviour.setdefault("response_codes", [("00", 1.0)])
+    return acquirer_simulator.AcquirerSimulator(("127.0.0.1", 0), behaviour=acquirer_simulator.Behaviour(
+        **behaviour)).start()
+
+
+@pytest.fixture
+def pool() -> Iterator[http_client.HTTPConnectionPool]:
+    pool = http_client.HTTPConnectionPool(settings=http_client.HTTPPoolSettings())
+    yield pool
+    pool.close()
+
+
+def _message(pan: str = "3333111122223333") -> adapters.CaptureMessage:
+    return adapters.CaptureMessage(merchant_id="1", currency=money.Currency.EUR, total_amount=100, tip=0, vat=0,
+                                   cardholder_name="Juls Cesar", expiration_month=12, expiration_year=2030,
+                                   pan=pydantic.SecretStr(pan), cvv=pydantic.SecretStr("000"))
+
+
+def _provider(simulator: acquirer_simulator.AcquirerSimulator, pool: http_client.HTTPConnectionPool,
+              timeout_seconds: float = 5.0) -> adapters.HTTPAcquiringProcessorProvider:
+    return adapters.HTTPAcquiringProcessorProvider(name="CKO", url=simulator.url, network=card.AcquiringNetwork.CKO,
+                                                   timeout_seconds=timeout_seconds, pool=pool)
+
+
+def test_should_capture_through_the_acquirer_api(pool: http_client.HTTPConnectionPool) -> None:
+    simulator = _simulator(response_codes=[("00", 1.0)])
+    try:
+        provider = _provider(simulator, pool)
+
+        approved = provider.capture(message=_message())
+        rejected = provider.capture(message=_message(pan="4444444444444444"))
+    finally:
+        simulator.stop()
+
+    assert isinstance(approved, adapters.ApprovedCapture)
+    assert len(approved.approval_code) == 10
+    assert rejected == adapters.RejectedCapture(network=card.AcquiringNetwork.CKO, response_code="19",
+                                                response_message="Re-enter transaction",
+                                                interchange_rate="0.10", is_retryable=True)
+    assert simulator.connections == 1
+
+
+def test_should_answer_a_retryable_rejection_when_the_acquirer_is_unavailable(
+        pool: http_client.HTTPConnectionPool) -> None:
+    simulator = _simulator(error_rate=1.0)
+    try:
+        breaker = adapters.CircuitBreakerAcquiringProcessorProvider(
+            provider=_provider(simulator, pool),
+            settings=adapters.CircuitBreakerSettings(minimum_calls=2, window_size=2))
+
+        results = [breaker.capture(message=_message()) for _ in range(2)]
+    finally:
+        simulator.stop()
+
+    assert [result.response_code for result in results] == ["F98", "F98"]
+    assert all(result.is_retryable for result in results)
+    assert breaker.state == adapters.CircuitState.OPEN
+
+
+def test_should_reject_a_capture_the_acquirer_refuses_with_a_client_error(
+        pool: http_client.HTTPConnectionPool) -> None:
+    simulator = _simulator()
+    try:
+        provider = adapters.HTTPAcquiringProcessorProvider(name="CKO", url=simulator.url + "/unknown",
+                                                           network=card.AcquiringNetwork.CKO, pool=pool)
+
+        result = provider.capture(message=_message())
+    finally:
+        simulator.stop()
+
+    assert result == adapters.RejectedCapture(network=card.AcquiringNetwork.CKO, response_code="30",
+                                              response_message="Refused by the acquirer with HTTP 404",
+                                              interchange_rate="0.0", is_retryable=False)
+
+
+def test_should_give_up_on_a_capture_at_the_request_deadline(pool: http_client.HTTPConnectionPool) -> None:
+    simulator = _simulator(timeout_rate=1.0, timeout_seconds=2.0)
+    try:
+        started = time.monotonic()
+        with deadline.scope(0.2), pytest.raises(adapters.CaptureOutcomeUnknownError):
+            _provider(simulator, pool).capture(message=_message())
+        elapsed = time.monotonic() - started
+    finally:
+        simulator.stop()
+
+    assert elapsed < 1.0
@@ -0,0 +1,76 @@
+import asyncio
+import time
+import tracemalloc
+
+from checkout.card_processing import pipeline, services
+from test.checkout.card_processing import faker
+
+
+def test_should_record_every_stage_of_a_retried_sale() -> None:
+    sale_pipeline = services.build_sale_pipeline()
+
+    response = services.process_sale(
+        request=faker.TransactionFake.fake(),
+        router=faker.StubRetryableApprovedTransactionRouter(),
+        account_range_provider=faker.StubAccountRangeProvider(),
+        repo=faker.FakeCardNotPresentTransactionRepository(ids=["1", "2", "3"]),
+        sale_pipeline=sale_pipeline,
+    )
+
+    assert response.status == services.TransactionStatus.APPROVED
+    assert {name: stats.calls for name, stats in sale_pipeline.stats().items()} == {
+        "lookup": 1, "account_range_lookup": 1, "transaction_id": 1, "route": 1, "register": 2, "capture": 2, "decide": 2,
+        "persist": 2}
+    assert all(stats.seconds > 0 for stats in sale_pipeline.stats().values())
+
+
+def test_should_let_an_inserted_stage_end_the_sale_before_the_acquirer() -> None:
+    repo = faker.FakeCardNotPresentTransactionRepository(ids=["1", "2", "3"])
+    sale_pipeline = services.build_sale_pipeline().insert_before("register", faker.StubFraudRejectionStage())
+
+    response = services.process_sale(
+        request=faker.TransactionFake.fake(),
+        router=faker.StubApprovedTransactionRouter(),
+        account_range_provider=faker.StubAccountRangeProvider(),
+        repo=repo,
+        sale_pipeline=sale_pipeline,
+    )
+
+    assert response.status == services.TransactionStatus.REJECTED
+    assert response.response_code == "59"
+    assert repo.transaction == {}
+    assert sale_pipeline.stats()["capture"].calls == 0
+
+
+def test_should_overlap_the_stages_of_a_concurrent_stage() -> None:
+    subject = pipeline.Pipeline(stages=(pipeline.ConcurrentStage(name="lookup", stages=(
+        faker.StubSleepingStage(name="first", seconds=0.05), faker.StubSleepingStage(name="second", seconds=0.05))),))
+
+    started = time.perf_counter()
+    asyncio.run(subject.run_async(context=None))
+
+    assert time.perf_counter() - started < 0.09
+
+
+def test_should_overlap_the_blocking_stages_of_a_concurrent_stage_in_threads() -> None:
+    subject = pipeline.Pipeline(stages=(pipeline.ConcurrentStage(name="lookup", stages=(
+        faker.StubBlockingStage(name="first", seconds=0.1), faker.StubBlockingStage(name="second", seconds=0.1))),))
+
+    started = time.perf_counter()
+    asyncio.run(subject.run_async(context=None))
+
+    assert time.perf_counter() - started < 0.18
+    assert subject.stats()["first"].calls == subject.stats()["second"].calls == 1
+    assert subject.stats()["first"].seconds >= 0.1
+
+
+def test_should_count_the_memory_a_stage_leaves_allocated_while_tracing() -> None:
+    subject = pipeline.Pipeline(stages=(faker.StubAllocatingStage(),))
+
+    tracemalloc.start()
+    try:
+        subject.run(context=[])
+    finally:
+        tracemalloc.stop()
+
+    assert subject.stats()["allocate"].allocated_bytes >= 1024 * 1024
@@ -0,0 +1,129 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from checkout.card_processing import adapters, services
+from checkout.infrastructure import metrics
+from checkout.standard_types import card
+from test.checkout.card_processing import faker
+
+
+@pytest.mark.parametrize(
+    "account_range_provider, expected_package",
+    [(faker.StubVisaAccountRangeProvider(),
+      adapters.TransactionPackage(franchise=card.Franchise.VISA, country="UK")),
+     (faker.StubAccountRangeProvider(),
+      adapters.TransactionPackage(franchise=card.Franchise.UNRECOGNIZED, country="FR")),
+     ]
+)
+def test_should_route_the_transaction_by_the_franchise_and_country_of_the_card(
+        account_range_provider: adapters.AccountRangeProvider,
+        expected_package: adapters.TransactionPackage) -> None:
+    router = faker.SpyTransactionRouter()
+
+    services.process_sale(
+        request=faker.TransactionFake.fake(),
+        router=router,
+        account_range_provider=account_range_provider,
+        repo=faker.FakeCardNotPresentTransactionRepository(ids=["1"]),
+    )
+
+    assert router.packages == [expected_package]
+
+
+def test_should_move_an_acquirer_that_keeps_asking_for_retries_behind_a_healthy_one() -> None:
+    flaky = faker.StubRetryableRejectedAcquiringProcessorTransactionProvider()
+    healthy = faker.StubApprovedAcquiringProcessorTransactionProvider()
+    router = adapters.AdaptiveTransactionRouter(default_route=(flaky, healthy), alpha=0.5, exploration_rate=0)
+    package = adapters.TransactionPackage(franchise=card.Franchise.UNRECOGNIZED, country="FR")
+
+    for _ in range(3):
+        for processor in router.get_acquiring_processing_providers(package=package):
+            result = processor.capture(message=None)
+            if isinstance(result, adapters.ApprovedCapture):
+                break
+
+    first_processor = next(router.get_acquiring_processing_providers(package=package))
+    assert isinstance(first_processor.capture(message=None), adapters.ApprovedCapture)
+    stats = router.stats()
+    assert stats[(type(flaky).__name__, card.Franchise.UNRECOGNIZED, "FR")].retryable_rate == 0.5
+
+
+def test_should_open_the_circuit_of_a_failing_acquirer_and_skip_it() -> None:
+    breaker = adapters.CircuitBreakerAcquiringProcessorProvider(
+        provider=faker.StubUnreachableAcquiringProcessorTransactionProvider(),
+        settings=adapters.CircuitBreakerSettings(minimum_calls=2, window_size=4),
+        clock=faker.FakeClock())
+    healthy = faker.StubApprovedAcquiringProcessorTransactionProvider()
+    router = adapters.AdaptiveTransactionRouter(default_route=(breaker, healthy), exploration_rate=0)
+    package = adapters.TransactionPackage(franchise=card.Franchise.UNRECOGNIZED, country="FR")
+
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            breaker.capture(message=None)
+
+    assert breaker.state == adapters.CircuitState.OPEN
+    assert list(router.get_acquiring_processing_providers(package=package))[0].capture(message=None) == \
+           healthy.capture(message=None)
+    assert breaker.capture(message=None).response_code == "F98"
+    assert breaker.stats().transitions == {"CLOSED->OPEN": 1}
+    with mock.patch.object(adapters, "_TRANSACTION_ROUTER", router):
+        exposition = metrics.REGISTRY.exposition()
+    assert ('checkout_circuit_breaker_transitions_total{acquirer="%s",from_state="CLOSED",to_state="OPEN"} 1'
+            % breaker.stats().name) in exposition
+
+
+def test_should_close_the_circuit_when_the_half_open_probes_succeed() -> None:
+    clock = faker.FakeClock()
+    provider = faker.StubUnreachableAcquiringProcessorTransactionProvider()
+    breaker = adapters.CircuitBreakerAcquiringProcessorProvider(
+        provider=provider,
+        settings=adapters.CircuitBreakerSettings(minimum_calls=1, open_seconds=10, half_open_probes=2),
+        clock=clock)
+    with pytest.raises(TimeoutError):
+        breaker.capture(message=None)
+
+    clock.now = 10
+    provider.reachable = True
+    assert breaker.state == adapters.CircuitState.HALF_OPEN
+    breaker.capture(message=None)
+    breaker.capture(message=None)
+
+    assert breaker.state == adapters.CircuitState.CLOSED
+    assert breaker.stats().transitions == {"CLOSED->OPEN": 1, "OPEN->HALF_OPEN": 1, "HALF_OPEN->CLOSED": 1}
+
+
+
+def test_should_count_a_cancelled_half_open_probe_as_a_failure_and_probe_again_later() -> None:
+    clock = faker.FakeClock()
+    breaker = adapters.CircuitBreakerAcquiringProcessorProvider(
+        provider=faker.StubSlowApprovedAcquiringProcessorTransactionProvider(latency_seconds=60),
+        settings=adapters.CircuitBreakerSettings(minimum_calls=1, open_seconds=10, half_open_probes=1),
+        clock=clock)
+
+    for now in (0, 10):
+        clock.now = now
+        # What the capture stage does once the payment deadline is spent.
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(breaker.capture_async(message=None), timeout=0.01))
+        assert breaker.state == adapters.CircuitState.OPEN
+
+    clock.now = 20
+    assert breaker.is_available()
+    assert breaker.stats().transitions == {"CLOSED->OPEN": 1, "OPEN->HALF_OPEN": 2, "HALF_OPEN->OPEN": 1}
+
+
+def test_should_record_the_latency_of_a_cancelled_capture_in_the_router_stats() -> None:
+    slow = faker.StubSlowApprovedAcquiringProcessorTransactionProvider(latency_seconds=60)
+    router = adapters.AdaptiveTransactionRouter(default_route=(slow,), alpha=1.0, exploration_rate=0)
+    package = adapters.TransactionPackage(franchise=card.Franchise.UNRECOGNIZED, country="FR")
+    processor = next(router.get_acquiring_processing_providers(package=package))
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(processor.capture_async(message=None), timeout=0.05))
+
+    stats = router.stats()[(type(slow).__name__, card.Franchise.UNRECOGNIZED, "FR")]
+    assert stats.samples == 1
+    assert stats.latency_seconds >= 0.05
+    assert stats.retryable_rate == 1.0
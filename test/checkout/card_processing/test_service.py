@@ -1,6 +1,10 @@
+import asyncio
+import time
+
 import pytest
 
-from checkout.card_processing import services, adapters
+from checkout.card_processing import model, services, adapters
+from checkout.infrastructure import deadline
 from test.checkout.card_processing import faker
 
 
@@ -25,3 +29,127 @@ def test_should_process_transaction_accordingly(
     )
     assert transaction_response.status == expected_status
     assert transaction_response.attempts == expected_attempts
+
+
+@pytest.mark.parametrize(
+    "router, expected_attempts, expected_status",
+    [(faker.StubApprovedTransactionRouter(), 0, services.TransactionStatus.APPROVED),
+     (faker.StubRetryableApprovedTransactionRouter(), 1, services.TransactionStatus.APPROVED),
+     (faker.StubRejectedTransactionRouter(), 0, services.TransactionStatus.REJECTED),
+     (faker.StubRetryableRejectedTransactionRouter(), 1, services.TransactionStatus.REJECTED),
+     (faker.StubAllRetryableRejectedTransactionRouter(), 2, services.TransactionStatus.REJECTED),
+     ]
+)
+def test_should_process_transaction_accordingly_without_blocking(
+        router: adapters.TransactionRouter, expected_attempts: int,
+        expected_status: services.TransactionStatus) -> None:
+    request = faker.TransactionFake.fake()
+    transaction_response = asyncio.run(services.process_sale_async(
+        request=request,
+        router=router,
+        account_range_provider=faker.StubAccountRangeProvider(),
+        repo=faker.FakeCardNotPresentTransactionRepository(ids=["1", "2", "3"])
+    ))
+    assert transaction_response.status == expected_status
+    assert transaction_response.attempts == expected_attempts
+
+
+@pytest.mark.parametrize(
+    "router, expected_flushes",
+    [(faker.StubApprovedTransactionRouter(), 1),
+     (faker.StubRetryableApprovedTransactionRouter(), 2),
+     (faker.StubAllRetryableRejectedTransactionRouter(), 3),
+     ]
+)
+def test_should_flush_the_unit_of_work_once_before_every_capture(
+        router: adapters.TransactionRouter, expected_flushes: int) -> None:
+    unit_of_work = faker.SpyUnitOfWork()
+    services.process_sale(
+        request=faker.TransactionFake.fake(),
+        router=router,
+        account_range_provider=faker.StubAccountRangeProvider(),
+        repo=faker.FakeCardNotPresentTransactionRepository(ids=["1", "2", "3"]),
+        unit_of_work=unit_of_work,
+    )
+    assert unit_of_work.flushes == expected_flushes
+    assert unit_of_work.commits == 0
+
+
+def test_should_not_retry_when_the_deadline_cannot_cover_another_attempt() -> None:
+    repo = faker.FakeCardNotPresentTransactionRepository(ids=["1", "2", "3"])
+
+    with deadline.scope(0.5), pytest.raises(deadline.DeadlineExceededError):
+        services.process_sale(
+            request=faker.TransactionFake.fake(),
+            router=faker.StubRetryableSlowTransactionRouter(),
+            account_range_provider=faker.StubAccountRangeProvider(),
+            repo=repo,
+        )
+
+    transaction, = repo.transaction.values()
+    assert transaction.status == model.TransactionStatus.REJECTED
+
+
+def test_should_leave_the_transaction_processing_when_the_capture_outlives_the_deadline() -> None:
+    repo = faker.FakeCardNotPresentTransactionRepository(ids=["1", "2", "3"])
+
+    async def process_sale() -> None:
+        with deadline.scope(0.05):
+            await services.process_sale_async(
+                request=faker.TransactionFake.fake(),
+                router=faker.StubSlowTransactionRouter(latency_seconds=1.0),
+                account_range_provider=faker.StubAccountRangeProvider(),
+                repo=repo,
+            )
+
+    with pytest.raises(deadline.DeadlineExceededError):
+        asyncio.run(process_sale())
+
+    transaction, = repo.transaction.values()
+    assert transaction.status == model.TransactionStatus.PROCESSING
+
+
+def test_should_give_a_blocking_capture_only_the_remaining_budget() -> None:
+    repo = faker.FakeCardNotPresentTransactionRepository(ids=["1", "2", "3"])
+
+    started = time.monotonic()
+    with deadline.scope(0.05), pytest.raises(deadline.DeadlineExceededError):
+        services.process_sale(
+            request=faker.TransactionFake.fake(),
+            router=faker.StubSlowTransactionRouter(latency_seconds=1.0),
+            account_range_provider=faker.StubAccountRangeProvider(),
+            repo=repo,
+        )
+
+    assert time.monotonic() - started < 0.5
+    transaction, = repo.transaction.values()
+    assert transaction.status == model.TransactionStatus.PROCESSING
+
+
+def test_should_time_the_captures_by_acquirer_network_and_response_code() -> None:
+    rejections = services.CAPTURE_SECONDS.labels("StubRejectedAcquiringProcessorTransactionProvider", "CKO", "43")
+    timeouts = services.CAPTURE_SECONDS.labels("StubSlowApprovedAcquiringProcessorTransactionProvider", "NONE",
+                                               "timeout")
+    rejections_before, timeouts_before = sum(rejections.counts), sum(timeouts.counts)
+
+    services.process_sale(
+        request=faker.TransactionFake.fake(),
+        router=faker.StubRejectedTransactionRouter(),
+        account_range_provider=faker.StubAccountRangeProvider(),
+        repo=faker.FakeCardNotPresentTransactionRepository(ids=["1"]),
+    )
+
+    async def process_sale() -> None:
+        with deadline.scope(0.05):
+            await services.process_sale_async(
+                request=faker.TransactionFake.fake(),
+                router=faker.StubSlowTransactionRouter(latency_seconds=1.0),
+                account_range_provider=faker.StubAccountRangeProvider(),
+                repo=faker.FakeCardNotPresentTransactionRepository(ids=["1"]),
+            )
+
+    with pytest.raises(deadline.DeadlineExceededError):
+        asyncio.run(process_sale())
+
+    assert sum(rejections.counts) == rejections_before + 1
+    assert sum(timeouts.counts) == timeouts_before + 1
@@ -1,16 +1,23 @@
+import datetime
 import decimal
-from typing import Optional, Dict, List
+from collections.abc import Iterator
+from typing import Any, Callable, Optional, Dict, List, Tuple
 
 import pydantic
 
 from checkout.gateway import adapters, model
 from checkout.gateway import services
+from checkout.infrastructure import deadline
 from checkout.standard_types import money
 
 
 class PaymentRequestFaker:
     @staticmethod
     def with_merchant_id(merchant_id: str) -> services.PaymentRequest:
+        return PaymentRequestFaker.with_pan(merchant_id=merchant_id, pan="1234560000001234")
+
+    @staticmethod
+    def with_pan(merchant_id: str, pan: str) -> services.PaymentRequest:
         return services.PaymentRequest(
             merchant_id=merchant_id,
             currency=money.Currency.EUR,
@@ -21,7 +28,7 @@ class PaymentRequestFaker:
                 cardholder_name="Fulanito de tal",
                 expiration_month=1,
                 expiration_year=2002,
-                pan=pydantic.SecretStr("1234560000001234"),
+                pan=pydantic.SecretStr(pan),
                 cvv=pydantic.SecretStr("123"),
             )
         )
@@ -55,10 +62,11 @@ class StubApprovedTransactionCardNotPresentProvider(adapters.CardNotPresentProvi
                  network: str = "CBK") -> None:
         self.approval_code = approval_code
         self.network = network
+        self.sales = 0
 
     def sale(self, transaction: adapters.Transaction) -> adapters.TransactionResponse:
+        self.sales += 1
         return adapters.TransactionResponse(
-            transaction_id="fake-transaction-id",
             network=self.network,
             response_code="00",
             response_message="Approved or completed successfully",
@@ -74,7 +82,6 @@ class StubRejectedTransactionCardNotPresentProvider(adapters.CardNotPresentProvi
 
     def sale(self, transaction: adapters.Transaction) -> adapters.TransactionResponse:
         return adapters.TransactionResponse(
-            transaction_id="fake-transaction-id",
             network=self.network,
             response_code="05",
             response_message="Do not honor",
@@ -83,29 +90,133 @@ class StubRejectedTransactionCardNotPresentProvider(adapters.CardNotPresentProvi
         )
 
 
+class StubUnavailableForPansCardNotPresentProvider(StubApprovedTransactionCardNotPresentProvider):
+    def __init__(self, unavailable_pans: List[str]) -> None:
+        super().__init__(approval_code="000000123456")
+        self.unavailable_pans = unavailable_pans
+
+    def sale(self, transaction: adapters.Transaction) -> adapters.TransactionResponse:
+        if transaction.card.pan.get_secret_value() in self.unavailable_pans:
+            raise ConnectionError("card processing is unavailable")
+        return super().sale(transaction=transaction)
+
+
+class StubDeadlineExceededCardNotPresentProvider(adapters.CardNotPresentProvider):
+    def __init__(self) -> None:
+        self.sales = 0
+
+    def sale(self, transaction: adapters.Transaction) -> adapters.TransactionResponse:
+        self.sales += 1
+        raise deadline.DeadlineExceededError(deadline.DeadlineExceededError.message)
+
+
 class FakeCardNotPresentPaymentRepository(adapters.CardNotPresentPaymentRepository):
 
     def __init__(self, ids: List[str]) -> None:
         self.ids = ids
         self.payments: Dict[str, model.CardNotPresentPayment] = {}
+        self.bulk_writes = 0
+        self.lookups = 0
+        # Called with every payment written, like a trigger on the payments table.
+        self.listeners: List[Callable[[model.CardNotPresentPayment], None]] = []
 
     def generate_id(self) -> str:
         return self.ids.pop()
 
-    def get_payments(self, merchant_id: str) -> List[model.CardNotPresentPayment]:
-        return [self.payments.get(merchant_id)]
+    def get_payments(self, merchant_id: str, limit: int,
+                     after: Optional[adapters.PaymentPosition] = None) -> List[model.CardNotPresentPayment]:
+        payments = self.iter_payments(merchant_id=merchant_id)
+        if after is not None:
+            payments = (payment for payment in payments
+                        if (payment.payment_date, payment.payment_id) > (after.payment_date, after.payment_id))
+        return list(payments)[:limit]
+
+    def iter_payments(self, merchant_id: str) -> Iterator[model.CardNotPresentPayment]:
+        yield from sorted((payment for payment in self.payments.values() if payment.merchant_id == merchant_id),
+                          key=lambda payment: (payment.payment_date, payment.payment_id))
 
     def find_payment(self, merchant_id: str, payment_id: str) -> Optional[model.CardNotPresentPayment]:
+        self.lookups += 1
         return self.payments.get(payment_id)
 
     def create_payment(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
-        self.payments[payment.payment_id] = payment
+        self._write(payment)
         return payment
 
     def update_payment(self, payment: model.CardNotPresentPayment) -> model.CardNotPresentPayment:
-        self.payments[payment.payment_id] = payment
+        self._write(payment)
         return payment
 
+    def create_payments(self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        self.bulk_writes += 1
+        for payment in payments:
+            self._write(payment)
+        return payments
+
+    def update_payments(self, payments: List[model.CardNotPresentPayment]) -> List[model.CardNotPresentPayment]:
+        self.bulk_writes += 1
+        for payment in payments:
+            self._write(payment)
+        return payments
+
+    def _write(self, payment: model.CardNotPresentPayment) -> None:
+        self.payments[payment.payment_id] = payment
+        for listener in self.listeners:
+            listener(payment)
+
+
+class FakePaymentTotalsRepository(adapters.PaymentTotalsRepository):
+    """
+    Keeps the totals like the trigger on payments: a write takes the previous state of the payment away from the
+    totals and adds the new one, settled payments only.
+    """
+
+    def __init__(self, payments: FakeCardNotPresentPaymentRepository) -> None:
+        self.payments = payments
+        self.totals: Dict[Tuple[str, datetime.date, str, str], List[Any]] = {}
+        self.rebuilt: List[Tuple[str, datetime.date, datetime.date]] = []
+        # The fake repository stores the payments it is given, which the service keeps changing afterwards.
+        self._written: Dict[str, model.CardNotPresentPayment] = {
+            payment.payment_id: payment.model_copy(deep=True) for payment in payments.payments.values()}
+        payments.listeners.append(self.on_write)
+
+    def on_write(self, payment: model.CardNotPresentPayment) -> None:
+        before = self._written.get(payment.payment_id)
+        if before == payment:
+            return
+        self._written[payment.payment_id] = payment.model_copy(deep=True)
+        for state, sign in ((before, -1), (payment, 1)):
+            if state is None or state.status == model.PaymentStatus.PENDING:
+                continue
+            key = (state.merchant_id, model.payment_day(state.payment_date), state.currency.value, state.status.value)
+            total = self.totals.setdefault(key, [0, decimal.Decimal(0), decimal.Decimal(0), decimal.Decimal(0)])
+            total[0] += sign
+            total[1] += sign * state.total_amount
+            total[2] += sign * state.tip
+            total[3] += sign * state.vat
+
+    def get_daily_totals(self, merchant_id: str, since: Optional[datetime.date] = None,
+                         until: Optional[datetime.date] = None) -> List[model.PaymentTotals]:
+        return [model.PaymentTotals(day=day, currency=money.Currency[currency], status=model.PaymentStatus[status],
+                                    payments=count, total_amount=total_amount, tip=tip, vat=vat)
+                for (merchant, day, currency, status), (count, total_amount, tip, vat) in sorted(self.totals.items())
+                if merchant == merchant_id and count != 0
+                and (since is None or day >= since) and (until is None or day <= until)]
+
+    def get_payment_days(self, merchant_id: str) -> Optional[Tuple[datetime.date, datetime.date]]:
+        days = [model.payment_day(payment.payment_date) for payment in self.payments.iter_payments(merchant_id)]
+        return (min(days), max(days)) if days else None
+
+    def rebuild_daily_totals(self, merchant_id: str, since: datetime.date, until: datetime.date) -> None:
+        self.rebuilt.append((merchant_id, since, until))
+        for key in [key for key in self.totals if key[0] == merchant_id and since <= key[1] <= until]:
+            del self.totals[key]
+        payments = [payment for payment in self.payments.iter_payments(merchant_id)
+                    if since <= model.payment_day(payment.payment_date) <= until]
+        for totals in adapters.summarize_payments(payments):
+            self.totals[(merchant_id, totals.day, totals.currency.value, totals.status.value)] = [
+                totals.payments, totals.total_amount, totals.tip, totals.vat]
+
 
 class StubApprovedCardNotPresentPayment:
     @staticmethod
@@ -129,3 +240,45 @@ class StubApprovedCardNotPresentPayment:
             ),
             payment_date=time_ns
         )
+
+
+class FakeIdempotencyStore(adapters.IdempotencyStore):
+    def __init__(self) -> None:
+        self.records: Dict[Tuple[str, str], adapters.IdempotencyRecord] = {}
+
+    def claim(self, record: adapters.IdempotencyRecord) -> Optional[adapters.IdempotencyRecord]:
+        key = (record.merchant_id, record.idempotency_key)
+        if key in self.records:
+            return self.records[key]
+        self.records[key] = record.model_copy()
+        return None
+
+    def find(self, merchant_id: str, idempotency_key: str) -> Optional[adapters.IdempotencyRecord]:
+        return self.records.get((merchant_id, idempotency_key))
+
+    def complete(self, record: adapters.IdempotencyRecord) -> adapters.IdempotencyRecord:
+        self.records[(record.merchant_id, record.idempotency_key)] = record.model_copy()
+        return record
+
+    def release(self, merchant_id: str, idempotency_key: str) -> None:
+        self.records.pop((merchant_id, idempotency_key), None)
+
+
+class FakeMerchantRepository(adapters.MerchantRepository):
+    def __init__(self, merchants: Optional[List[model.Merchant]] = None) -> None:
+        self.merchants: Dict[str, model.Merchant] = {merchant.merchant_id: merchant for merchant in merchants or []}
+        self.bulk_reads = 0
+        self.lookups = 0
+
+    @classmethod
+    def with_active(cls, *merchant_ids: str) -> "FakeMerchantRepository":
+        return cls([model.Merchant(merchant_id=merchant_id, status=model.MerchantStatus.ACTIVE)
+                    for merchant_id in merchant_ids])
+
+    def get_merchants(self) -> List[model.Merchant]:
+        self.bulk_reads += 1
+        return list(self.merchants.values())
+
+    def find_merchant(self, merchant_id: str) -> Optional[model.Merchant]:
+        self.lookups += 1
+        return self.merchants.get(merchant_id)
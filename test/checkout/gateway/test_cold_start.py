@@ -0,0 +1,22 @@
+import os
+
+from benchmark import cold_start
+
+# Time to the first payment of a fresh interpreter, generous enough for a loaded CI runner while still catching an
+# eager import or a schema built at import time that multiplies it.
+COLD_START_BUDGET_SECONDS = float(os.environ.get("CHECKOUT_COLD_START_BUDGET_SECONDS", "3"))
+
+
+def test_should_answer_the_first_payment_of_a_cold_start_within_the_budget() -> None:
+    run = cold_start.measure(warmup=True)
+
+    assert run.status_code == 200
+    assert run.total_seconds < COLD_START_BUDGET_SECONDS
+
+
+def test_should_not_import_the_database_driver_before_the_first_connection() -> None:
+    modules = {entry.module for entry in cold_start.profile_imports()}
+
+    assert "checkout.gateway.entrypoint" in modules
+    assert "psycopg2" not in modules
+    assert "checkout.infrastructure.migrations.runner" not in modules
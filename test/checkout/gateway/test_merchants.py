@@ -0,0 +1,91 @@
+import os
+import threading
+from typing import Optional
+from unittest import mock
+
+from checkout.gateway import adapters, model
+from test.checkout.card_processing import faker as card_processing_faker
+from test.checkout.gateway import faker
+
+
+def test_should_answer_the_merchants_from_memory_once_loaded() -> None:
+    repository = faker.FakeMerchantRepository.with_active("1", "2")
+    merchants = adapters.CachedMerchantRepository(repository=repository)
+
+    merchants.load()
+
+    assert merchants.find_merchant(merchant_id="1").is_active
+    assert merchants.find_merchant(merchant_id="2").is_active
+    assert repository.bulk_reads == 1
+    assert repository.lookups == 0
+
+
+def test_should_read_a_merchant_again_when_notified_or_once_its_entry_expired() -> None:
+    clock = card_processing_faker.FakeClock()
+    repository = faker.FakeMerchantRepository.with_active("1", "2")
+    merchants = adapters.CachedMerchantRepository(repository=repository, ttl_seconds=60, clock=clock)
+    merchants.load()
+    for merchant_id in ("1", "2"):
+        repository.merchants[merchant_id] = model.Merchant(merchant_id=merchant_id,
+                                                           status=model.MerchantStatus.INACTIVE)
+
+    merchants.refresh("1")
+
+    assert not merchants.find_merchant(merchant_id="1").is_active
+    assert merchants.find_merchant(merchant_id="2").is_active
+    clock.now = 60
+    assert not merchants.find_merchant(merchant_id="2").is_active
+
+
+def test_should_not_keep_a_merchant_read_before_the_change_it_was_notified_of() -> None:
+    repository = faker.FakeMerchantRepository.with_active("1")
+    merchants = adapters.CachedMerchantRepository(repository=repository)
+    reading = threading.Event()
+    notified = threading.Event()
+    stale_find = repository.find_merchant
+
+    def find_before_the_change(merchant_id: str) -> Optional[model.Merchant]:
+        merchant = stale_find(merchant_id)
+        reading.set()
+        notified.wait(5)
+        return merchant
+
+    repository.find_merchant = find_before_the_change
+    stale_read = threading.Thread(target=merchants.find_merchant, args=("1",))
+    stale_read.start()
+    assert reading.wait(5)
+    repository.find_merchant = stale_find
+    repository.merchants["1"] = model.Merchant(merchant_id="1", status=model.MerchantStatus.INACTIVE)
+
+    refreshed = merchants.refresh("1")
+    notified.set()
+    stale_read.join(5)
+
+    assert not refreshed.is_active
+    assert not merchants.find_merchant(merchant_id="1").is_active
+    assert repository.lookups == 2
+
+
+def test_should_not_listen_to_merchant_changes_when_disabled() -> None:
+    with mock.patch.dict(os.environ, {"CHECKOUT_MERCHANT_CACHE_LISTEN": "0"}), \
+            mock.patch.object(adapters, "_MERCHANTS", adapters.CachedMerchantRepository(
+                repository=faker.FakeMerchantRepository())), \
+            mock.patch.object(adapters.notifications, "NotificationListener") as listener:
+        adapters.start_merchant_cache()
+
+    listener.assert_not_called()
+
+
+def test_should_remember_an_unknown_merchant_for_a_while() -> None:
+    clock = card_processing_faker.FakeClock()
+    repository = faker.FakeMerchantRepository()
+    merchants = adapters.CachedMerchantRepository(repository=repository, unknown_ttl_seconds=5, clock=clock)
+    merchants.load()
+
+    for _ in range(3):
+        assert merchants.find_merchant(merchant_id="1") is None
+    assert repository.lookups == 1
+
+    repository.merchants["1"] = model.Merchant(merchant_id="1", status=model.MerchantStatus.ACTIVE)
+    clock.now = 5
+    assert merchants.find_merchant(merchant_id="1").is_active
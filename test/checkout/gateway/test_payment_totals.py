@@ -0,0 +1,103 @@
+import datetime
+import decimal
+import random
+from unittest import mock
+
+import pytest
+
+from checkout.gateway import adapters, backfill, model, services
+from checkout.infrastructure import database
+from checkout.standard_types import money
+from test.checkout.gateway import faker
+from test.checkout.infrastructure import faker as infrastructure_faker
+
+_DAY = datetime.date(2024, 3, 1)
+
+
+def _pay(repository: faker.FakeCardNotPresentPaymentRepository, rng: random.Random, merchant_id: str,
+         day: datetime.date) -> None:
+    request = faker.PaymentRequestFaker.with_merchant_id(merchant_id=merchant_id).model_copy(update={
+        "currency": rng.choice(list(money.Currency)),
+        "total_amount": decimal.Decimal(rng.randint(100, 99999)) / 100,
+        "tip": decimal.Decimal(rng.randint(0, 999)) / 100,
+        "vat": decimal.Decimal(rng.randint(0, 1999)) / 100,
+    })
+    processor = rng.choice([faker.StubApprovedTransactionCardNotPresentProvider(approval_code="000000123456"),
+                            faker.StubRejectedTransactionCardNotPresentProvider()])
+    # Anywhere in the day, including its first and last nanosecond.
+    payment_date = model.day_start(day) + rng.choice([0, model.NANOSECONDS_PER_DAY - 1,
+                                                      rng.randrange(model.NANOSECONDS_PER_DAY)])
+    with mock.patch("checkout.standard_types.helpers.time_ns", return_value=payment_date):
+        services.process_payment(request=request, repository=repository, processor=processor)
+
+
+def _row(totals) -> tuple:
+    return (totals.day, totals.currency, totals.status.value, totals.payments, totals.total_amount, totals.tip,
+            totals.vat)
+
+
+def test_should_keep_the_totals_equal_to_a_full_scan_of_the_payments() -> None:
+    rng = random.Random(7)
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=[str(n) for n in range(300)])
+    totals = faker.FakePaymentTotalsRepository(payments=repository)
+    for _ in range(300):
+        _pay(repository, rng, merchant_id=rng.choice(["1", "2"]), day=_DAY + datetime.timedelta(days=rng.randint(0, 9)))
+    settled = [payment for payment in repository.payments.values() if payment.status == model.PaymentStatus.APPROVED]
+    for payment in rng.sample(settled, 20):
+        voided = payment.model_copy(update={"status": model.PaymentStatus.VOIDED})
+        repository.update_payment(voided)
+        # Written again in the same state, like a replayed write-behind journal.
+        repository.update_payments([voided.model_copy()])
+
+    for merchant_id in ("1", "2"):
+        summary = services.get_merchant_summary(merchant_id=merchant_id, repository=totals)
+        scanned = adapters.summarize_payments(repository.iter_payments(merchant_id=merchant_id))
+        assert totals.get_daily_totals(merchant_id=merchant_id) == scanned
+        assert [_row(total) for total in summary.totals] == [_row(total) for total in scanned]
+        assert sum(total.payments for total in summary.totals) == len(list(repository.iter_payments(merchant_id)))
+
+    week = services.get_merchant_summary(merchant_id="1", repository=totals, since=_DAY + datetime.timedelta(days=2),
+                                         until=_DAY + datetime.timedelta(days=8))
+    assert {total.day for total in week.totals} == {_DAY + datetime.timedelta(days=n) for n in range(2, 9)}
+
+
+def test_should_rebuild_the_totals_of_every_merchant_in_chunks_of_days() -> None:
+    rng = random.Random(11)
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=[str(n) for n in range(100)])
+    for n in range(100):
+        _pay(repository, rng, merchant_id=str(n % 2), day=_DAY + datetime.timedelta(days=n % 10))
+    # Attached after the payments were written, like totals created by the migration.
+    totals = faker.FakePaymentTotalsRepository(payments=repository)
+
+    rebuilt = backfill.backfill_payment_totals(totals=totals, merchant_ids=["0", "1", "unknown"], days=4)
+
+    assert rebuilt == 6
+    assert totals.rebuilt[:3] == [("0", _DAY, _DAY + datetime.timedelta(days=3)),
+                                  ("0", _DAY + datetime.timedelta(days=4), _DAY + datetime.timedelta(days=7)),
+                                  ("0", _DAY + datetime.timedelta(days=8), _DAY + datetime.timedelta(days=8))]
+    for merchant_id in ("0", "1"):
+        assert totals.get_daily_totals(merchant_id) == adapters.summarize_payments(
+            repository.iter_payments(merchant_id=merchant_id))
+
+
+def test_should_rebuild_the_totals_of_a_chunk_in_one_transaction_holding_the_merchant_lock() -> None:
+    factory = infrastructure_faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(min_size=0), connect=factory)
+    repository = adapters.PostgresPaymentTotalsRepository(pool=pool)
+
+    repository.rebuild_daily_totals(merchant_id="1", since=_DAY, until=_DAY + datetime.timedelta(days=6))
+
+    connection, = factory.connections
+    assert "pg_advisory_xact_lock" in connection.executed[0]
+    assert connection.params[0] == (adapters.PAYMENT_TOTALS_LOCK_KEY, "1")
+    assert connection.executed[1].startswith("DELETE FROM payment_daily_totals")
+    assert connection.params[2][-2:] == (model.day_start(_DAY), model.day_start(_DAY + datetime.timedelta(days=7)))
+    assert connection.commits == 1
+
+
+def test_should_refuse_a_summary_ending_before_it_starts() -> None:
+    totals = faker.FakePaymentTotalsRepository(payments=faker.FakeCardNotPresentPaymentRepository(ids=[]))
+
+    with pytest.raises(services.InvalidDateRangeError):
+        services.get_merchant_summary(merchant_id="1", repository=totals, since=_DAY,
+                                      until=_DAY - datetime.timedelta(days=1))
@@ -0,0 +1,60 @@
+import asyncio
+import json
+import pathlib
+from typing import Any, Callable, Dict, Iterator
+
+from benchmark import asgi
+from checkout.gateway import recording
+
+
+def _payment(pan: str) -> Dict[str, Any]:
+    return {
+        "merchant_id": "1",
+        "currency": "EUR",
+        "total_amount": "100.0",
+        "card": {"cardholder_name": "Juls Cesar", "expiration_month": 12, "expiration_year": 2030,
+                 "pan": pan, "cvv": "123"},
+    }
+
+
+async def _echo_app(scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+    message = await receive()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": message.get("body", b"")})
+
+
+def test_should_keep_the_bin_and_last_four_digits_of_a_recorded_pan() -> None:
+    assert recording.sanitize_pan("3333111122223333") == "3333110000003333"
+    assert recording.sanitize_pan("4444444444444444") == "4444444444444444"
+
+
+def test_should_sanitize_every_card_of_a_batch() -> None:
+    body = json.dumps({"payments": [_payment("3333111122223333"), _payment("5555555555555555")]}).encode()
+
+    content = recording.sanitize_body(path="/v1/payments/batch", body=body)
+
+    assert [payment["card"]["pan"] for payment in content["payments"]] == ["3333110000003333", "5555555555555555"]
+    assert {payment["card"]["cvv"] for payment in content["payments"]} == {"000"}
+    assert {payment["card"]["cardholder_name"] for payment in content["payments"]} == {"TEST CARDHOLDER"}
+
+
+def test_should_record_payments_with_their_arrival_offset(tmp_path: pathlib.Path) -> None:
+    record_file = tmp_path / "traffic.jsonl"
+    ticks: Iterator[float] = iter([100.0, 100.25])
+    recorder = recording.TrafficRecorder(_echo_app, path=str(record_file), clock=lambda: next(ticks))
+
+    async def traffic() -> None:
+        await asgi.request(recorder, method="POST", path="/v1/payments",
+                           body=json.dumps(_payment("3333111122223333")).encode(),
+                           headers=[(b"content-type", b"application/json"), (b"idempotency-key", b"key-1")])
+        await asgi.request(recorder, method="GET", path="/v1/payments")
+        await asgi.request(recorder, method="POST", path="/v1/payments",
+                           body=json.dumps(_payment("4444444444444444")).encode())
+    asyncio.run(traffic())
+
+    lines = [json.loads(line) for line in record_file.read_text().splitlines()]
+    assert recorder.recorded == 2
+    assert [(line["offset_seconds"], line["idempotency_key"], line["body"]["card"]["pan"]) for line in lines] == [
+        (0.0, "key-1", "3333110000003333"),
+        (0.25, None, "4444444444444444"),
+    ]
@@ -1,8 +1,17 @@
+import asyncio
+import json
 import time
+from typing import List
 from unittest import mock
 
-from checkout.gateway import services
+import pydantic
+import pytest
+
+from checkout.gateway import adapters, cleanup, model, services
+from checkout.infrastructure import cache, database, deadline
+from test.checkout.card_processing import faker as card_processing_faker
 from test.checkout.gateway import faker
+from test.checkout.infrastructure import faker as infrastructure_faker
 
 
 @mock.patch("checkout.standard_types.helpers.time_ns", return_value=time.time_ns())
@@ -54,3 +63,435 @@ def test_should_save_the_transaction_result(time_ns_mock: mock.MagicMock) -> Non
         ))
 
     assert expected_payment == repository.find_payment(merchant_id="1", payment_id="1")
+
+
+@mock.patch("checkout.standard_types.helpers.time_ns", return_value=time.time_ns())
+def test_should_save_the_transaction_result_without_blocking(time_ns_mock: mock.MagicMock) -> None:
+    request = faker.PaymentRequestFaker.with_merchant_id(
+        merchant_id="fake-merchant-id"
+    )
+
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=["1"])
+    expected_payment = faker.StubApprovedCardNotPresentPayment.with_attrs(
+        payment_id="1", merchant_id="fake-merchant-id",
+        approval_code="000000123456", time_ns=time_ns_mock.return_value)
+
+    payment_response = asyncio.run(services.process_payment_async(
+        request=request,
+        repository=repository,
+        processor=faker.StubApprovedTransactionCardNotPresentProvider(
+            approval_code="000000123456"
+        )))
+
+    assert payment_response == faker.PaymentResponseFaker.with_approved_transaction(
+        payment_id="1", approval_code="000000123456")
+    assert expected_payment == repository.find_payment(merchant_id="1", payment_id="1")
+
+
+def test_should_page_through_the_payments_of_a_merchant_with_the_next_cursor() -> None:
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=[])
+    for payment_id, time_ns in [("3", 30), ("1", 10), ("2", 20)]:
+        repository.create_payment(faker.StubApprovedCardNotPresentPayment.with_attrs(
+            payment_id=payment_id, merchant_id="fake-merchant-id", approval_code="000000123456", time_ns=time_ns))
+    repository.create_payment(faker.StubApprovedCardNotPresentPayment.with_attrs(
+        payment_id="4", merchant_id="other-merchant-id", approval_code="000000123456", time_ns=5))
+
+    first_page = services.get_payments(merchant_id="fake-merchant-id", repository=repository, limit=2)
+    second_page = services.get_payments(merchant_id="fake-merchant-id", repository=repository, limit=2,
+                                        cursor=first_page.next_cursor)
+
+    assert [payment.payment_id for payment in first_page.payments] == ["1", "2"]
+    assert [payment.payment_id for payment in second_page.payments] == ["3"]
+    assert second_page.next_cursor is None
+
+
+def test_should_reject_a_cursor_that_was_not_issued_by_the_gateway() -> None:
+    with pytest.raises(services.InvalidCursorError):
+        services.get_payments(merchant_id="fake-merchant-id",
+                              repository=faker.FakeCardNotPresentPaymentRepository(ids=[]),
+                              cursor="not-a-cursor")
+
+
+def test_should_stream_every_payment_of_a_merchant_as_ndjson() -> None:
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=[])
+    for payment_id, time_ns in [("2", 20), ("1", 10)]:
+        repository.create_payment(faker.StubApprovedCardNotPresentPayment.with_attrs(
+            payment_id=payment_id, merchant_id="fake-merchant-id", approval_code="000000123456", time_ns=time_ns))
+
+    lines = list(services.stream_payments(merchant_id="fake-merchant-id", repository=repository))
+
+    assert [json.loads(line)["payment_id"] for line in lines] == ["1", "2"]
+    assert all(line.endswith("\n") for line in lines)
+
+
+def test_should_answer_every_payment_of_a_batch_even_when_one_of_them_fails() -> None:
+    request = services.BatchPaymentRequest(payments=[
+        faker.PaymentRequestFaker.with_pan(merchant_id="fake-merchant-id", pan="1234560000001234"),
+        faker.PaymentRequestFaker.with_pan(merchant_id="fake-merchant-id", pan="4444440000004444"),
+        faker.PaymentRequestFaker.with_pan(merchant_id="fake-merchant-id", pan="5555550000005555"),
+    ])
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=["3", "2", "1"])
+
+    batch_response = asyncio.run(services.process_payments_async(
+        request=request,
+        repository=repository,
+        processor=faker.StubUnavailableForPansCardNotPresentProvider(unavailable_pans=["4444440000004444"]),
+        concurrency=2))
+
+    assert [(payment.payment_id, payment.status) for payment in batch_response.payments] == [
+        ("1", services.PaymentStatus.APPROVED),
+        ("2", services.PaymentStatus.PENDING),
+        ("3", services.PaymentStatus.APPROVED)]
+    assert repository.find_payment(merchant_id="fake-merchant-id", payment_id="2").status == \
+           model.PaymentStatus.PENDING
+    assert repository.bulk_writes == 2
+
+
+def test_should_write_a_retried_payment_in_one_commit_per_capture_plus_one() -> None:
+    factory = infrastructure_faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(), connect=factory)
+    unit_of_work = database.PostgresUnitOfWork(pool=pool)
+
+    payment_response = services.process_payment(
+        request=faker.PaymentRequestFaker.with_merchant_id(merchant_id="fake-merchant-id"),
+        repository=adapters.PostgresCardNotPresentPaymentRepository(pool=pool, unit_of_work=unit_of_work),
+        processor=adapters.FlashyCardNotPresentProvider(
+            router=card_processing_faker.StubRetryableApprovedTransactionRouter(),
+            account_range_provider=card_processing_faker.StubAccountRangeProvider(),
+            unit_of_work=unit_of_work),
+        unit_of_work=unit_of_work)
+
+    connection, = factory.connections
+    assert payment_response.status == services.PaymentStatus.APPROVED
+    assert connection.commits == 3
+    assert [statement.split(" (")[0] for statement in connection.executed] == [
+        "INSERT INTO payments", "INSERT INTO transactions",
+        "INSERT INTO transactions",
+        "INSERT INTO transactions", "INSERT INTO payments"]
+
+
+def test_should_leave_the_payment_pending_when_the_deadline_cannot_cover_a_retry() -> None:
+    factory = infrastructure_faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(), connect=factory)
+    unit_of_work = database.PostgresUnitOfWork(pool=pool)
+
+    with deadline.scope(0.5):
+        payment_response = services.process_payment(
+            request=faker.PaymentRequestFaker.with_merchant_id(merchant_id="fake-merchant-id"),
+            repository=adapters.PostgresCardNotPresentPaymentRepository(pool=pool, unit_of_work=unit_of_work),
+            processor=adapters.FlashyCardNotPresentProvider(
+                router=card_processing_faker.StubRetryableSlowTransactionRouter(),
+                account_range_provider=card_processing_faker.StubAccountRangeProvider(),
+                unit_of_work=unit_of_work),
+            unit_of_work=unit_of_work)
+
+    connection, = factory.connections
+    assert payment_response.status == services.PaymentStatus.PENDING
+    assert connection.commits == 2
+    assert [statement.split(" (")[0] for statement in connection.executed] == [
+        "SET LOCAL statement_timeout = %s", "INSERT INTO payments", "INSERT INTO transactions",
+        "INSERT INTO transactions"]
+
+
+def test_should_answer_a_retried_payment_with_the_stored_response_without_paying_again() -> None:
+    request = faker.PaymentRequestFaker.with_merchant_id(merchant_id="fake-merchant-id")
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=["2", "1"])
+    processor = faker.StubApprovedTransactionCardNotPresentProvider(approval_code="000000123456")
+    idempotency_store = faker.FakeIdempotencyStore()
+
+    async def pay() -> services.PaymentResponse:
+        return await services.process_payment_idempotently_async(
+            request=request, idempotency_key="fake-key", repository=repository, processor=processor,
+            idempotency_store=idempotency_store)
+
+    first_response = asyncio.run(pay())
+    retried_response = asyncio.run(pay())
+
+    assert retried_response == first_response
+    assert processor.sales == 1
+    assert list(repository.payments) == ["1"]
+
+
+def test_should_answer_a_retry_of_a_payment_cut_short_by_the_deadline_with_its_final_state() -> None:
+    request = faker.PaymentRequestFaker.with_merchant_id(merchant_id="fake-merchant-id")
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=["1"])
+    processor = faker.StubDeadlineExceededCardNotPresentProvider()
+    idempotency_store = faker.FakeIdempotencyStore()
+
+    async def pay() -> services.PaymentResponse:
+        return await services.process_payment_idempotently_async(
+            request=request, idempotency_key="fake-key", repository=repository, processor=processor,
+            idempotency_store=idempotency_store)
+
+    pending_response = asyncio.run(pay())
+    still_pending_response = asyncio.run(pay())
+    # Resolved later from its transactions.
+    repository.payments["1"].approve(response_code="00", response_message="Approved or completed successfully",
+                                     approval_code="000000123456")
+    resolved_response = asyncio.run(pay())
+    replayed_response = asyncio.run(pay())
+
+    assert pending_response.status == still_pending_response.status == services.PaymentStatus.PENDING
+    assert (resolved_response.payment_id, resolved_response.status, resolved_response.approval_code) == (
+        "1", services.PaymentStatus.APPROVED, "000000123456")
+    assert replayed_response == resolved_response
+    assert processor.sales == 1
+    assert repository.lookups == 2
+
+
+def test_should_share_the_in_flight_payment_with_concurrent_duplicates() -> None:
+    request = faker.PaymentRequestFaker.with_merchant_id(merchant_id="fake-merchant-id")
+    processor = faker.StubApprovedTransactionCardNotPresentProvider(approval_code="000000123456")
+
+    async def pay_twice() -> List[services.PaymentResponse]:
+        repository = faker.FakeCardNotPresentPaymentRepository(ids=["2", "1"])
+        idempotency_store = faker.FakeIdempotencyStore()
+        return await asyncio.gather(*(services.process_payment_idempotently_async(
+            request=request, idempotency_key="fake-key", repository=repository, processor=processor,
+            idempotency_store=idempotency_store) for _ in range(2)))
+
+    first_response, duplicate_response = asyncio.run(pay_twice())
+
+    assert duplicate_response == first_response
+    assert processor.sales == 1
+
+
+def test_should_refuse_an_idempotency_key_reused_with_a_different_request() -> None:
+    idempotency_store = faker.FakeIdempotencyStore()
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=["2", "1"])
+    processor = faker.StubApprovedTransactionCardNotPresentProvider()
+
+    asyncio.run(services.process_payment_idempotently_async(
+        request=faker.PaymentRequestFaker.with_pan(merchant_id="fake-merchant-id", pan="1234560000001234"),
+        idempotency_key="fake-key", repository=repository, processor=processor, idempotency_store=idempotency_store))
+
+    with pytest.raises(services.IdempotencyKeyReusedError):
+        asyncio.run(services.process_payment_idempotently_async(
+            request=faker.PaymentRequestFaker.with_pan(merchant_id="fake-merchant-id", pan="4444440000004444"),
+            idempotency_key="fake-key", repository=repository, processor=processor,
+            idempotency_store=idempotency_store))
+
+
+def test_should_fingerprint_an_idempotent_request_without_its_cvv() -> None:
+    idempotency_store = faker.FakeIdempotencyStore()
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=["2", "1"])
+    processor = faker.StubApprovedTransactionCardNotPresentProvider()
+    request = faker.PaymentRequestFaker.with_pan(merchant_id="fake-merchant-id", pan="1234560000001234")
+    retried_request = request.model_copy(update={"card": request.card.model_copy(update={
+        "cvv": pydantic.SecretStr("999")})})
+
+    async def pay(payment_request: services.PaymentRequest) -> services.PaymentResponse:
+        return await services.process_payment_idempotently_async(
+            request=payment_request, idempotency_key="fake-key", repository=repository, processor=processor,
+            idempotency_store=idempotency_store)
+
+    first_response = asyncio.run(pay(request))
+    retried_response = asyncio.run(pay(retried_request))
+
+    assert retried_response == first_response
+    assert processor.sales == 1
+
+
+def test_should_claim_an_idempotency_key_or_read_its_holder_in_a_single_statement() -> None:
+    factory = infrastructure_faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(), connect=factory)
+    with pool.connection() as connection:
+        connection.results.append([("1", "fake-key", "f", None, True)])
+        connection.results.append([("1", "fake-key", "f", None, False)])
+    store = adapters.PostgresIdempotencyStore(pool=pool, ttl_seconds=60)
+    record = adapters.IdempotencyRecord(merchant_id="1", idempotency_key="fake-key", fingerprint="f")
+
+    with mock.patch("checkout.standard_types.helpers.time_ns", return_value=1000):
+        claimed = store.claim(record)
+        holder = store.claim(record)
+
+    assert claimed is None
+    assert holder == record
+    assert len(connection.executed) == 2
+    assert connection.params[0] == ("1", "fake-key", "f", 1000, 1000 + 60 * 10 ** 9)
+
+
+def test_should_delete_the_expired_idempotency_keys_in_batches() -> None:
+    factory = infrastructure_faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(), connect=factory)
+    with pool.connection() as connection:
+        connection.results.extend([[("1",), ("1",)], [("2",), ("2",)], [("3",)]])
+
+    with mock.patch("checkout.standard_types.helpers.time_ns", return_value=1000):
+        deleted = cleanup.delete_expired_idempotency_keys(store=adapters.PostgresIdempotencyStore(pool=pool),
+                                                          batch_size=2)
+
+    assert deleted == 5
+    assert connection.params == [(1000, 2)] * 3
+    assert connection.commits == 3
+
+
+def test_should_free_the_idempotency_key_of_a_failed_payment() -> None:
+    idempotency_store = faker.FakeIdempotencyStore()
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(services.process_payment_idempotently_async(
+            request=faker.PaymentRequestFaker.with_pan(merchant_id="fake-merchant-id", pan="4444440000004444"),
+            idempotency_key="fake-key",
+            repository=faker.FakeCardNotPresentPaymentRepository(ids=["1"]),
+            processor=faker.StubUnavailableForPansCardNotPresentProvider(unavailable_pans=["4444440000004444"]),
+            idempotency_store=idempotency_store))
+
+    assert idempotency_store.records == {}
+
+
+def test_should_serve_repeated_polls_of_a_settled_payment_from_the_cache() -> None:
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=[])
+    repository.create_payment(faker.StubApprovedCardNotPresentPayment.with_attrs(
+        payment_id="1", merchant_id="fake-merchant-id", approval_code="000000123456", time_ns=time.time_ns()))
+    cached_repository = adapters.CachedCardNotPresentPaymentRepository(
+        repository=repository, payments=cache.TTLCache(max_size=10, ttl_seconds=60))
+
+    responses = [services.get_payment(merchant_id="fake-merchant-id", payment_id="1", repository=cached_repository)
+                 for _ in range(3)]
+
+    assert all(response.status == services.PaymentStatus.APPROVED for response in responses)
+    assert repository.lookups == 1
+
+
+def test_should_drop_the_cached_payment_when_its_status_is_updated() -> None:
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=[])
+    payment = faker.StubApprovedCardNotPresentPayment.with_attrs(
+        payment_id="1", merchant_id="fake-merchant-id", approval_code="", time_ns=time.time_ns())
+    payment.status = model.PaymentStatus.PENDING
+    repository.create_payment(payment)
+    cached_repository = adapters.CachedCardNotPresentPaymentRepository(
+        repository=repository, payments=cache.TTLCache(max_size=10, ttl_seconds=60))
+    cached_repository.find_payment(merchant_id="fake-merchant-id", payment_id="1")
+
+    approved = payment.model_copy(update={"status": model.PaymentStatus.APPROVED})
+    cached_repository.update_payment(payment=approved)
+
+    assert cached_repository.find_payment(
+        merchant_id="fake-merchant-id", payment_id="1").status == model.PaymentStatus.APPROVED
+    assert repository.lookups == 2
+
+
+def test_should_drop_the_cached_payment_only_once_its_update_is_committed() -> None:
+    factory = infrastructure_faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(), connect=factory)
+    unit_of_work = database.PostgresUnitOfWork(pool=pool)
+    payments = cache.TTLCache(max_size=10, ttl_seconds=60)
+    payment = faker.StubApprovedCardNotPresentPayment.with_attrs(
+        payment_id="1", merchant_id="fake-merchant-id", approval_code="", time_ns=time.time_ns())
+    payment.status = model.PaymentStatus.PENDING
+    payments.set(("fake-merchant-id", "1"), payment)
+    cached_repository = adapters.CachedCardNotPresentPaymentRepository(
+        repository=adapters.PostgresCardNotPresentPaymentRepository(pool=pool, unit_of_work=unit_of_work),
+        payments=payments, unit_of_work=unit_of_work)
+
+    cached_repository.update_payment(payment=payment.model_copy(update={"status": model.PaymentStatus.APPROVED}))
+    staged = payments.get(("fake-merchant-id", "1"))
+    unit_of_work.commit()
+
+    assert staged is not None and staged.status == model.PaymentStatus.PENDING
+    assert payments.get(("fake-merchant-id", "1")) is None
+
+
+def test_should_answer_only_the_requested_fields_of_a_payment() -> None:
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=[])
+    repository.create_payment(faker.StubApprovedCardNotPresentPayment.with_attrs(
+        payment_id="1", merchant_id="fake-merchant-id", approval_code="000000123456", time_ns=time.time_ns()))
+
+    view = services.get_payment_view(merchant_id="fake-merchant-id", payment_id="1", repository=repository,
+                                     fields=services.parse_fields("payment_id, status"))
+    full_view = services.get_payment_view(merchant_id="fake-merchant-id", payment_id="1", repository=repository)
+
+    assert view == {"payment_id": "1", "status": "APPROVED"}
+    assert services.encode_json(full_view) == services.get_payment(
+        merchant_id="fake-merchant-id", payment_id="1", repository=repository).model_dump_json()
+
+
+def test_should_refuse_unknown_payment_fields() -> None:
+    with pytest.raises(services.InvalidFieldsError):
+        services.parse_fields("payment_id,card_masked_pan")
+
+
+def test_should_read_only_the_columns_of_the_requested_fields() -> None:
+    factory = infrastructure_faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(), connect=factory)
+    with pool.connection() as connection:
+        connection.results.append([(1, "1", "1", "APPROVED"), (2, "2", "2", "PENDING")])
+
+    page = services.get_payment_views(
+        merchant_id="fake-merchant-id", repository=adapters.PostgresCardNotPresentPaymentRepository(pool=pool),
+        fields=("payment_id", "status"), limit=1)
+
+    statement, = connection.executed
+    assert " ".join(statement.split()).startswith(
+        "SELECT payment_date, payment_id, payment_id, status FROM payments WHERE")
+    assert page["payments"] == [{"payment_id": "1", "status": "APPROVED"}]
+    assert page["next_cursor"] is not None
+
+
+@pytest.mark.parametrize("merchants", [
+    faker.FakeMerchantRepository(),
+    faker.FakeMerchantRepository([
+        model.Merchant(merchant_id="fake-merchant-id", status=model.MerchantStatus.INACTIVE)]),
+])
+def test_should_refuse_a_payment_for_an_unknown_or_inactive_merchant_before_writing_it(
+        merchants: faker.FakeMerchantRepository) -> None:
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=["1"])
+    processor = faker.StubApprovedTransactionCardNotPresentProvider()
+    idempotency_store = faker.FakeIdempotencyStore()
+
+    with pytest.raises((services.UnknownMerchantError, services.InactiveMerchantError)):
+        asyncio.run(services.process_payment_idempotently_async(
+            request=faker.PaymentRequestFaker.with_merchant_id(merchant_id="fake-merchant-id"),
+            idempotency_key="fake-key", repository=repository, processor=processor,
+            idempotency_store=idempotency_store, merchants=merchants))
+
+    assert repository.payments == {}
+    assert idempotency_store.records == {}
+    assert processor.sales == 0
+
+
+def test_should_answer_the_payments_of_a_batch_still_going_on_at_the_deadline_as_pending() -> None:
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=["2", "1"])
+    processor = adapters.FlashyCardNotPresentProvider(
+        router=card_processing_faker.StubSlowTransactionRouter(latency_seconds=1.0),
+        account_range_provider=card_processing_faker.StubAccountRangeProvider())
+
+    async def pay_within_deadline() -> services.BatchPaymentResponse:
+        with deadline.scope(0.2):
+            return await services.process_payments_async(
+                request=services.BatchPaymentRequest(payments=[
+                    faker.PaymentRequestFaker.with_merchant_id(merchant_id="fake-merchant-id") for _ in range(2)]),
+                repository=repository, processor=processor)
+
+    started = time.monotonic()
+    batch_response = asyncio.run(pay_within_deadline())
+
+    assert time.monotonic() - started < 0.8
+    assert [payment.status for payment in batch_response.payments] == [services.PaymentStatus.PENDING] * 2
+    assert [payment.status for payment in repository.payments.values()] == [model.PaymentStatus.PENDING] * 2
+
+
+def test_should_reject_only_the_payments_of_a_batch_for_unknown_or_inactive_merchants() -> None:
+    repository = faker.FakeCardNotPresentPaymentRepository(ids=["2", "1"])
+    merchants = faker.FakeMerchantRepository([
+        model.Merchant(merchant_id="fake-merchant-id", status=model.MerchantStatus.ACTIVE),
+        model.Merchant(merchant_id="inactive-merchant-id", status=model.MerchantStatus.INACTIVE)])
+
+    batch_response = asyncio.run(services.process_payments_async(
+        request=services.BatchPaymentRequest(payments=[
+            faker.PaymentRequestFaker.with_merchant_id(merchant_id="unknown-merchant-id"),
+            faker.PaymentRequestFaker.with_merchant_id(merchant_id="fake-merchant-id"),
+            faker.PaymentRequestFaker.with_merchant_id(merchant_id="inactive-merchant-id"),
+            faker.PaymentRequestFaker.with_merchant_id(merchant_id="fake-merchant-id")]),
+        repository=repository,
+        processor=faker.StubApprovedTransactionCardNotPresentProvider(),
+        merchants=merchants))
+
+    assert [(payment.payment_id, payment.status, payment.response_code) for payment in batch_response.payments] == [
+        ("", services.PaymentStatus.REJECTED, services.MERCHANT_REFUSED_RESPONSE_CODE),
+        ("1", services.PaymentStatus.APPROVED, "00"),
+        ("", services.PaymentStatus.REJECTED, services.MERCHANT_REFUSED_RESPONSE_CODE),
+        ("2", services.PaymentStatus.APPROVED, "00")]
+    assert "inactive-merchant-id" in batch_response.payments[2].response_message
+    assert sorted(repository.payments) == ["1", "2"]
@@ -0,0 +1,55 @@
+from typing import List, Optional
+
+
+class FakeCursor:
+    def __init__(self, connection: "FakeConnection") -> None:
+        self.connection = connection
+
+    def execute(self, query: str, params: Optional[tuple] = None) -> None:
+        if self.connection.broken:
+            raise ConnectionError("server closed the connection unexpectedly")
+        self.connection.executed.append(query)
+        self.connection.params.append(params)
+
+    def fetchall(self) -> List[tuple]:
+        return self.connection.results.pop(0) if self.connection.results else []
+
+    def fetchone(self) -> Optional[tuple]:
+        rows = self.fetchall()
+        return rows[0] if rows else None
+
+    def close(self) -> None:
+        ...
+
+
+class FakeConnection:
+    def __init__(self) -> None:
+        self.closed = 0
+        self.broken = False
+        self.rollbacks = 0
+        self.commits = 0
+        self.executed: List[str] = []
+        self.params: List[Optional[tuple]] = []
+        self.results: List[List[tuple]] = []
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def commit(self) -> None:
+        self.commits += 1
+
+    def rollback(self) -> None:
+        self.rollbacks += 1
+
+    def close(self) -> None:
+        self.closed = 1
+
+
+class FakeConnectionFactory:
+    def __init__(self) -> None:
+        self.connections: List[FakeConnection] = []
+
+    def __call__(self) -> FakeConnection:
+        connection = FakeConnection()
+        self.connections.append(connection)
+        return connection
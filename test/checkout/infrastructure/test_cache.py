@@ -0,0 +1,75 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from typing import List
+
+from checkout.infrastructure import cache
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_should_expire_an_entry_after_its_ttl() -> None:
+    clock = FakeClock()
+    subject = cache.TTLCache(max_size=10, ttl_seconds=5, clock=clock)
+    subject.set("short", 1, ttl_seconds=1)
+    subject.set("long", 2)
+
+    clock.now = 2
+
+    assert subject.get("short") is None
+    assert subject.get("long") == 2
+
+
+def test_should_evict_the_least_recently_used_entry_when_full() -> None:
+    subject = cache.TTLCache(max_size=2, ttl_seconds=60)
+    subject.set("first", 1)
+    subject.set("second", 2)
+    subject.get("first")
+
+    subject.set("third", 3)
+
+    assert subject.get("second") is None
+    assert subject.get("first") == 1
+    assert subject.get("third") == 3
+
+
+def test_should_run_a_single_call_for_concurrent_callers_of_the_same_key() -> None:
+    single_flight = cache.AsyncSingleFlight()
+    calls: List[str] = []
+
+    async def call() -> str:
+        calls.append("call")
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def concurrent_callers() -> List[str]:
+        return await asyncio.gather(*(single_flight.do("key", call) for _ in range(5)))
+
+    assert asyncio.run(concurrent_callers()) == ["result"] * 5
+    assert calls == ["call"]
+
+
+def test_should_block_concurrent_threads_of_the_same_key_on_a_single_call() -> None:
+    single_flight = cache.SingleFlight()
+    release = threading.Event()
+    calls: List[str] = []
+
+    def call() -> str:
+        calls.append("call")
+        release.wait(1)
+        return "result"
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+        results = [executor.submit(single_flight.do, "key", call) for _ in range(5)]
+        time.sleep(0.05)
+        release.set()
+
+    assert [result.result() for result in results] == ["result"] * 5
+    assert calls == ["call"]
@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+from checkout.infrastructure import database, deadline
+from test.checkout.infrastructure import faker
+
+
+def test_should_reuse_a_released_connection_instead_of_opening_a_new_one() -> None:
+    factory = faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(max_size=2), connect=factory)
+
+    with pool.connection() as first:
+        ...
+    with pool.connection() as second:
+        ...
+
+    assert first is second
+    assert len(factory.connections) == 1
+    assert pool.stats().acquisitions == 2
+
+
+def test_should_time_out_when_every_connection_is_in_use() -> None:
+    pool = database.ConnectionPool(
+        settings=database.PoolSettings(max_size=1, acquire_timeout_seconds=0.01),
+        connect=faker.FakeConnectionFactory())
+
+    with pool.connection():
+        with pytest.raises(database.PoolTimeoutError):
+            with pool.connection():
+                ...
+
+    stats = pool.stats()
+    assert stats.timeouts == 1
+    assert stats.waits == 0
+    assert stats.size == 1
+
+
+def test_should_give_the_statements_and_the_wait_for_a_connection_the_remaining_budget() -> None:
+    factory = faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(max_size=1, acquire_timeout_seconds=5.0),
+                                   connect=factory)
+
+    with deadline.scope(2.0):
+        with pool.connection():
+            started = time.monotonic()
+            with deadline.scope(0.01), pytest.raises(database.PoolTimeoutError):
+                with pool.connection():
+                    ...
+            assert time.monotonic() - started < 1.0
+
+    connection, = factory.connections
+    assert connection.executed == ["SET LOCAL statement_timeout = %s"]
+    timeout_milliseconds, = connection.params[0]
+    assert 1000 < timeout_milliseconds <= 2000
+
+
+def test_should_replace_a_connection_that_fails_the_health_check() -> None:
+    factory = faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(
+        settings=database.PoolSettings(max_size=1, health_check_after_seconds=0), connect=factory)
+
+    with pool.connection() as first:
+        first.broken = True
+    with pool.connection() as second:
+        ...
+
+    assert first is not second
+    assert first.closed
+    assert pool.stats().health_check_failures == 1
+    assert pool.stats().size == 1
+
+
+def test_should_reap_idle_connections_above_the_minimum_size() -> None:
+    factory = faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(
+        settings=database.PoolSettings(min_size=1, max_size=3, max_idle_seconds=0), connect=factory)
+
+    with pool.connection():
+        with pool.connection():
+            ...
+
+    stats = pool.stats()
+    assert stats.size == 1
+    assert stats.reaped == 1
+    assert len([conn for conn in factory.connections if conn.closed]) == 1
+
+
+def test_should_upsert_the_latest_state_of_every_staged_row_in_a_single_commit() -> None:
+    factory = faker.FakeConnectionFactory()
+    unit_of_work = database.PostgresUnitOfWork(
+        pool=database.ConnectionPool(settings=database.PoolSettings(), connect=factory))
+    writer = database.TableWriter(table="payments", columns=("payment_id", "status"),
+                                  key_columns=("payment_id",), update_columns=("status",))
+
+    unit_of_work.stage(writer, ("1", "PENDING"))
+    unit_of_work.stage(writer, ("2", "PENDING"))
+    unit_of_work.stage(writer, ("1", "APPROVED"))
+    unit_of_work.commit()
+    unit_of_work.commit()
+
+    connection, = factory.connections
+    assert connection.commits == 1
+    assert len(connection.executed) == 1
+    assert "ON CONFLICT (payment_id) DO UPDATE SET status = EXCLUDED.status" in connection.executed[0]
+    assert connection.params == [["1", "APPROVED", "2", "PENDING"]]
@@ -0,0 +1,97 @@
+import socket
+import struct
+import threading
+import time
+from typing import Iterator
+
+import pytest
+
+from benchmark import acquirer_simulator
+from checkout.infrastructure import http_client
+
+
+@pytest.fixture
+def simulator() -> Iterator[acquirer_simulator.AcquirerSimulator]:
+    simulator = acquirer_simulator.AcquirerSimulator(("127.0.0.1", 0), behaviour=acquirer_simulator.Behaviour(
+        latency=acquirer_simulator.parse_latency("constant:0.2"), response_codes=[("00", 1.0)])).start()
+    yield simulator
+    simulator.stop()
+
+
+def test_should_keep_the_connection_alive_between_requests(simulator: acquirer_simulator.AcquirerSimulator) -> None:
+    pool = http_client.HTTPConnectionPool(settings=http_client.HTTPPoolSettings())
+
+    for _ in range(3):
+        assert pool.request("POST", simulator.url + "/v1/captures", body=b"{}").status == 200
+
+    stats, = pool.stats()
+    assert stats.requests == 3
+    assert stats.connections_opened == 1
+    assert simulator.connections == 1
+
+
+def test_should_wait_for_a_connection_of_a_busy_host_up_to_the_acquire_timeout(
+        simulator: acquirer_simulator.AcquirerSimulator) -> None:
+    pool = http_client.HTTPConnectionPool(settings=http_client.HTTPPoolSettings(
+        max_connections_per_host=1, acquire_timeout_seconds=0.05))
+    busy = threading.Thread(target=pool.request, args=("POST", simulator.url + "/v1/captures", b"{}"))
+    busy.start()
+    while not pool.stats() or pool.stats()[0].in_use == 0:
+        pass
+
+    with pytest.raises(http_client.HTTPPoolTimeoutError):
+        pool.request("POST", simulator.url + "/v1/captures", body=b"{}")
+
+    busy.join()
+    stats, = pool.stats()
+    assert stats.timeouts == 1
+    assert stats.size == 1
+
+
+def test_should_retry_once_on_a_new_connection_when_the_idle_one_was_closed_by_the_server(
+        simulator: acquirer_simulator.AcquirerSimulator) -> None:
+    simulator.keep_alive_seconds = 0.1
+    pool = http_client.HTTPConnectionPool(settings=http_client.HTTPPoolSettings())
+    pool.request("POST", simulator.url + "/v1/captures", body=b"{}")
+    time.sleep(0.3)
+
+    assert pool.request("POST", simulator.url + "/v1/captures", body=b"{}").status == 200
+    stats, = pool.stats()
+    assert stats.stale_retries == 1
+    assert stats.connections_opened == 2
+
+
+def test_should_not_send_a_post_again_when_the_server_resets_after_reading_it() -> None:
+    listener = socket.create_server(("127.0.0.1", 0))
+    received = []
+
+    def serve() -> None:
+        connection, _ = listener.accept()
+        reader = connection.makefile("rb")
+        for answered in (True, False):
+            headers = []
+            while (line := reader.readline()) not in (b"\r\n", b""):
+                headers.append(line)
+            length = next(int(line.split(b":")[1]) for line in headers if line.lower().startswith(b"content-length"))
+            received.append(reader.read(length))
+            if answered:
+                connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}")
+        # Processed, then reset instead of answered.
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        connection.close()
+
+    server = threading.Thread(target=serve, daemon=True)
+    server.start()
+    pool = http_client.HTTPConnectionPool(settings=http_client.HTTPPoolSettings())
+    url = "http://127.0.0.1:%d/v1/captures" % listener.getsockname()[1]
+    pool.request("POST", url, body=b'{"n": 1}')
+
+    with pytest.raises(ConnectionError):
+        pool.request("POST", url, body=b'{"n": 2}')
+
+    server.join(1)
+    listener.close()
+    assert received == [b'{"n": 1}', b'{"n": 2}']
+    stats, = pool.stats()
+    assert stats.connections_opened == 1
+    assert stats.stale_retries == 0
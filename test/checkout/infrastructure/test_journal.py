@@ -0,0 +1,97 @@
+import os
+import pathlib
+
+import pytest
+
+from checkout.infrastructure import database, journal, write_behind
+from test.checkout.infrastructure import faker
+
+
+def test_should_replay_the_entries_that_were_not_acknowledged_before_a_restart(tmp_path: pathlib.Path) -> None:
+    first_run = journal.Journal(directory=str(tmp_path))
+    first_run.append([{"id": 1}, {"id": 2}])
+    first_run.acknowledge(first_run.read_batch(max_entries=1))
+    first_run.append([{"id": 3}])
+    first_run.close()
+
+    second_run = journal.Journal(directory=str(tmp_path))
+    replayed = []
+    drained = journal.JournalDrainer(journal=second_run, sink=replayed.extend).drain()
+
+    assert drained == 2
+    assert replayed == [{"id": 2}, {"id": 3}]
+    assert second_run.stats().pending_entries == 0
+    assert journal.Journal(directory=str(tmp_path)).stats().pending_entries == 0
+
+
+def test_should_rotate_segments_and_delete_them_once_drained(tmp_path: pathlib.Path) -> None:
+    subject = journal.Journal(directory=str(tmp_path), settings=journal.JournalSettings(segment_max_bytes=32))
+    for number in range(5):
+        subject.append([{"id": number, "padding": "x" * 10}])
+    assert subject.stats().segments == 5
+
+    drained = journal.JournalDrainer(journal=subject, sink=lambda entries: None, batch_size=2).drain()
+
+    assert drained == 5
+    assert subject.stats().segments == 1
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".log")]) == 1
+
+
+def test_should_drop_a_torn_entry_left_by_a_crash(tmp_path: pathlib.Path) -> None:
+    subject = journal.Journal(directory=str(tmp_path))
+    subject.append([{"id": 1}])
+    subject.close()
+    with open(tmp_path / "000000000001.log", "ab") as segment:
+        segment.write(b'{"id": 2')
+
+    replayed = []
+    journal.JournalDrainer(journal=journal.Journal(directory=str(tmp_path)), sink=replayed.extend).drain()
+
+    assert replayed == [{"id": 1}]
+
+
+def test_should_push_back_when_the_pending_entries_exceed_the_journal_size(tmp_path: pathlib.Path) -> None:
+    subject = journal.Journal(directory=str(tmp_path), settings=journal.JournalSettings(
+        max_pending_bytes=16, backpressure_timeout_seconds=0.01))
+    subject.append([{"id": 1, "padding": "x" * 10}])
+
+    with pytest.raises(journal.JournalFullError):
+        subject.append([{"id": 2}])
+
+    stats = subject.stats()
+    assert stats.rejected == 1
+    assert stats.backpressure_waits == 1
+    assert stats.lag_seconds > 0
+
+
+def test_should_keep_the_entries_when_the_sink_fails(tmp_path: pathlib.Path) -> None:
+    subject = journal.Journal(directory=str(tmp_path))
+    subject.append([{"id": 1}])
+
+    def failing_sink(entries) -> None:
+        raise ConnectionError("server closed the connection unexpectedly")
+
+    with pytest.raises(ConnectionError):
+        journal.JournalDrainer(journal=subject, sink=failing_sink).drain()
+
+    assert subject.stats().pending_entries == 1
+
+
+def test_should_journal_the_commit_and_apply_it_later_in_one_upsert(tmp_path: pathlib.Path) -> None:
+    factory = faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(), connect=factory)
+    write_behind_journal = journal.Journal(directory=str(tmp_path))
+    unit_of_work = write_behind.WriteBehindUnitOfWork(write_behind_journal=write_behind_journal, pool=pool)
+    writer = database.TableWriter(table="payments", columns=("payment_id", "status"),
+                                  key_columns=("payment_id",), update_columns=("status",))
+
+    unit_of_work.stage(writer, ("1", "APPROVED"))
+    unit_of_work.commit()
+    assert factory.connections == []
+
+    journal.JournalDrainer(journal=write_behind_journal,
+                           sink=lambda entries: write_behind.apply_journal_entries(entries, pool=pool)).drain()
+
+    connection, = factory.connections
+    assert connection.commits == 1
+    assert connection.params == [["1", "APPROVED"]]
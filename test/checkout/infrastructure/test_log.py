@@ -0,0 +1,76 @@
+import io
+import json
+import sys
+import threading
+from typing import Iterator, List
+
+import pydantic
+import pytest
+
+from checkout.infrastructure import log
+
+
+class BlockingStream(io.StringIO):
+    def __init__(self) -> None:
+        super().__init__()
+        self.released = threading.Event()
+
+    def write(self, text: str) -> int:
+        self.released.wait()
+        return super().write(text)
+
+
+@pytest.fixture
+def stream() -> Iterator[io.StringIO]:
+    stream = io.StringIO()
+    yield stream
+    log.configure(settings=log.LogSettings.from_env(), stream=sys.stderr)
+
+
+def _events(stream: io.StringIO) -> List[dict]:
+    log.flush()
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_should_write_events_as_json_lines_without_card_data(stream: io.StringIO) -> None:
+    log.configure(settings=log.LogSettings(level=log.INFO), stream=stream)
+
+    log.get_logger("checkout.test").error(
+        "query_failed", cardholder_name="Juls Cesar", cvv=pydantic.SecretStr("123"), merchant_id="1",
+        error=ValueError("duplicate key (pan)=(3333111122223333)"))
+
+    event, = _events(stream)
+    assert event["level"] == "error"
+    assert event["logger"] == "checkout.test"
+    assert event["event"] == "query_failed"
+    assert event["merchant_id"] == "1"
+    assert event["cardholder_name"] == "[REDACTED]"
+    assert event["cvv"] == "[REDACTED]"
+    assert event["error"] == "ValueError: duplicate key (pan)=(333311******3333)"
+
+
+def test_should_skip_events_below_the_level_and_sample_the_configured_ones(stream: io.StringIO) -> None:
+    log.configure(settings=log.LogSettings(level=log.INFO, sample_rates={"transaction_registered": 0.0}),
+                  stream=stream)
+    logger = log.get_logger("checkout.test")
+
+    logger.debug("payment_received")
+    logger.info("transaction_registered")
+    logger.info("payment_approved")
+
+    assert not logger.enabled(log.DEBUG)
+    assert [event["event"] for event in _events(stream)] == ["payment_approved"]
+
+
+def test_should_drop_events_instead_of_blocking_when_the_queue_is_full() -> None:
+    stream = BlockingStream()
+    log.configure(settings=log.LogSettings(level=log.INFO, queue_size=2), stream=stream)
+    try:
+        logger = log.get_logger("checkout.test")
+        for _ in range(10):
+            logger.info("payment_approved")
+
+        assert log.dropped() >= 7
+    finally:
+        stream.released.set()
+        log.configure(settings=log.LogSettings.from_env(), stream=sys.stderr)
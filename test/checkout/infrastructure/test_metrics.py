@@ -0,0 +1,104 @@
+import json
+import multiprocessing
+import os
+import pathlib
+import time
+from typing import Iterator
+
+import pytest
+
+from checkout.infrastructure import metrics
+
+
+def _observe_in_worker(directory: str, keep_running: bool = False) -> None:
+    registry = metrics.Registry(directory=directory)
+    registry.histogram("payment_seconds", "Payments.", labels=("route",), buckets=(0.1, 1.0)).labels(
+        "/v1/payments").observe(0.5)
+    registry.register_collector(lambda: [metrics.Sample(name="pool_in_use", help="In use.", type="gauge",
+                                                        labels=(), value=7)])
+    registry.publish()
+    while keep_running:
+        time.sleep(1)
+
+
+def test_should_expose_cumulative_histogram_buckets() -> None:
+    registry = metrics.Registry()
+    seconds = registry.histogram("payment_seconds", "Payments.", labels=("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        seconds.labels("/v1/payments").observe(value)
+
+    exposition = registry.exposition()
+
+    assert 'payment_seconds_bucket{route="/v1/payments",le="0.1"} 2' in exposition
+    assert 'payment_seconds_bucket{route="/v1/payments",le="1"} 3' in exposition
+    assert 'payment_seconds_bucket{route="/v1/payments",le="+Inf"} 4' in exposition
+    assert 'payment_seconds_sum{route="/v1/payments"} 3.65' in exposition
+    assert 'payment_seconds_count{route="/v1/payments"} 4' in exposition
+
+
+def test_should_add_up_the_metrics_of_every_live_worker_process(tmp_path: pathlib.Path) -> None:
+    worker = multiprocessing.get_context("fork").Process(target=_observe_in_worker, args=(str(tmp_path), True))
+    worker.start()
+    registry = metrics.Registry(directory=str(tmp_path))
+    registry.histogram("payment_seconds", "Payments.", labels=("route",), buckets=(0.1, 1.0)).labels(
+        "/v1/payments").observe(0.05)
+    try:
+        published_by = time.monotonic() + 5
+        while not list(tmp_path.glob("metrics-*.json")) and time.monotonic() < published_by:
+            time.sleep(0.01)
+
+        exposition = registry.exposition()
+    finally:
+        worker.terminate()
+        worker.join()
+
+    assert 'payment_seconds_bucket{route="/v1/payments",le="0.1"} 1' in exposition
+    assert 'payment_seconds_count{route="/v1/payments"} 2' in exposition
+    assert 'pool_in_use{pid="%d"} 7' % worker.pid in exposition
+
+
+def test_should_prune_the_snapshots_of_exited_workers_and_skip_stale_ones(tmp_path: pathlib.Path) -> None:
+    worker = multiprocessing.get_context("fork").Process(target=_observe_in_worker, args=(str(tmp_path),))
+    worker.start()
+    worker.join()
+    registry = metrics.Registry(directory=str(tmp_path), stale_seconds=60)
+    stale = tmp_path / f"metrics-{os.getppid()}.json"
+    stale.write_text(json.dumps({"pid": os.getppid(), "metrics": {}, "samples": [
+        ["pool_in_use", "In use.", "gauge", [], 3]]}))
+    os.utime(stale, (time.time() - 120, time.time() - 120))
+
+    exposition = registry.exposition()
+
+    assert "payment_seconds" not in exposition
+    assert "pool_in_use" not in exposition
+    assert sorted(path.name for path in tmp_path.glob("metrics-*.json")) == sorted(
+        [f"metrics-{os.getpid()}.json", stale.name])
+
+
+def test_should_time_a_generator_until_it_is_exhausted_and_count_its_errors() -> None:
+    registry = metrics.Registry()
+    seconds = registry.histogram("query_seconds", "Queries.").labels()
+    errors = registry.counter("query_errors_total", "Failed queries.").labels()
+
+    @metrics.timed(seconds, errors=errors)
+    def rows(fail: bool) -> Iterator[int]:
+        yield 1
+        if fail:
+            raise ValueError("connection lost")
+        yield 2
+
+    assert list(rows(fail=False)) == [1, 2]
+    with pytest.raises(ValueError):
+        list(rows(fail=True))
+
+    assert sum(seconds.counts) == 2
+    assert errors.value == 1
+
+
+def test_should_reject_a_metric_registered_again_with_other_labels() -> None:
+    registry = metrics.Registry()
+    registry.counter("payments_total", "Payments.", labels=("status",))
+
+    assert registry.counter("payments_total", "Payments.", labels=("status",)) is not None
+    with pytest.raises(ValueError):
+        registry.counter("payments_total", "Payments.", labels=("merchant_id",))
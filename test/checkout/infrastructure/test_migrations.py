@@ -0,0 +1,37 @@
+import pathlib
+
+import pytest
+
+from checkout.infrastructure import database
+from checkout.infrastructure.migrations import runner
+from test.checkout.infrastructure import faker
+
+
+def test_should_discover_the_shipped_migrations_in_version_order() -> None:
+    versions = [migration.version for migration in runner.discover()]
+
+    assert versions == sorted(versions)
+    assert versions[:2] == [1, 2]
+
+
+def test_should_refuse_two_migrations_with_the_same_version(tmp_path: pathlib.Path) -> None:
+    (tmp_path / "0001_first.sql").write_text("SELECT 1;")
+    (tmp_path / "0001_second.sql").write_text("SELECT 2;")
+
+    with pytest.raises(runner.MigrationError):
+        runner.discover(directory=tmp_path)
+
+
+def test_should_only_apply_the_migrations_that_were_not_applied_yet() -> None:
+    factory = faker.FakeConnectionFactory()
+    pool = database.ConnectionPool(settings=database.PoolSettings(), connect=factory)
+    with pool.connection() as conn:
+        conn.results.append([(1,)])
+    migrations = [runner.Migration(version=1, name="first", sql="SELECT 'first'"),
+                  runner.Migration(version=2, name="second", sql="SELECT 'second'")]
+
+    applied = runner.migrate(pool=pool, migrations=migrations)
+
+    assert [migration.version for migration in applied] == [2]
+    assert "SELECT 'first'" not in factory.connections[0].executed
+    assert "SELECT 'second'" in factory.connections[0].executed
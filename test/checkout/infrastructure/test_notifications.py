@@ -0,0 +1,21 @@
+import threading
+
+from psycopg2 import sql
+
+from checkout.infrastructure import notifications
+from test.checkout.infrastructure import faker
+
+
+def test_should_listen_to_the_channel_quoted_as_an_identifier() -> None:
+    factory = faker.FakeConnectionFactory()
+    connected = threading.Event()
+    listener = notifications.NotificationListener(channel="merchant_changes", on_notification=lambda payload: None,
+                                                  on_connect=connected.set, connect=factory, retry_seconds=60)
+
+    listener.start()
+    assert connected.wait(5)
+    listener.stop()
+
+    connection, = factory.connections
+    assert connection.executed == [sql.SQL("LISTEN {}").format(sql.Identifier("merchant_changes"))]
+    assert connection.closed